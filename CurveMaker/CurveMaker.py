@@ -2,7 +2,14 @@ import os
 import unittest
 from __main__ import vtk, qt, ctk, slicer
 import math
+import time
+import collections
 import numpy
+from vtk.util import numpy_support
+from CurveMakerLib import CurveArcLength, CurveCurvature, CardinalSpline, CurveSegmentIndex, CurveDeviation, updatePolyLine, polyPoints
+from CurveMakerLib import polylinePoints, splineSamplingParameters, sampleArcLengths, decimateCurve, newTubeFilter, queryDistances
+from CurveMakerLib import CurveProfiler, CurveResultCache
+import CurveMakerLib
 
 #
 # CurveMaker
@@ -49,6 +56,7 @@ class CurveMakerWidget:
 
     # Tags to manage event observers
     self.tagSourceNode = None
+    self.tagsSourceInteraction = []
     self.tagDestinationNode = None
     
     #####################
@@ -149,6 +157,43 @@ class CurveMakerWidget:
     self.InterpResolutionSliderWidget.setToolTip("Number of interpolation points between control points. Default is 25.")
     parametersFormLayout.addRow("Resolution: ", self.InterpResolutionSliderWidget)
 
+    #
+    # Radio button to select the sampling of the spline
+    #
+    self.SamplingLayout = qt.QHBoxLayout()
+    self.SamplingUniform = qt.QRadioButton("Resolution")
+    self.SamplingArcLength = qt.QRadioButton("Arc length")
+    self.SamplingAdaptive = qt.QRadioButton("Adaptive")
+    self.SamplingUniform.setToolTip("Sample each interval between control points with the resolution.")
+    self.SamplingArcLength.setToolTip("Sample the curve at regular distances (spacing).")
+    self.SamplingAdaptive.setToolTip("Sample the curve more densely where it bends, within the tolerance.")
+    self.SamplingLayout.addWidget(self.SamplingUniform)
+    self.SamplingLayout.addWidget(self.SamplingArcLength)
+    self.SamplingLayout.addWidget(self.SamplingAdaptive)
+    self.SamplingGroup = qt.QButtonGroup()
+    self.SamplingGroup.addButton(self.SamplingUniform)
+    self.SamplingGroup.addButton(self.SamplingArcLength)
+    self.SamplingGroup.addButton(self.SamplingAdaptive)
+
+    parametersFormLayout.addRow("Sampling: ", self.SamplingLayout)
+
+    self.SamplingSpacingSliderWidget = ctk.ctkSliderWidget()
+    self.SamplingSpacingSliderWidget.singleStep = 0.1
+    self.SamplingSpacingSliderWidget.minimum = 0.1
+    self.SamplingSpacingSliderWidget.maximum = 20.0
+    self.SamplingSpacingSliderWidget.value = 2.0
+    self.SamplingSpacingSliderWidget.setToolTip("Distance between the samples (maximum distance in the adaptive sampling).")
+    parametersFormLayout.addRow("Spacing (mm): ", self.SamplingSpacingSliderWidget)
+
+    self.SamplingToleranceSliderWidget = ctk.ctkSliderWidget()
+    self.SamplingToleranceSliderWidget.decimals = 3
+    self.SamplingToleranceSliderWidget.singleStep = 0.01
+    self.SamplingToleranceSliderWidget.minimum = 0.001
+    self.SamplingToleranceSliderWidget.maximum = 1.0
+    self.SamplingToleranceSliderWidget.value = 0.1
+    self.SamplingToleranceSliderWidget.setToolTip("Maximum deviation of the sampled curve from the spline in the adaptive sampling.")
+    parametersFormLayout.addRow("Tolerance (mm): ", self.SamplingToleranceSliderWidget)
+
     #
     # Radio button for ring mode
     #
@@ -171,6 +216,22 @@ class CurveMakerWidget:
     self.EnableAutoUpdateCheckBox.setToolTip("If checked, the CurveMaker module keeps updating the model as the points are updated.")
     parametersFormLayout.addRow("Auto update:", self.EnableAutoUpdateCheckBox)
 
+    #
+    # Streaming mode for control points moved by a tracker
+    #
+    self.EnableStreamingCheckBox = qt.QCheckBox()
+    self.EnableStreamingCheckBox.checked = 0
+    self.EnableStreamingCheckBox.setToolTip("If checked, only the latest position of the control points is processed, and the tube is simplified to keep the latency under the budget.")
+    parametersFormLayout.addRow("Streaming:", self.EnableStreamingCheckBox)
+
+    self.LatencyBudgetSliderWidget = ctk.ctkSliderWidget()
+    self.LatencyBudgetSliderWidget.singleStep = 5.0
+    self.LatencyBudgetSliderWidget.minimum = 10.0
+    self.LatencyBudgetSliderWidget.maximum = 500.0
+    self.LatencyBudgetSliderWidget.value = 50.0
+    self.LatencyBudgetSliderWidget.setToolTip("Maximum latency (ms) from a control point update to the update of the model in the streaming mode.")
+    parametersFormLayout.addRow("Latency budget (ms): ", self.LatencyBudgetSliderWidget)
+
     #
     # Button to generate a curve
     #
@@ -185,12 +246,25 @@ class CurveMakerWidget:
     self.RingOff.connect('clicked(bool)', self.onRingOff)
     self.RingOn.connect('clicked(bool)', self.onRingOn)
     self.EnableAutoUpdateCheckBox.connect('toggled(bool)', self.onEnableAutoUpdate)
+    self.EnableStreamingCheckBox.connect('toggled(bool)', self.onEnableStreaming)
+    self.LatencyBudgetSliderWidget.connect("valueChanged(double)", self.onLatencyBudgetUpdated)
     self.SourceSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSourceSelected)
     self.DestinationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onDestinationSelected)
     self.RadiusSliderWidget.connect("valueChanged(double)", self.onTubeUpdated)
     self.InterpResolutionSliderWidget.connect("valueChanged(double)", self.onInterpResolutionUpdated)
+    self.SamplingUniform.connect('clicked(bool)', self.onSelectSamplingUniform)
+    self.SamplingArcLength.connect('clicked(bool)', self.onSelectSamplingArcLength)
+    self.SamplingAdaptive.connect('clicked(bool)', self.onSelectSamplingAdaptive)
+    self.SamplingSpacingSliderWidget.connect("valueChanged(double)", self.onSamplingSpacingUpdated)
+    self.SamplingToleranceSliderWidget.connect("valueChanged(double)", self.onSamplingToleranceUpdated)
     self.GenerateButton.connect('clicked(bool)', self.onGenerateCurve)
 
+    # Preview the tube while the sliders are dragged
+    for slider in [self.RadiusSliderWidget, self.InterpResolutionSliderWidget,
+                   self.SamplingSpacingSliderWidget, self.SamplingToleranceSliderWidget]:
+      slider.slider().connect('sliderPressed()', self.logic.startInteraction)
+      slider.slider().connect('sliderReleased()', self.logic.endInteraction)
+
     # Set default
     ## default interpolation method
     self.InterpolationCardinalSpline.setChecked(True)
@@ -200,6 +274,13 @@ class CurveMakerWidget:
     self.RingOff.setChecked(True)
     self.onRingOff(True)
 
+    ## default sampling
+    self.SamplingUniform.setChecked(True)
+    self.onSelectSamplingUniform(True)
+
+    ## merge the curve updates while dragging sliders or control points
+    self.logic.setUpdateInterval(50)
+
     
     #
     # Curve Length area
@@ -384,11 +465,18 @@ class CurveMakerWidget:
 
 
   def cleanup(self):
-    pass
+    self.logic.removeAllCurves()
+    self.logic.clearControlPointCache()
 
   def onEnableAutoUpdate(self, state):
     self.logic.enableAutomaticUpdate(state)
 
+  def onEnableStreaming(self, state):
+    self.logic.setStreamingMode(state, self.LatencyBudgetSliderWidget.value)
+
+  def onLatencyBudgetUpdated(self):
+    self.logic.setStreamingMode(self.logic.StreamingMode, self.LatencyBudgetSliderWidget.value)
+
   def onGenerateCurve(self):
     self.logic.generateCurveOnce()
     
@@ -396,6 +484,10 @@ class CurveMakerWidget:
     # Remove observer if previous node exists
     if self.logic.SourceNode and self.tagSourceNode:
       self.logic.SourceNode.RemoveObserver(self.tagSourceNode)
+    if self.logic.SourceNode:
+      for tag in self.tagsSourceInteraction:
+        self.logic.SourceNode.RemoveObserver(tag)
+    self.tagsSourceInteraction = []
 
     # Update selected node, add observer, and update control points
     if self.SourceSelector.currentNode():
@@ -405,6 +497,11 @@ class CurveMakerWidget:
       tubeModelID = self.logic.SourceNode.GetAttribute('CurveMaker.CurveModel')
       self.DestinationSelector.setCurrentNodeID(tubeModelID)
       self.tagSourceNode = self.logic.SourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.logic.controlPointsUpdated, 2)
+      # Preview the tube while control points are dragged
+      if hasattr(slicer.vtkMRMLMarkupsNode, 'PointStartInteractionEvent'):
+        self.tagsSourceInteraction = [
+          self.logic.SourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointStartInteractionEvent, self.logic.startInteraction),
+          self.logic.SourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, self.logic.endInteraction)]
 
     # Update checkbox
     if (self.SourceSelector.currentNode() == None or self.DestinationSelector.currentNode() == None):
@@ -444,6 +541,35 @@ class CurveMakerWidget:
     self.logic.setInterpResolution(self.InterpResolutionSliderWidget.value)
 
     
+  def onSelectSamplingUniform(self, s):
+    self.logic.setSamplingMode(0)
+    self.updateSamplingInterface()
+
+
+  def onSelectSamplingArcLength(self, s):
+    self.logic.setSamplingMode(1)
+    self.updateSamplingInterface()
+
+
+  def onSelectSamplingAdaptive(self, s):
+    self.logic.setSamplingMode(2)
+    self.updateSamplingInterface()
+
+
+  def onSamplingSpacingUpdated(self):
+    self.logic.setSamplingSpacing(self.SamplingSpacingSliderWidget.value)
+
+
+  def onSamplingToleranceUpdated(self):
+    self.logic.setSamplingTolerance(self.SamplingToleranceSliderWidget.value)
+
+
+  def updateSamplingInterface(self):
+    self.InterpResolutionSliderWidget.enabled = (self.logic.SamplingMode == 0)
+    self.SamplingSpacingSliderWidget.enabled = (self.logic.SamplingMode != 0)
+    self.SamplingToleranceSliderWidget.enabled = (self.logic.SamplingMode == 2)
+
+
   def onReload(self,moduleName="CurveMaker"):
     """Generic reload method for any scripted module.
     ModuleWizard will subsitute correct default moduleName.
@@ -453,14 +579,14 @@ class CurveMakerWidget:
     
   def onSelectInterpolationNone(self, s):
     self.logic.setInterpolationMethod(0)
-    self.InterpResolutionSliderWidget.enabled = True
+    self.updateSamplingInterface()
     if self.RingOn != None:
       self.RingOn.enabled = True
 
       
   def onSelectInterpolationCardinalSpline(self, s):
     self.logic.setInterpolationMethod(1)
-    self.InterpResolutionSliderWidget.enabled = True
+    self.updateSamplingInterface()
     if self.RingOn != None:
       self.RingOn.enabled = True
 
@@ -485,7 +611,6 @@ class CurveMakerWidget:
     self.meanCurvatureLineEdit.text = '--'
     self.minCurvatureLineEdit.text = '--'
     self.maxCurvatureLineEdit.text = '--'
-    self.logic.updateCurve()
     
     
   def onCurvatureOn(self, s):
@@ -503,7 +628,8 @@ class CurveMakerWidget:
     self.minCurvatureLineEdit.enabled = True
     self.maxCurvatureLineEdit.enabled = True
     #self.logic.updateCurve()
-    self.logic.generateCurveOnce()
+    if not self.logic.AutomaticUpdate:
+      self.logic.generateCurveOnce()
 
     
   def onAutoCurvatureRangeOff(self, s):
@@ -533,9 +659,11 @@ class CurveMakerWidget:
 
     
   def onModelModifiedEvent(self, caller, event):
+    start = self.logic.Profiler.start()
     self.lengthLineEdit.text = '%.2f' % self.logic.CurveLength
     self.updateTargetFiducialsTable()
     self.updateCurvatureInterface()
+    self.logic.Profiler.stop('widget.onModelModifiedEvent', start, self.fiducialsTable.rowCount)
 
         
   def onModelDisplayModifiedEvent(self, caller, event):
@@ -603,14 +731,17 @@ class CurveMakerWidget:
       if self.fiducialsTable.rowCount != nOfControlPoints:
         self.fiducialsTable.setRowCount(nOfControlPoints)
 
+      positions = self.logic.getControlPoints(self.targetFiducialsNode)
+
+      (errs, evecs, segs) = self.logic.distancesToPoints(positions, extrapolate)
+
       dist = ''
       for i in range(nOfControlPoints):
 
         label = self.targetFiducialsNode.GetNthFiducialLabel(i)
-        pos = [0.0, 0.0, 0.0]
-
-        self.targetFiducialsNode.GetNthControlPointPosition(i,pos)
-        (err, evec) = self.logic.distanceToPoint(pos, extrapolate)
+        pos = positions[i]
+        err = errs[i]
+        evec = evecs[i]
 
         posstr = '(%.3f, %.3f, %.3f)' % (pos[0], pos[1], pos[2])
         if showErrorVec:
@@ -637,6 +768,37 @@ class CurveMakerWidget:
 
 class CurveMakerLogic:
 
+  # Stages of the curve generation. Each stage is recomputed only if it has
+  # been invalidated (see invalidate()).
+  StageControlPoints = 1   # Fetch the control points from SourceNode
+  StageSampling      = 2   # Sample the centerline (CurvePoly)
+  StageLength        = 4   # Arc length (ArcLength, CurveLength)
+  StageCurvature     = 8   # "Curvature" and "Deviation" point arrays
+  StageTube          = 16  # Tube surface (DestinationNode)
+  StageAll           = 31
+
+  # Stages to be recomputed when a stage is invalidated
+  Downstream = {
+    StageControlPoints : StageAll,
+    StageSampling      : StageSampling | StageLength | StageCurvature | StageTube,
+    StageLength        : StageLength,
+    StageCurvature     : StageCurvature | StageTube,
+    StageTube          : StageTube,
+    }
+
+  # Stage invalidated by each parameter (see setEngineParameters())
+  ParameterStages = {
+    'InterpolationMethod' : StageSampling,
+    'RingMode'            : StageSampling,
+    'interpResolution'    : StageSampling,
+    'SamplingMode'        : StageSampling,
+    'SamplingSpacing'     : StageSampling,
+    'SamplingTolerance'   : StageSampling,
+    'Curvature'           : StageCurvature,
+    'TubeRadius'          : StageTube,
+    'TubeNumberOfSides'   : StageTube,
+    }
+
   def __init__(self):
     self.SourceNode = None
     self.DestinationNode = None
@@ -646,6 +808,10 @@ class CurveMakerLogic:
     self.NumberOfIntermediatePoints = 20
     self.ModelColor = [0.0, 0.0, 1.0]
 
+    self.ControlPoints = None  ## Control points of the curve (Nx3 array)
+    self.controlPointCaches = {}  ## ControlPointCache for each markups node ID
+    self.cacheScene = None  ## Scene observed to drop the caches of the removed nodes
+    self.cacheSceneTag = None
     self.CurvePoly = None
     self.interpResolution = 25
     
@@ -654,41 +820,543 @@ class CurveMakerLogic:
     #  1: Cardinal Spline (VTK default)
     self.InterpolationMethod = 0
 
+    # Sampling of the cardinal spline (see splineSamplingParameters()):
+    #  0: Uniform in the spline parameter (interpResolution)
+    #  1: Uniform in arc length (SamplingSpacing)
+    #  2: Adaptive to the curvature (SamplingTolerance)
+    self.SamplingMode = 0
+    self.SamplingSpacing = 2.0
+    self.SamplingTolerance = 0.1
+
     self.RingMode = 0
     self.CurveLength = -1.0  ## Length of the curve (<0 means 'not measured')
+    self.ArcLength = None    ## Cumulative arc length along the curve (CurveArcLength)
+    self.CurvatureData = None ## Point-by-point curvature (CurveCurvature)
+
     self.Curvature = 0
     self.curvatureMeanKappa = None
     self.curvatureMinKappa = None
     self.curvatureMaxKappa = None
 
+    ## Reference curve of the "Deviation" point array (see
+    ## setDeviationReference()), and the deviation from it (CurveDeviation)
+    self.DeviationReference = None
+    self.DeviationData = None
+
+    ## State of the last cardinal spline sampling, used to update the curve
+    ## locally when control points are moved (see updateCurveLocally())
+    self.Spline = None
+    self.SplineParameters = None
+    self.SplineSamples = None
+
+    ## Tube filter generating the model of DestinationNode from CurvePoly.
+    ## The filter and its output are kept while the destination is unchanged.
+    self.TubeFilter = None
+    self.tubeDestinationNode = None
+
+    ## Level of detail of the tube. During interactions (see
+    ## startInteraction()), a preview of the tube is generated with
+    ## PreviewNumberOfSides sides around every PreviewDecimation-th point of
+    ## the curve. The full tube is generated when the interactions end.
+    self.TubeNumberOfSides = 20
+    self.PreviewNumberOfSides = 6
+    self.PreviewDecimation = 4
+    self.InteractionCount = 0
+    self.PreviewPoly = None
+    self.tubeIsPreview = False
+
+    ## Spatial index over the segments of CurvePoly for distance queries.
+    ## Built on the first query after each updateCurve().
+    self.SegmentIndex = None
+    self.UseSegmentIndex = True
+
+    ## Number of points above which computeDistanceMap() shows a progress
+    ## dialog (see DistanceMapProgress).
+    self.DistanceMapProgressPoints = 1000000
+
+    ## Update scheduler. Update requests (parameter changes and control point
+    ## moves) arriving within UpdateInterval (ms) after an update are merged
+    ## into one update, performed when the interval expires with the latest
+    ## state. If UpdateInterval is 0, every request is processed immediately.
+    ## The timers of the logic are created on first use: the curves managed
+    ## by another logic (see addCurve()) never use their update timer.
+    self.UpdateInterval = 0
+    self.updateTimer = None
+    self.pendingRequests = 0
+    self.UpdateRequestCount = 0
+    self.UpdateCount = 0
+    self.MergedUpdateRequestCount = 0
+
+    ## Stages to be recomputed at the next update, and the nodes used for the
+    ## last update
+    self.DirtyStages = self.StageAll
+    self.pendingFullUpdate = True
+    self.builtSourceNode = None
+    self.builtDestinationNode = None
+
+    ## Per-stage timing and counters (disabled by default, see enableProfiling())
+    self.Profiler = CurveProfiler()
+
+    ## Cache of the generated curves for the recently used control points and
+    ## parameters (see getResultCacheKey()), e.g. when the parameters are
+    ## switched back and forth in the widget. Bounded by the default memory
+    ## of CurveResultCache (see setResultCacheSize()).
+    self.ResultCache = CurveResultCache()
+
+    ## Additional curves managed by this logic (see addCurve()). Each curve
+    ## is a CurveMakerLogic with its own nodes and parameters, whose updates
+    ## are requested to the scheduler of this logic (Manager) and performed
+    ## together. Only the curves with pending requests are updated. The tubes
+    ## of the curves may also be merged into MergedModelNode.
+    self.Curves = collections.OrderedDict()  ## Curve logic for each source node ID
+    self.curveObserverTags = {}  ## Observer tags on the source node for each source node ID
+    self.pendingCurves = []
+    self.Manager = None
+    self.MergedModelNode = None
+    self.mergeFilter = None
+
+    ## Streaming mode for control points moved by a tracker (see
+    ## setStreamingMode()). The update requests are not processed when they
+    ## arrive, but by the scheduler when the event loop is idle (see
+    ## scheduleUpdate()), so that the samples arriving during a generation
+    ## are merged into one update with the latest positions (the older
+    ## samples are dropped). For the curves managed by another logic, this
+    ## is the scheduler of the manager, which also updates the merged model.
+    ## The latency from the latest sample to the update of the model is
+    ## measured. The tube is reduced to its preview while the full tube does
+    ## not fit in LatencyBudget (ms), and the full tube is generated when no
+    ## sample has arrived for StreamIdleInterval (ms).
+    self.StreamingMode = False
+    self.LatencyBudget = 50.0
+    self.StreamIdleInterval = 250
+    self.streamIdleTimer = None
+    self.streamSampleTime = None  ## Arrival time of the latest unprocessed sample
+    self.streamPreview = False
+    self.streamFullUpdateTime = 0.0  ## Duration (ms) of the last update with the full tube
+    self.lastUpdateTime = 0.0  ## Duration (ms) of the last update
+    self.resetStreamingStatistics()
+
+  def setUpdateInterval(self, interval):
+    self.UpdateInterval = interval
+    if interval <= 0 and (self.pendingRequests > 0 or len(self.pendingCurves) > 0):
+      if self.updateTimer:
+        self.updateTimer.stop()
+      self.processPendingUpdate()
+
+  def invalidate(self, stage, local=False):
+    # Marks 'stage' and the stages depending on it to be recomputed.
+    # 'local' is True if only the control points have been moved, in which
+    # case the curve may be updated locally (see updateCurveLocally()).
+    self.DirtyStages = self.DirtyStages | self.Downstream[stage]
+    if not local:
+      self.pendingFullUpdate = True
+
+  def requestUpdate(self, stage=StageControlPoints, local=False):
+    # Invalidates 'stage' (see invalidate()) and requests an update of the
+    # curve through the update scheduler.
+    self.invalidate(stage, local)
+    self.UpdateRequestCount = self.UpdateRequestCount + 1
+    self.pendingRequests = self.pendingRequests + 1
+
+    if self.Manager:
+      self.Manager.requestCurveUpdate(self)
+    else:
+      self.scheduleUpdate()
+
+  def requestCurveUpdate(self, curve):
+    # Called by the curves managed by this logic (see addCurve()) when they
+    # have requested an update
+    if curve not in self.pendingCurves:
+      self.pendingCurves.append(curve)
+    self.scheduleUpdate()
+
+  def isStreaming(self):
+    # True if this logic or one of its curves is in the streaming mode
+    if self.StreamingMode:
+      return True
+    for curve in self.Curves.values():
+      if curve.StreamingMode:
+        return True
+    return False
+
+  def scheduleUpdate(self):
+    if self.isStreaming():
+      # Deferred to the next iteration of the event loop, merging the
+      # requests arriving meanwhile
+      if not self.isUpdateTimerActive():
+        self.startUpdateTimer(0)
+    elif self.UpdateInterval <= 0:
+      self.processPendingUpdate()
+    elif not self.isUpdateTimerActive():
+      # Not in a burst: update now, and merge the following requests
+      self.processPendingUpdate()
+      self.startUpdateTimer(self.UpdateInterval)
+
+  def startUpdateTimer(self, interval):
+    if self.updateTimer == None:
+      self.updateTimer = qt.QTimer()
+      self.updateTimer.setSingleShot(True)
+      self.updateTimer.connect('timeout()', self.onUpdateTimer)
+    self.updateTimer.start(interval)
+
+  def isUpdateTimerActive(self):
+    return self.updateTimer != None and self.updateTimer.isActive()
+
+  def onUpdateTimer(self):
+    # End of an update interval. Perform the merged update if any requests
+    # have arrived during the interval (this also guarantees a final update
+    # with the last state at the end of a burst).
+    if self.pendingRequests > 0 or len(self.pendingCurves) > 0:
+      self.processPendingUpdate()
+      if not self.isStreaming():
+        self.startUpdateTimer(self.UpdateInterval)
+
+  def processPendingUpdate(self):
+    if self.pendingRequests > 0:
+      self.MergedUpdateRequestCount = self.MergedUpdateRequestCount + self.pendingRequests - 1
+      self.pendingRequests = 0
+      self.UpdateCount = self.UpdateCount + 1
+
+      start = time.perf_counter()
+      self.Profiler.beginUpdate()
+      kind = 'local'
+      if self.pendingFullUpdate or not self.updateCurveLocally():
+        kind = 'full'
+        self.updateDirtyStages()
+      self.Profiler.endUpdate(kind)
+      self.lastUpdateTime = (time.perf_counter() - start) * 1000.0
+      if self.Manager == None:
+        self.endStreamUpdate()
+
+    if len(self.pendingCurves) > 0:
+      self.updatePendingCurves()
+
+  def addCurve(self, sourceNode, destinationNode, parameters=None):
+    # Adds a curve generated from the markups node 'sourceNode' into the
+    # model node 'destinationNode', with its own 'parameters' (see
+    # getEngineParameters(); the parameters of this logic by default).
+    # The curve follows the control points of 'sourceNode' and is updated
+    # by the scheduler of this logic, together with the other curves.
+    # Returns the logic of the curve, whose setters may be used to change
+    # its parameters.
+    self.removeCurve(sourceNode)
+
+    curve = CurveMakerLogic()
+    curve.Manager = self
+    curve.SourceNode = sourceNode
+    curve.DestinationNode = destinationNode
+    curve.ModelColor = list(self.ModelColor)
+    curve.AutomaticUpdate = True
+    curve.Profiler = self.Profiler
+    curve.ResultCache = self.ResultCache
+    if parameters == None:
+      parameters = self.getEngineParameters()
+    for (name, value) in parameters.items():
+      setattr(curve, name, value)
+
+    tags = [sourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, curve.controlPointsUpdated, 2),
+            sourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointAddedEvent, curve.controlPointsUpdated, 2),
+            sourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointRemovedEvent, curve.controlPointsUpdated, 2)]
+    if hasattr(slicer.vtkMRMLMarkupsNode, 'PointStartInteractionEvent'):
+      tags.append(sourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointStartInteractionEvent, curve.startInteraction))
+      tags.append(sourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, curve.endInteraction))
+
+    self.Curves[sourceNode.GetID()] = curve
+    self.curveObserverTags[sourceNode.GetID()] = tags
+    curve.requestUpdate(self.StageControlPoints)
+    return curve
+
+  def removeCurve(self, sourceNode):
+    # Stops updating the curve of 'sourceNode' (its model is left unchanged,
+    # and shown again if it has been hidden by the merged model)
+    curve = self.Curves.pop(sourceNode.GetID(), None)
+    if curve == None:
+      return
+    if self.MergedModelNode:
+      self.setCurveModelVisibility(curve, True)
+    for tag in self.curveObserverTags.pop(sourceNode.GetID()):
+      sourceNode.RemoveObserver(tag)
+    curve.clearControlPointCache()
+    curve.Manager = None
+    if curve in self.pendingCurves:
+      self.pendingCurves.remove(curve)
+    if self.MergedModelNode:
+      self.updateMergedModel()
+
+  def removeAllCurves(self):
+    for curve in list(self.Curves.values()):
+      self.removeCurve(curve.SourceNode)
+
+  def getCurve(self, sourceNode):
+    # Returns the logic of the curve of 'sourceNode', or None
+    return self.Curves.get(sourceNode.GetID())
+
+  def getCurves(self):
+    return list(self.Curves.values())
+
+  def setMergedModel(self, modelNode):
+    # Merges the tubes of all the curves added with addCurve() into
+    # 'modelNode' (e.g. to render them as one model). The models of the
+    # curves are hidden while merging, so that the tubes are rendered once.
+    # None stops merging and shows the models of the curves again.
+    self.MergedModelNode = modelNode
+    if modelNode:
+      self.updateMergedModel()
+    else:
+      for curve in self.Curves.values():
+        self.setCurveModelVisibility(curve, True)
+
+  def setCurveModelVisibility(self, curve, visible):
+    displayNode = curve.DestinationNode.GetDisplayNode()
+    if displayNode and displayNode.GetVisibility() != visible:
+      displayNode.SetVisibility(visible)
+
+  def updatePendingCurves(self):
+    # Updates the curves that have requested an update (in the order in
+    # which they have been added), then the merged model
+    pending = self.pendingCurves
+    self.pendingCurves = []
+
+    self.Profiler.beginUpdate()
+    for curve in self.Curves.values():
+      if curve in pending:
+        curve.processPendingUpdate()
+    if self.MergedModelNode:
+      self.updateMergedModel()
+    self.Profiler.endUpdate('curves')
+    for curve in pending:
+      curve.endStreamUpdate()
+
+  def updateMergedModel(self):
+    start = self.Profiler.start()
+    if self.mergeFilter == None:
+      self.mergeFilter = vtk.vtkAppendPolyData()
+    self.mergeFilter.RemoveAllInputs()
+    nOfInputs = 0
+    for curve in self.Curves.values():
+      self.setCurveModelVisibility(curve, False)
+      if curve.TubeFilter:
+        self.mergeFilter.AddInputData(curve.TubeFilter.GetOutput())
+        nOfInputs = nOfInputs + 1
+    if nOfInputs > 0:
+      self.mergeFilter.Update()
+      merged = self.mergeFilter.GetOutput()
+    else:
+      merged = vtk.vtkPolyData()
+
+    if self.MergedModelNode.GetDisplayNodeID() == None:
+      modelDisplayNode = slicer.vtkMRMLModelDisplayNode()
+      modelDisplayNode.SetColor(self.ModelColor)
+      slicer.mrmlScene.AddNode(modelDisplayNode)
+      self.MergedModelNode.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
+    if self.MergedModelNode.GetPolyData() is not merged:
+      self.MergedModelNode.SetAndObservePolyData(merged)
+    self.MergedModelNode.Modified()
+    if self.MergedModelNode.GetScene() == None:
+      slicer.mrmlScene.AddNode(self.MergedModelNode)
+    self.Profiler.stop('merge', start, merged.GetNumberOfPoints())
+
+  def setResultCacheSize(self, maxMemory):
+    # Maximum memory (bytes) of the cached curves. 0 disables the cache.
+    self.ResultCache.setMaxMemory(maxMemory)
+
+  def getResultCacheStatistics(self):
+    # Returns the numbers of hits, misses, evictions and entries, and the
+    # memory used by the cache (bytes)
+    return self.ResultCache.getStatistics()
+
+  def clearResultCache(self):
+    self.ResultCache.clear()
+
+  def getResultCacheKey(self):
+    # Key of the current curve in the result cache: the control points and
+    # the parameters affecting the centerline and the tube
+    parameters = (self.InterpolationMethod, self.RingMode, self.TubeRadius, self.TubeNumberOfSides, self.Curvature)
+    if self.InterpolationMethod == 1:
+      parameters = parameters + (self.SamplingMode, self.interpResolution, self.SamplingSpacing, self.SamplingTolerance)
+    return CurveResultCache.makeKey(self.ControlPoints, parameters)
+
+  def enableProfiling(self, enabled=True, logFileName=None):
+    # Records the wall time, number of calls and number of samples of each
+    # stage of the updates (see getProfile()). If 'logFileName' is specified,
+    # each update is also appended to the file as a line of JSON.
+    self.Profiler.enable(enabled, logFileName)
+
+  def getProfile(self):
+    # Returns the statistics of each stage, and the records of the last
+    # updates (see CurveMakerLib.CurveProfiler)
+    profile = {}
+    profile['stages'] = self.Profiler.getStatistics()
+    profile['updates'] = self.Profiler.getHistory()
+    return profile
+
+  def resetProfile(self):
+    self.Profiler.reset()
+
+  def getUpdateStatistics(self):
+    # Returns the numbers of update requests, updates performed, and requests
+    # merged into another update by the scheduler
+    stats = {}
+    stats['requests'] = self.UpdateRequestCount
+    stats['updates'] = self.UpdateCount
+    stats['merged'] = self.MergedUpdateRequestCount
+    stats['pending'] = self.pendingRequests
+    return stats
+
   def setNumberOfIntermediatePoints(self,npts):
     if npts > 0:
       self.NumberOfIntermediatePoints = npts
-    self.updateCurve()
+    self.requestUpdate(self.StageSampling)
 
   def setTubeRadius(self, radius):
     self.TubeRadius = radius
-    self.updateCurve()
+    self.requestUpdate(self.StageTube)
 
   def setInterpolationMethod(self, method):
     if method > 3 or method < 0:
       self.InterpolationMethod = 0
     else:
       self.InterpolationMethod = method
-    self.updateCurve()
+    self.requestUpdate(self.StageSampling)
 
   def setRing(self, switch):
     self.RingMode = switch
-    self.updateCurve()
+    self.requestUpdate(self.StageSampling)
+
+  def setTubeNumberOfSides(self, sides):
+    if sides >= 3:
+      self.TubeNumberOfSides = int(sides)
+    self.requestUpdate(self.StageTube)
+
+  def setPreviewLevel(self, sides, decimation):
+    # Number of sides of the preview tube and decimation of the curve for
+    # the preview (1: all the points)
+    if sides >= 3:
+      self.PreviewNumberOfSides = int(sides)
+    if decimation >= 1:
+      self.PreviewDecimation = int(decimation)
+    if self.tubeIsPreview:
+      self.requestUpdate(self.StageTube)
+
+  def startInteraction(self, caller=None, event=None):
+    # Called when the user starts dragging a control point or a slider.
+    # Until the matching endInteraction(), the tube is a preview.
+    self.InteractionCount = self.InteractionCount + 1
+
+  def endInteraction(self, caller=None, event=None):
+    self.InteractionCount = max(self.InteractionCount - 1, 0)
+    if self.InteractionCount == 0 and self.tubeIsPreview:
+      self.requestUpdate(self.StageTube)
+
+  def isInteracting(self):
+    # True while the tube is generated as a preview (during interactions,
+    # or while streaming above the latency budget)
+    return self.InteractionCount > 0 or self.streamPreview
+
+  def setStreamingMode(self, enabled, latencyBudget=None):
+    # Processes the control point updates in the streaming mode (see
+    # __init__()). 'latencyBudget' (ms) is the maximum latency to hold.
+    self.StreamingMode = enabled
+    if latencyBudget != None:
+      self.LatencyBudget = latencyBudget
+    if not enabled:
+      if self.streamIdleTimer:
+        self.streamIdleTimer.stop()
+      self.onStreamIdle()
+
+  def streamControlPoints(self):
+    # Control points updated in the streaming mode: the update is requested
+    # to the scheduler, which defers it to the next iteration of the event
+    # loop.
+    self.StreamSampleCount = self.StreamSampleCount + 1
+    if self.streamSampleTime != None:
+      # The previous sample has not been processed and never will be
+      self.StreamDroppedCount = self.StreamDroppedCount + 1
+    self.streamSampleTime = time.perf_counter()
+    self.requestUpdate(self.StageControlPoints, True)
+
+  def endStreamUpdate(self):
+    # Called when the model (or the merged model) has been updated. Measures
+    # the latency from the latest sample, if any.
+    if self.streamSampleTime == None:
+      return
+    latency = (time.perf_counter() - self.streamSampleTime) * 1000.0
+    self.streamSampleTime = None
+    self.streamLatencies.append(latency)
+    self.StreamUpdateCount = self.StreamUpdateCount + 1
+    if latency > self.LatencyBudget:
+      self.StreamOverBudgetCount = self.StreamOverBudgetCount + 1
+
+    # A sample may arrive just after an update has started, and wait for the
+    # whole update before being processed: the latency is up to twice the
+    # duration of an update.
+    if not self.streamPreview:
+      self.streamFullUpdateTime = self.lastUpdateTime
+      if 2.0 * self.streamFullUpdateTime > self.LatencyBudget:
+        self.streamPreview = True
+    if self.streamIdleTimer == None:
+      self.streamIdleTimer = qt.QTimer()
+      self.streamIdleTimer.setSingleShot(True)
+      self.streamIdleTimer.connect('timeout()', self.onStreamIdle)
+    self.streamIdleTimer.start(self.StreamIdleInterval)
+
+  def onStreamIdle(self):
+    # End of a stream: generate the full tube
+    if self.streamPreview:
+      self.streamPreview = False
+      self.requestUpdate(self.StageTube)
+
+  def resetStreamingStatistics(self):
+    self.StreamSampleCount = 0
+    self.StreamUpdateCount = 0
+    self.StreamDroppedCount = 0
+    self.StreamOverBudgetCount = 0
+    self.streamLatencies = collections.deque(maxlen=1000)
+
+  def getStreamingStatistics(self):
+    # Returns the numbers of samples received, updates, dropped samples and
+    # updates over the latency budget, and the latencies (ms) of the last
+    # 1000 updates
+    stats = {}
+    stats['samples'] = self.StreamSampleCount
+    stats['updates'] = self.StreamUpdateCount
+    stats['dropped'] = self.StreamDroppedCount
+    stats['overBudget'] = self.StreamOverBudgetCount
+    stats['budget_ms'] = self.LatencyBudget
+    stats['preview'] = self.streamPreview
+    latencies = numpy.array(self.streamLatencies)
+    for (name, value) in (('mean', numpy.mean), ('p50', numpy.median), ('max', numpy.max)):
+      stats['latency_%s_ms' % name] = float(value(latencies)) if latencies.shape[0] > 0 else None
+    stats['latency_p95_ms'] = float(numpy.percentile(latencies, 95)) if latencies.shape[0] > 0 else None
+    return stats
 
   def setCurvature(self, switch):
     self.Curvature = switch
-    self.updateCurve()
+    self.requestUpdate(self.StageCurvature)
 
   def setInterpResolution(self, res):
     ## Resoution is specified as the number of interpolation points between two consecutive control points
     self.interpResolution = res
-    self.updateCurve()
+    self.requestUpdate(self.StageSampling)
+
+  def setSamplingMode(self, mode):
+    if mode > 2 or mode < 0:
+      self.SamplingMode = 0
+    else:
+      self.SamplingMode = mode
+    self.requestUpdate(self.StageSampling)
+
+  def setSamplingSpacing(self, spacing):
+    ## Distance between the samples (mm), or their maximum distance in the adaptive mode
+    if spacing > 0.0:
+      self.SamplingSpacing = spacing
+    self.requestUpdate(self.StageSampling)
+
+  def setSamplingTolerance(self, tolerance):
+    ## Maximum deviation (mm) of the sampled curve from the spline in the adaptive mode
+    if tolerance > 0.0:
+      self.SamplingTolerance = tolerance
+    self.requestUpdate(self.StageSampling)
     
   def enableAutomaticUpdate(self, auto):
     self.AutomaticUpdate = auto
@@ -700,113 +1368,168 @@ class CurveMakerLogic:
     self.updateCurve()
     self.AutomaticUpdate = prevAutomaticUpdate
 
+  def getEngineParameters(self):
+    # Current parameters as the parameters of CurveMakerLib.CurveEngine
+    parameters = {}
+    parameters['InterpolationMethod'] = self.InterpolationMethod
+    parameters['RingMode'] = self.RingMode
+    parameters['interpResolution'] = self.interpResolution
+    parameters['SamplingMode'] = self.SamplingMode
+    parameters['SamplingSpacing'] = self.SamplingSpacing
+    parameters['SamplingTolerance'] = self.SamplingTolerance
+    parameters['Curvature'] = self.Curvature
+    parameters['TubeRadius'] = self.TubeRadius
+    parameters['TubeNumberOfSides'] = self.TubeNumberOfSides
+    return parameters
+
+  def setEngineParameters(self, parameters):
+    # Sets the parameters returned by getEngineParameters() (all or some of
+    # them), and requests one update of the stages affected by the changes
+    stages = []
+    for (name, value) in parameters.items():
+      stage = self.ParameterStages[name]
+      if getattr(self, name) != value:
+        setattr(self, name, value)
+        self.invalidate(stage)
+        stages.append(stage)
+    if len(stages) > 0:
+      self.requestUpdate(min(stages))
+
+  def generateCurves(self, sources, tube=False, workers=None, targets=None, extrapolate=False):
+    # Generates the curves for many sources (markups nodes, Nx3 arrays of
+    # control points or control point files) with the current parameters,
+    # in a pool of 'workers' processes (the number of CPUs by default). The
+    # scene is not modified. Returns a list of CurveMakerLib.CaseResult in
+    # the order of 'sources'; if a case fails, its 'error' is set and the
+    # other cases are still processed. See CurveMakerLib.generateCurves().
+    inputs = []
+    for source in sources:
+      if isinstance(source, slicer.vtkMRMLMarkupsNode):
+        source = self.getControlPoints(source)
+      inputs.append(source)
+    if isinstance(targets, slicer.vtkMRMLMarkupsNode):
+      targets = self.getControlPoints(targets)
+    return CurveMakerLib.generateCurves(inputs, self.getEngineParameters(), tube, workers, targets, extrapolate)
+
+  def processSequence(self, sequence, path, targets=None, extrapolate=False, tubeDirectory=None):
+    # Writes the length, curvature and target distances of the curve in each
+    # frame of 'sequence' to the CSV file 'path', with the current parameters
+    # (see CurveMakerLib.processSequence()). 'sequence' is a sequence node of
+    # markups nodes, or an iterable of markups nodes or Nx3 arrays of control
+    # points; the frames are read one by one. The tubes are written to
+    # 'tubeDirectory' if specified. The scene is not modified. Returns the
+    # number of frames.
+    def frames():
+      if hasattr(sequence, 'GetNumberOfDataNodes'):
+        for i in range(sequence.GetNumberOfDataNodes()):
+          yield ControlPointCache.read(sequence.GetNthDataNode(i))
+      else:
+        for source in sequence:
+          if isinstance(source, slicer.vtkMRMLMarkupsNode):
+            source = ControlPointCache.read(source)
+          yield source
+    if isinstance(targets, slicer.vtkMRMLMarkupsNode):
+      targets = self.getControlPoints(targets)
+    return CurveMakerLib.processSequence(frames(), path, self.getEngineParameters(), targets, extrapolate, tubeDirectory)
+
+  def exportCurveData(self, path, targets=None, extrapolate=False, append=False, metadata=None):
+    # Writes the current curve (sampled centerline, arc length and curvature
+    # at each sample, parameters) to the curve archive 'path', with the
+    # distances of 'targets' (markups node or Mx3 array) to the curve if
+    # specified. If 'append' is True, the curve is added to the curves of the
+    # archive. The archive is read with CurveMakerLib.CurveArchive.
+    if self.CurvePoly == None or self.CurvePoly.GetNumberOfPoints() == 0:
+      return
+    curvature = None
+    if self.Curvature and self.CurvatureData:
+      curvature = self.CurvatureData.values
+    distances = None
+    segments = None
+    if isinstance(targets, slicer.vtkMRMLMarkupsNode):
+      targets = self.getControlPoints(targets)
+    if targets is not None:
+      (distances, errVecs, segments) = self.distancesToPoints(targets, extrapolate)
+    with CurveMakerLib.CurveArchiveWriter(path, append) as writer:
+      samples = polyPoints(self.CurvePoly)
+      writer.write(samples, sampleArcLengths(self.ArcLength, samples), curvature, self.getEngineParameters(),
+                   targets, distances, segments, metadata)
+
   def controlPointsUpdated(self,caller,event):
-    self.updateCurve()
+    if self.StreamingMode:
+      self.streamControlPoints()
+    else:
+      self.requestUpdate(self.StageControlPoints, True)
+
+  def getControlPoints(self, sourceNode):
+    # Returns the positions of the control points as a (read-only) Nx3 array.
+    # The array is cached for each node until the node reports a modification.
+    # The cache of a node is dropped when the node is removed from the scene.
+    cache = self.controlPointCaches.get(sourceNode.GetID())
+    if cache == None or cache.node != sourceNode:
+      if cache:
+        cache.removeObservers()
+      cache = ControlPointCache(sourceNode)
+      self.controlPointCaches[sourceNode.GetID()] = cache
+      scene = sourceNode.GetScene()
+      if scene and scene != self.cacheScene:
+        self.removeCacheSceneObserver()
+        self.cacheScene = scene
+        self.cacheSceneTag = scene.AddObserver(scene.NodeRemovedEvent, self.onNodeRemoved)
+    return cache.getPoints()
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, node):
+    # Drops the cache of a node removed from the scene, and its observers
+    # (which would keep the node alive)
+    if node == None:
+      return
+    cache = self.controlPointCaches.get(node.GetID())
+    if cache and cache.node == node:
+      cache.removeObservers()
+      del self.controlPointCaches[node.GetID()]
+
+  def removeCacheSceneObserver(self):
+    if self.cacheScene:
+      self.cacheScene.RemoveObserver(self.cacheSceneTag)
+    self.cacheScene = None
+    self.cacheSceneTag = None
+
+  def clearControlPointCache(self):
+    for cache in self.controlPointCaches.values():
+      cache.removeObservers()
+    self.controlPointCaches = {}
+    self.removeCacheSceneObserver()
 
   def nodeToPoly(self, sourceNode, outputPoly, closed=False):
-    points = vtk.vtkPoints()
-    cellArray = vtk.vtkCellArray()
+    self.pointsToPoly(self.getControlPoints(sourceNode), outputPoly, closed)
 
-    nOfControlPoints = sourceNode.GetNumberOfControlPoints()
-    pos = [0.0, 0.0, 0.0]
-    posStartEnd = [0.0, 0.0, 0.0]
+  def pointsToPoly(self, controlPoints, outputPoly, closed=False):
+    # Polyline connecting the control points (see polylinePoints())
+    updatePolyLine(outputPoly, polylinePoints(controlPoints, closed))
 
-    offset = 0
-    
-    if not closed:
-      points.SetNumberOfPoints(nOfControlPoints)
-      cellArray.InsertNextCell(nOfControlPoints)
-    else:
-      posStart = [0.0, 0.0, 0.0]
-      posEnd = [0.0, 0.0, 0.0]
-      sourceNode.GetNthControlPointPosition(0,posStart)
-      sourceNode.GetNthControlPointPosition(nOfControlPoints-1,posEnd)
-      posStartEnd[0] = (posStart[0]+posEnd[0])/2.0
-      posStartEnd[1] = (posStart[1]+posEnd[1])/2.0
-      posStartEnd[2] = (posStart[2]+posEnd[2])/2.0
-      points.SetNumberOfPoints(nOfControlPoints+2)
-      cellArray.InsertNextCell(nOfControlPoints+2)
-
-      points.SetPoint(0,posStartEnd)
-      cellArray.InsertCellPoint(0)
-
-      offset = 1
-      
-    for i in range(nOfControlPoints):
-      sourceNode.GetNthControlPointPosition(i,pos)
-      points.SetPoint(offset+i,pos)
-      cellArray.InsertCellPoint(offset+i)
+  def nodeToPolyCardinalSpline(self, sourceNode, outputPoly, closed=False):
+    self.pointsToPolyCardinalSpline(self.getControlPoints(sourceNode), outputPoly, closed)
 
-    offset = offset + nOfControlPoints
-    
-    if closed:
-      points.SetPoint(offset,posStartEnd)
-      cellArray.InsertCellPoint(offset)
+  def pointsToPolyCardinalSpline(self, controlPoints, outputPoly, closed=False):
 
-    outputPoly.Initialize()
-    outputPoly.SetPoints(points)
-    outputPoly.SetLines(cellArray)
+    nOfControlPoints = controlPoints.shape[0]
 
-  def nodeToPolyCardinalSpline(self, sourceNode, outputPoly, closed=False):
+    # One spline for x, y and z (equivalent to one vtkCardinalSpline for each
+    # direction, with the control points at t = 0, 1, 2, ...)
+    spline = CardinalSpline(controlPoints, closed)
 
-    nOfControlPoints = sourceNode.GetNumberOfControlPoints()
-    pos = [0.0, 0.0, 0.0]
+    # Interpolate x, y and z and create new points (see splineSamplingParameters())
+    t = splineSamplingParameters(spline, self.interpResolution, self.SamplingMode,
+                                 self.SamplingSpacing, self.SamplingTolerance)
 
-    # One spline for each direction.
-    aSplineX = vtk.vtkCardinalSpline()
-    aSplineY = vtk.vtkCardinalSpline()
-    aSplineZ = vtk.vtkCardinalSpline()
+    # The samples are written directly to the point buffer of outputPoly
+    samples = updatePolyLine(outputPoly, None, t.shape[0])
+    spline.evaluate(t, samples)
 
-    if closed:
-      aSplineX.ClosedOn()
-      aSplineY.ClosedOn()
-      aSplineZ.ClosedOn()
-    else:
-      aSplineX.ClosedOff()
-      aSplineY.ClosedOff()
-      aSplineZ.ClosedOff()
-
-    for i in range(0, nOfControlPoints):
-      sourceNode.GetNthControlPointPosition(i, pos)
-      aSplineX.AddPoint(i, pos[0])
-      aSplineY.AddPoint(i, pos[1])
-      aSplineZ.AddPoint(i, pos[2])
-    
-    # Interpolate x, y and z by using the three spline filters and
-    # create new points
-    nInterpolatedPoints = (self.interpResolution+2)*(nOfControlPoints-1) # One section is devided into self.interpResolution segments
-    points = vtk.vtkPoints()
-    r = [0.0, 0.0]
-    aSplineX.GetParametricRange(r)
-    t = r[0]
-    p = 0
-    tStep = (nOfControlPoints-1.0)/(nInterpolatedPoints-1.0)
-    nOutputPoints = 0
-
-    if closed:
-      while t < r[1]+1.0:
-        points.InsertPoint(p, aSplineX.Evaluate(t), aSplineY.Evaluate(t), aSplineZ.Evaluate(t))
-        t = t + tStep
-        p = p + 1
-      ## Make sure to close the loop
-      points.InsertPoint(p, aSplineX.Evaluate(r[0]), aSplineY.Evaluate(r[0]), aSplineZ.Evaluate(r[0]))
-      p = p + 1
-      points.InsertPoint(p, aSplineX.Evaluate(r[0]+tStep), aSplineY.Evaluate(r[0]+tStep), aSplineZ.Evaluate(r[0]+tStep))
-      nOutputPoints = p + 1
-    else:
-      while t < r[1]:
-        points.InsertPoint(p, aSplineX.Evaluate(t), aSplineY.Evaluate(t), aSplineZ.Evaluate(t))
-        t = t + tStep
-        p = p + 1
-      nOutputPoints = p
-    
-    lines = vtk.vtkCellArray()
-    lines.InsertNextCell(nOutputPoints)
-    for i in range(0, nOutputPoints):
-      lines.InsertCellPoint(i)
-        
-    outputPoly.SetPoints(points)
-    outputPoly.SetLines(lines)
+    # Keep the spline and the samples for local updates
+    self.Spline = spline
+    self.SplineParameters = t
+    self.SplineSamples = samples
 
   def pathToPoly(self, path, poly):
     points = vtk.vtkPoints()
@@ -835,178 +1558,300 @@ class CurveMakerLogic:
       lines.SetNumberOfCells(1)
 
   def calculateLineLength(self, poly):
-    lines = poly.GetLines()
-    points = poly.GetPoints()
-    pts = vtk.vtkIdList()
-
-    lines.GetCell(0, pts)
-    ip = numpy.array(points.GetPoint(pts.GetId(0)))
-    n = pts.GetNumberOfIds()
-
-    # Check if there is overlap between the first and last segments
-    # (for making sure to close the loop for spline curves)
-    if n > 2:
-      slp = numpy.array(points.GetPoint(pts.GetId(n-2)))
-      # Check distance between the first point and the second last point
-      if numpy.linalg.norm(slp-ip) < 0.00001:
-        n = n - 1
-        
-    length = 0.0
-    pp = ip
-    for i in range(1,n):
-      p = numpy.array(points.GetPoint(pts.GetId(i)))
-      length = length + numpy.linalg.norm(pp-p)
-      pp = p
-
-    return length
+    return CurveArcLength(polyPoints(poly)).length
 
 
-  def computeCurvatures(self, poly, curvatureValues):
+  def computeCurvatures(self, poly):
     # Calculate point-by-point curvature of the curve
-    # Returns mean/min/max curvature
-    
-    lines = poly.GetLines()
-    points = poly.GetPoints()
-    pts = vtk.vtkIdList()
-
-    lines.GetCell(0, pts)
-    ip = numpy.array(points.GetPoint(pts.GetId(0)))
-    n = pts.GetNumberOfIds()
-
-    ## Check if there is overlap between the first and last segments
-    ## (for making sure to close the loop for spline curves)
-    #if n > 2:
-    #  slp = numpy.array(points.GetPoint(pts.GetId(n-2)))
-    #  # Check distance between the first point and the second last point
-    #  if numpy.linalg.norm(slp-ip) < 0.00001:
-    #    n = n - 1
-
-    curvatureValues.Initialize()
-    curvatureValues.SetName("Curvature")
-    curvatureValues.SetNumberOfComponents(1)
-    curvatureValues.SetNumberOfTuples(n)
-    curvatureValues.Reset()
-    curvatureValues.FillComponent(0,0.0)  
-
-    minKappa = 0.0
-    maxKappa = 0.0
-    meanKappa = 0.0   # NOTE: mean is weighted by the lengh of each segment
-    
-    pp = numpy.array(points.GetPoint(pts.GetId(0)))
-    p  = numpy.array(points.GetPoint(pts.GetId(1)))
-    ds = numpy.linalg.norm(p-pp)
-    pT = (p-pp) / ds
-    pp = p
-    pm = (p+pp)/2.0
-    length = 0.0 + numpy.linalg.norm(pm-pp)
-    
-    curvatureValues.InsertValue(pts.GetId(0), 0.0) # The curvature for the first cell is 0.0
-
-    for i in range(1,n-1):
-      p = numpy.array(points.GetPoint(pts.GetId(i+1)))
-      ds = numpy.linalg.norm(p-pp)
-      T  = (p-pp) / ds
-      kappa = numpy.linalg.norm(T-pT) / ds # Curvature
-      curvatureValues.InsertValue(pts.GetId(i), kappa) # The curvature for the first cell is 0.0
-
-      m = (p+pp)/2.0 
-      l = numpy.linalg.norm(m-pm) # length for this segment
-      if kappa < minKappa:
-        minKappa = kappa
-      elif kappa > maxKappa:
-        maxKappa = kappa
-      meanKappa = meanKappa + kappa * l  # weighted mean
-      length = length + l
-
-      pp = p
-      pm = m
-      pT = T
-
-    curvatureValues.InsertValue(pts.GetId(n-1), 0.0) # The curvature for the last cell is 0.0
-    
-    length = length + numpy.linalg.norm(pp-pm)
-          
-    meanKappa = meanKappa / length
-    
-    # TODO: This routin does not consider a closed loop. If a closed loop is specified,
-    # It needs to calculate the curveture of two ends differently.
+    # Returns the "Curvature" point array and mean/min/max curvature.
+    # The array shares the memory of a numpy array (no copy is made).
+    # See CurveCurvature for details.
 
-    return (meanKappa, minKappa, maxKappa)
+    curvature = CurveCurvature(polyPoints(poly))
+
+    return (curvature.vtkArray, curvature.mean, curvature.min, curvature.max)
 
   
   def updateCurve(self):
 
+    # Regenerates the curve from scratch
+    self.Profiler.beginUpdate()
+    self.invalidate(self.StageControlPoints)
+    self.updateDirtyStages()
+    self.Profiler.endUpdate('full')
+
+
+  def updateDirtyStages(self):
+
+    # Recomputes the stages of the curve generation that have been
+    # invalidated since the last update.
+
     if self.AutomaticUpdate == False:
       return
 
     if self.SourceNode and self.DestinationNode:
 
-      if self.SourceNode.GetNumberOfControlPoints() < 2:
-        if self.CurvePoly != None:
-          self.CurvePoly.Initialize()
+      if self.SourceNode != self.builtSourceNode:
+        self.invalidate(self.StageControlPoints)
+      if self.DestinationNode != self.builtDestinationNode:
+        self.invalidate(self.StageTube)
+      self.builtSourceNode = self.SourceNode
+      self.builtDestinationNode = self.DestinationNode
+
+      dirty = self.DirtyStages
+      self.DirtyStages = 0
+      self.pendingFullUpdate = False
+
+      if dirty & self.StageControlPoints:
+        start = self.Profiler.start()
+        self.ControlPoints = self.getControlPoints(self.SourceNode)
+        self.Profiler.stop('controlPoints', start, self.ControlPoints.shape[0])
 
+      if self.CurvePoly == None:
+        self.CurvePoly = vtk.vtkPolyData()
+
+      if self.ControlPoints.shape[0] < 2:
+        self.CurvePoly.Initialize()
+
+        self.Spline = None
+        self.CurvatureData = None
+        self.DeviationData = None
         self.CurveLength = 0.0
+        self.ArcLength = None
+        self.SegmentIndex = None
 
       else:
 
-        if self.CurvePoly == None:
-          self.CurvePoly = vtk.vtkPolyData()
-        
-        if self.DestinationNode.GetDisplayNodeID() == None:
-          modelDisplayNode = slicer.vtkMRMLModelDisplayNode()
-          modelDisplayNode.SetColor(self.ModelColor)
-          slicer.mrmlScene.AddNode(modelDisplayNode)
-          self.DestinationNode.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
-        
-        if self.InterpolationMethod == 0:
-        
-          if self.RingMode > 0:
-            self.nodeToPoly(self.SourceNode, self.CurvePoly, True)
+        # Curves are served from the cache, except the previews of the tube
+        # during interactions and the tubes with the deviation from another
+        # curve. The length and curvature are recomputed from the cached
+        # samples, since they are cheap.
+        cacheKey = None
+        cached = None
+        if self.ResultCache.isEnabled() and not self.isInteracting() and self.DeviationReference is None:
+          cacheKey = self.getResultCacheKey()
+          cached = self.ResultCache.get(cacheKey)
+        if cached:
+          (samples, cachedTube) = cached
+          if dirty & self.StageSampling:
+            buffer = updatePolyLine(self.CurvePoly, samples)
+            self.Spline = None
+            if self.InterpolationMethod == 1 and self.SamplingMode == 0:
+              # Fit the spline again (much cheaper than the tube), so that
+              # the cached curve can still be updated locally
+              self.Spline = CardinalSpline(self.ControlPoints, self.RingMode > 0)
+              self.SplineParameters = splineSamplingParameters(self.Spline, self.interpResolution)
+              self.SplineSamples = buffer
+            self.SegmentIndex = None
+            dirty = (dirty & ~self.StageSampling) | self.StageLength | self.StageCurvature
+          dirty = dirty | self.StageTube
+
+        if dirty & self.StageSampling:
+          start = self.Profiler.start()
+          self.Spline = None
+
+          if self.InterpolationMethod == 0:
+
+            if self.RingMode > 0:
+              self.pointsToPoly(self.ControlPoints, self.CurvePoly, True)
+            else:
+              self.pointsToPoly(self.ControlPoints, self.CurvePoly, False)
+
+          elif self.InterpolationMethod == 1: # Cardinal Spline
+
+            if self.RingMode > 0:
+              self.pointsToPolyCardinalSpline(self.ControlPoints, self.CurvePoly, True)
+            else:
+              self.pointsToPolyCardinalSpline(self.ControlPoints, self.CurvePoly, False)
+
+          self.SegmentIndex = None
+          self.Profiler.stop('sampling', start, self.CurvePoly.GetNumberOfPoints())
+
+        if dirty & self.StageLength:
+          start = self.Profiler.start()
+          self.ArcLength = CurveArcLength(polyPoints(self.CurvePoly))
+          self.CurveLength = self.ArcLength.length
+          self.Profiler.stop('length', start, self.CurvePoly.GetNumberOfPoints())
+
+        if dirty & self.StageCurvature:
+          start = self.Profiler.start()
+          if self.Curvature:
+            ## If the curvature option is ON, calculate the curvature along the curve.
+            ## (the arrays are reused if the number of points is unchanged)
+            if self.CurvatureData == None:
+              self.CurvatureData = CurveCurvature(polyPoints(self.CurvePoly))
+            else:
+              self.CurvatureData.compute(polyPoints(self.CurvePoly))
+            if self.CurvePoly.GetPointData().GetArray('Curvature') is not self.CurvatureData.vtkArray:
+              self.CurvePoly.GetPointData().AddArray(self.CurvatureData.vtkArray)
           else:
-            self.nodeToPoly(self.SourceNode, self.CurvePoly, False)
-        
-        elif self.InterpolationMethod == 1: # Cardinal Spline
-        
-          if self.RingMode > 0:
-            self.nodeToPolyCardinalSpline(self.SourceNode, self.CurvePoly, True)
-          else:
-            self.nodeToPolyCardinalSpline(self.SourceNode, self.CurvePoly, False)
-          
-        self.CurveLength = self.calculateLineLength(self.CurvePoly)
+            self.CurvatureData = None
+            self.CurvePoly.GetPointData().RemoveArray('Curvature')
+          self.Profiler.stop('curvature', start, self.CurvePoly.GetNumberOfPoints())
+          if self.DeviationReference is not None:
+            self.updateDeviation()
+
+      if dirty & self.StageTube:
+        if cached:
+          self.updateTubeModel(cachedTube)
+        else:
+          self.updateTubeModel()
+
+      if cacheKey and not cached and not self.tubeIsPreview:
+        tube = vtk.vtkPolyData()
+        tube.DeepCopy(self.TubeFilter.GetOutput())
+        self.ResultCache.put(cacheKey, numpy.array(polyPoints(self.CurvePoly)), tube)
+
+
+  def updateCurveLocally(self):
+
+    # updateCurveLocally() updates the curve after some of the control points
+    # have been moved, without rebuilding it. Only the spline intervals
+    # influenced by the moved points are re-sampled, and the points, arc
+    # lengths and curvatures of CurvePoly are patched in place.
+    # Returns False if the curve needs to be rebuilt with updateCurve()
+    # (e.g. the number of control points has changed, or the curve is not
+    # a cardinal spline).
+
+    if self.AutomaticUpdate == False:
+      return True
+
+    if not (self.SourceNode and self.DestinationNode) or self.Spline == None:
+      return False
+
+    # Only the control points may have changed since the last update
+    if (self.pendingFullUpdate or self.SourceNode != self.builtSourceNode
+        or self.DestinationNode != self.builtDestinationNode):
+      return False
+
+    # Samples placed by arc length move along the whole curve
+    if self.SamplingMode != 0:
+      return False
+
+    timer = self.Profiler.start()
+    controlPoints = self.getControlPoints(self.SourceNode)
+    self.Profiler.stop('controlPoints', timer, controlPoints.shape[0])
+    if controlPoints.shape[0] != self.Spline.nPoints:
+      return False
+
+    self.ControlPoints = controlPoints
+    self.DirtyStages = 0
+
+    moved = numpy.nonzero((controlPoints != self.Spline.points[:self.Spline.nPoints]).any(axis=1))[0]
+    if moved.shape[0] == 0:
+      return True
+
+    timer = self.Profiler.start()
+    intervals = self.Spline.moveControlPoints(controlPoints, moved[0], moved[-1])
+    if intervals == None:
+      self.invalidate(self.StageSampling)
+      return False
+
+    # Samples in intervals (k0, k1]; the two samples added to close a ring
+    # are never affected (see CardinalSpline.moveControlPoints()).
+    (k0, k1) = intervals
+    t = self.SplineParameters
+    if self.Spline.closed:
+      t = t[:-2]
+    if k0 == 0:
+      start = 0
+    else:
+      start = numpy.searchsorted(t, k0, side='right')
+    stop = numpy.searchsorted(t, k1, side='right')
+
+    self.Spline.evaluate(t[start:stop], self.SplineSamples[start:stop])
+    points = self.CurvePoly.GetPoints()
+    points.GetData().Modified()
+    points.Modified()
+    self.Profiler.stop('sampling', timer, stop - start)
+
+    timer = self.Profiler.start()
+    self.ArcLength.update(start, stop)
+    self.CurveLength = self.ArcLength.length
+    self.SegmentIndex = None
+    self.Profiler.stop('length', timer, stop - start)
+
+    if self.CurvatureData:
+      timer = self.Profiler.start()
+      self.CurvatureData.update(start, stop)
+      self.Profiler.stop('curvature', timer, stop - start)
+
+    if self.DeviationReference is not None:
+      self.updateDeviation()
 
-      tubeFilter = vtk.vtkTubeFilter()
-      curvatureValues = vtk.vtkDoubleArray()
+    self.updateTubeModel()
 
+    return True
+
+
+  def updateTubeModel(self, cachedTube=None):
+
+    # Updates DestinationNode with the tube around CurvePoly, or with
+    # 'cachedTube' if it has been found in the result cache.
+
+    if self.DestinationNode.GetDisplayNodeID() == None:
+      modelDisplayNode = slicer.vtkMRMLModelDisplayNode()
+      modelDisplayNode.SetColor(self.ModelColor)
+      slicer.mrmlScene.AddNode(modelDisplayNode)
+      self.DestinationNode.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
+
+    if self.CurvatureData:
+      self.curvatureMeanKappa = self.CurvatureData.mean
+      self.curvatureMinKappa = self.CurvatureData.min
+      self.curvatureMaxKappa = self.CurvatureData.max
+    else:
+      self.curvatureMeanKappa = None
+      self.curvatureMinKappa = None
+      self.curvatureMaxKappa = None
+
+    start = self.Profiler.start()
+
+    # Preview of the tube during interactions (see startInteraction())
+    if self.isInteracting():
+      if self.PreviewPoly == None:
+        self.PreviewPoly = vtk.vtkPolyData()
+      decimateCurve(self.CurvePoly, self.PreviewDecimation, self.PreviewPoly)
+      tubeInput = self.PreviewPoly
+      numberOfSides = self.PreviewNumberOfSides
+    else:
+      tubeInput = self.CurvePoly
+      numberOfSides = self.TubeNumberOfSides
+    self.tubeIsPreview = self.isInteracting()
+
+    # Keep one tube filter per destination model. The filter updates its
+    # output in place, so the model keeps the same polydata and its display
+    # pipeline is not reconnected.
+    if self.TubeFilter == None or self.tubeDestinationNode != self.DestinationNode:
+      self.TubeFilter = newTubeFilter(numberOfSides)
+      self.tubeDestinationNode = self.DestinationNode
+    if self.TubeFilter.GetInput() is not tubeInput:
+      self.TubeFilter.SetInputData(tubeInput)
+    self.TubeFilter.SetNumberOfSides(numberOfSides)
+    self.TubeFilter.SetRadius(self.TubeRadius)
+    if cachedTube is not None:
+      self.TubeFilter.GetOutput().DeepCopy(cachedTube)
+    else:
+      self.TubeFilter.Update()
+    self.Profiler.stop('tube', start, tubeInput.GetNumberOfPoints())
+
+    # The observers of the model (e.g. the widget) are timed separately
+    start = self.Profiler.start()
+    if self.DestinationNode.GetPolyData() is not self.TubeFilter.GetOutput():
+      self.DestinationNode.SetAndObservePolyData(self.TubeFilter.GetOutput())
+    self.DestinationNode.Modified()
+    self.Profiler.stop('modelModified', start)
+
+    if self.DestinationNode.GetScene() == None:
+      slicer.mrmlScene.AddNode(self.DestinationNode)
+
+    displayNode = self.DestinationNode.GetDisplayNode()
+    if displayNode:
       if self.Curvature:
-        ## If the curvature option is ON, calculate the curvature along the curve.
-        (meanKappa, minKappa, maxKappa) = self.computeCurvatures(self.CurvePoly, curvatureValues)
-        self.CurvePoly.GetPointData().AddArray(curvatureValues)
-        self.curvatureMeanKappa = meanKappa
-        self.curvatureMinKappa = minKappa
-        self.curvatureMaxKappa = maxKappa
+        displayNode.SetActiveScalarName('Curvature')
+      elif self.DeviationData:
+        displayNode.SetActiveScalarName('Deviation')
       else:
-        self.curvatureMeanKappa = None
-        self.curvatureMinKappa = None
-        self.curvatureMaxKappa = None
-       
-      tubeFilter.SetInputData(self.CurvePoly)
-      tubeFilter.SetRadius(self.TubeRadius)
-      tubeFilter.SetNumberOfSides(20)
-      tubeFilter.CappingOn()
-      tubeFilter.Update()
-
-      self.DestinationNode.SetAndObservePolyData(tubeFilter.GetOutput())
-      self.DestinationNode.Modified()
-      
-      if self.DestinationNode.GetScene() == None:
-        slicer.mrmlScene.AddNode(self.DestinationNode)
-
-      displayNode = self.DestinationNode.GetDisplayNode()
-      if displayNode:
-        if self.Curvature:
-          displayNode.SetActiveScalarName('Curvature')
-        else:
-          displayNode.SetActiveScalarName('')
+        displayNode.SetActiveScalarName('')
         
         
   def getCurvatureSummary(self):
@@ -1021,6 +1866,21 @@ class CurveMakerLogic:
       return None
     
 
+  def positionsAtArcLength(self, s):
+
+    # positionsAtArcLength() returns the positions and unit tangent vectors
+    # of the points at arc length(s) 's' (mm) from the first point of the
+    # curve. 's' can be a single value or an array of values; the positions
+    # and tangents are returned as arrays of the corresponding shape (3 or
+    # Nx3). Values are clamped to [0, CurveLength]. Returns None if the curve
+    # has not been generated.
+
+    if self.ArcLength == None:
+      return None
+
+    return self.ArcLength.positions(s)
+
+
   def distanceToPoint(self, point, extrapolate):
 
     # distanceToPoint() calculates the approximate minimum distance between
@@ -1028,67 +1888,323 @@ class CurveMakerLogic:
     # It calculates the minimum distance between the point and each segment
     # of the curve (approxmated as a straight line) and select the segment with
     # the minimum distance from the point as a closest segment.
+    # See distancesToPoints() to query many points at once.
+
+    (distances, errVecs, indices) = self.distancesToPoints([point], extrapolate)
+
+    return (distances[0], errVecs[0])
+
+
+  def distancesToPoints(self, points, extrapolate):
+
+    # distancesToPoints() is a batched version of distanceToPoint(). 'points'
+    # is an Nx3 array of query points. Returns (distances, errVecs, indices),
+    # where errVecs[k] is the vector from the closest point on the curve to
+    # points[k], and indices[k] is the index of the closest segment (segment i
+    # connects the i-th and (i+1)-th points of the curve). If the curve has not
+    # been generated, distances are Inf and indices are -1.
+    # The closest segments are searched using the spatial index of the curve
+    # (see getSegmentIndex()) unless UseSegmentIndex is False, in which case all
+    # points are tested against all segments. Both give the same results.
+
+    return queryDistances(self.getSegmentIndex(), points, extrapolate, self.UseSegmentIndex)
+
+
+  def computeDistanceMap(self, target, outputNode=None, extrapolate=False, workers=None, maxDistance=None,
+                         fillCancelled=False):
+
+    # computeDistanceMap() computes the distances between the curve and all
+    # the points of 'target', e.g. for the margins around a needle path:
+    #  - a model node: the distances to its vertices are stored in its
+    #    "CurveDistance" point array;
+    #  - a volume node (e.g. a label map): the distances to the centers of its
+    #    voxels are stored in 'outputNode' (a scalar volume node, created if
+    #    None) with the geometry of 'target'; with 'maxDistance' (mm), only
+    #    the voxels within maxDistance of the curve are computed, and the
+    #    others are set to maxDistance;
+    #  - an Nx3 array of points.
+    # The points are processed in chunks across 'workers' threads (see
+    # CurveMakerLib.CurveDistanceField). This takes about 5-10 us per point
+    # and CPU, i.e. seconds to minutes for a whole image: a progress dialog
+    # is shown for more than 'DistanceMapProgressPoints' points, and the
+    # events of the application are processed between the chunks. Returns
+    # the distances (an array shaped as the points or the voxels, K x J x I),
+    # or None if the curve has not been generated or if the computation was
+    # cancelled. If cancelled, the "CurveDistance" array of a model is left
+    # unchanged, or with 'fillCancelled', set to the distances computed so
+    # far and to NaN for the other vertices.
+
+    index = self.getSegmentIndex()
+    if index == None:
+      return None
+    start = self.Profiler.start()
+
+    if isinstance(target, slicer.vtkMRMLModelNode):
+      poly = target.GetPolyData()
+      n = poly.GetNumberOfPoints()
+      points = numpy.asarray(numpy_support.vtk_to_numpy(poly.GetPoints().GetData()))
+      # Computed apart, and stored in the model once complete
+      distances = numpy.empty(n)
+      distances.fill(numpy.nan)
+      with DistanceMapProgress(n, self.DistanceMapProgressPoints) as progress:
+        cancelled = CurveMakerLib.pointDistances(index, points, extrapolate, workers=workers, out=distances, progress=progress) is None
+      if not cancelled or fillCancelled:
+        array = poly.GetPointData().GetArray('CurveDistance')
+        if array is None or array.GetNumberOfTuples() != n or array.GetNumberOfComponents() != 1:
+          array = vtk.vtkDoubleArray()
+          array.SetName('CurveDistance')
+          array.SetNumberOfTuples(n)
+          poly.GetPointData().AddArray(array)
+        numpy_support.vtk_to_numpy(array)[:] = distances
+        array.Modified()
+        poly.Modified()
+
+    elif isinstance(target, slicer.vtkMRMLVolumeNode):
+      if outputNode == None:
+        outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', target.GetName() + '_CurveDistance')
+      dimensions = target.GetImageData().GetDimensions()
+      matrix = vtk.vtkMatrix4x4()
+      target.GetIJKToRASMatrix(matrix)
+      ijkToRAS = [[matrix.GetElement(r, c) for c in range(4)] for r in range(4)]
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(dimensions)
+      imageData.AllocateScalars(vtk.VTK_FLOAT, 1)
+      distances = numpy.asarray(numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()))
+      n = distances.size
+      with DistanceMapProgress(n, self.DistanceMapProgressPoints) as progress:
+        cancelled = CurveMakerLib.imageDistances(index, dimensions, ijkToRAS, extrapolate, workers=workers, out=distances,
+                                                 maxDistance=maxDistance, progress=progress) is None
+      if not cancelled:
+        distances = distances.reshape(dimensions[2], dimensions[1], dimensions[0])
+        outputNode.SetAndObserveImageData(imageData)
+        outputNode.CopyOrientation(target)
 
-    npoint = numpy.array(point)
+    else:
+      points = numpy.asarray(target, dtype=float).reshape(-1, 3)
+      n = points.shape[0]
+      with DistanceMapProgress(n, self.DistanceMapProgressPoints) as progress:
+        distances = CurveMakerLib.pointDistances(index, points, extrapolate, workers=workers, progress=progress)
+      cancelled = distances is None
+
+    self.Profiler.stop('distanceMap', start, n)
+    if cancelled:
+      return None
+    return distances
 
-    if self.CurvePoly == None:
-      return numpy.Inf
 
-    lines = self.CurvePoly.GetLines()
-    points = self.CurvePoly.GetPoints()
-    pts = vtk.vtkIdList()
+  def getReferenceCurve(self, reference):
 
-    lines.GetCell(0, pts)
-    ip = numpy.array(points.GetPoint(pts.GetId(0)))
-    n = pts.GetNumberOfIds()
+    # Returns the points and the segment index (None if not built) of the
+    # curve 'reference': a CurveMakerLogic (e.g. a curve of getCurve()) or
+    # an Nx3 array of points.
 
-    # First point on the segment
-    p1 = ip
+    if isinstance(reference, CurveMakerLogic):
+      if reference.CurvePoly == None or reference.CurvePoly.GetNumberOfPoints() < 2:
+        return (numpy.zeros((0, 3)), None)
+      return (polyPoints(reference.CurvePoly), reference.getSegmentIndex())
+    return (numpy.asarray(reference, dtype=float).reshape(-1, 3), None)
 
-    minMag2 = numpy.Inf
-    minIndex = -1
-    minErrVec = numpy.array([0.0, 0.0, 0.0])
 
-    errVec = numpy.array([0.0, 0.0, 0.0])
-    for i in range(1,n):
-      # Second point on the segment
-      p2 = numpy.array(points.GetPoint(pts.GetId(i)))
+  def computeDeviation(self, reference):
 
-      # Normal vector along the segment
-      nvec = p2-p1
-      norm = numpy.linalg.norm(nvec)
-      if norm != 0:
-        nnvec = nvec / norm
+    # computeDeviation() compares the current curve with the curve
+    # 'reference' (see getReferenceCurve()), e.g. the actual path with the
+    # planned trajectory. Returns a CurveDeviation: the symmetric Hausdorff
+    # distance, the mean and RMS deviation, and the distance from each
+    # sample of the curve to the reference ('values'). The closest segments
+    # are searched with the segment indexes of the curves, which are kept
+    # until the curves are updated. Returns None if the curve has not been
+    # generated.
 
-      # Calculate the distance between the point and the segment
-      mag2 = 0.0
+    if self.CurvePoly == None or self.CurvePoly.GetNumberOfPoints() < 2:
+      return None
+    (referencePoints, referenceIndex) = self.getReferenceCurve(reference)
+    return CurveDeviation(polyPoints(self.CurvePoly), referencePoints, self.getSegmentIndex(), referenceIndex)
 
-      op = npoint - p1
-      aproj = numpy.inner(op, nnvec)
 
-      if extrapolate and ((i == 1 and aproj < 0.0) or (i == n-1 and aproj > 0.0)):
-        # extrapolate first or last segment
-        errVec = op-aproj*nnvec  # perpendicular
-        mag2 = numpy.inner(errVec,errVec) # magnitude^2
-      else:
-        if aproj < 0.0:
-          errVec = npoint - p1
-          mag2 = numpy.inner(errVec, errVec) # magnitude^2
-        elif aproj > norm:
-          errVec = npoint - p2
-          mag2 = numpy.inner(errVec, errVec) # magnitude^2
-        else:
-          errVec = op-aproj*nnvec # perpendicular
-          mag2 = numpy.inner(errVec,errVec) # magnitude^2
-        
-      if mag2 < minMag2:
-        minMag2 = mag2
-        minIndex = i
-        minErrVec = errVec
-    
-      p1 = p2
+  def setDeviationReference(self, reference):
+
+    # setDeviationReference() attaches the deviation from 'reference' (see
+    # computeDeviation()) to the curve as the "Deviation" point array, which
+    # is passed to the tube model like "Curvature". The deviation is
+    # recomputed whenever the curve is updated; call this again after the
+    # reference has changed. None removes the array.
+
+    self.DeviationReference = reference
+    if reference is None:
+      self.DeviationData = None
+      if self.CurvePoly:
+        self.CurvePoly.GetPointData().RemoveArray('Deviation')
+    self.requestUpdate(self.StageCurvature)
+
+
+  def updateDeviation(self):
+
+    # Recomputes the "Deviation" point array of CurvePoly from
+    # DeviationReference (the arrays are reused if the number of points is
+    # unchanged)
+
+    start = self.Profiler.start()
+    points = polyPoints(self.CurvePoly)
+    (referencePoints, referenceIndex) = self.getReferenceCurve(self.DeviationReference)
+    if self.DeviationData == None:
+      self.DeviationData = CurveDeviation(points, referencePoints, self.getSegmentIndex(), referenceIndex)
+    else:
+      self.DeviationData.compute(points, referencePoints, self.getSegmentIndex(), referenceIndex)
+    if self.CurvePoly.GetPointData().GetArray('Deviation') is not self.DeviationData.vtkArray:
+      self.CurvePoly.GetPointData().AddArray(self.DeviationData.vtkArray)
+    self.Profiler.stop('deviation', start, points.shape[0])
+
+
+  def getSegmentIndex(self):
+
+    # Returns the spatial index over the segments of the current curve.
+    # The index is built once after each update of the curve.
+
+    if self.CurvePoly == None or self.CurvePoly.GetNumberOfPoints() < 2:
+      return None
 
-    distance = numpy.sqrt(minMag2)
+    if self.SegmentIndex == None:
+      # CurvePoly consists of a single polyline that visits its points in order
+      cpoints = polyPoints(self.CurvePoly)
+      self.SegmentIndex = CurveSegmentIndex(cpoints)
 
-    return (distance, minErrVec)
+    return self.SegmentIndex
 
+
+#
+# CurveMakerSimulatedTracker
+#
+
+class CurveMakerSimulatedTracker:
+
+  # Moves a control point of a markups node at 'rate' Hz, as a tracked
+  # instrument would, to test the streaming mode of CurveMakerLogic. The
+  # point (the last one by default) follows a circle of 'radius' mm around
+  # its initial position in the XY plane, once every 'period' seconds.
+
+  def __init__(self, node, rate=60.0, radius=10.0, period=2.0, pointIndex=-1):
+    self.node = node
+    self.rate = rate
+    self.radius = radius
+    self.period = period
+    if pointIndex < 0:
+      pointIndex = node.GetNumberOfControlPoints() + pointIndex
+    self.pointIndex = pointIndex
+    self.origin = [0.0, 0.0, 0.0]
+    node.GetNthControlPointPosition(pointIndex, self.origin)
+    self.SampleCount = 0
+    self.startTime = None
+    self.timer = qt.QTimer()
+    self.timer.connect('timeout()', self.onTimer)
+
+  def start(self):
+    self.startTime = time.perf_counter()
+    self.timer.start(int(1000.0 / self.rate))
+
+  def stop(self):
+    self.timer.stop()
+
+  def onTimer(self):
+    self.moveTo(time.perf_counter() - self.startTime)
+
+  def moveTo(self, t):
+    # Moves the point to its position at 't' seconds
+    angle = 2.0 * math.pi * t / self.period
+    self.node.SetNthControlPointPosition(self.pointIndex,
+                                         self.origin[0] + self.radius * (math.cos(angle) - 1.0),
+                                         self.origin[1] + self.radius * math.sin(angle),
+                                         self.origin[2])
+    self.SampleCount = self.SampleCount + 1
+
+
+#
+# ControlPointCache
+#
+
+class ControlPointCache:
+
+  # Positions of the control points of a markups node as an Nx3 array. The
+  # positions are read at once, and read again only after the node has
+  # reported a modification.
+
+  # Events invalidating the cache. The observers have a higher priority than
+  # the observers updating the curve, so that they see the new positions.
+  Events = [vtk.vtkCommand.ModifiedEvent,
+            slicer.vtkMRMLMarkupsNode.PointAddedEvent,
+            slicer.vtkMRMLMarkupsNode.PointRemovedEvent,
+            slicer.vtkMRMLMarkupsNode.PointModifiedEvent]
+  Priority = 10.0
+
+  def __init__(self, node):
+    self.node = node
+    self.points = None
+    self.tags = []
+    for event in self.Events:
+      self.tags.append(node.AddObserver(event, self.onNodeModified, self.Priority))
+
+  def removeObservers(self):
+    for tag in self.tags:
+      self.node.RemoveObserver(tag)
+    self.tags = []
+
+  def onNodeModified(self, caller, event):
+    self.points = None
+
+  def getPoints(self):
+    if self.points is None:
+      self.points = self.read(self.node)
+      self.points.flags.writeable = False
+    return self.points
+
+  @staticmethod
+  def read(node):
+    # Without a parent transform, the world coordinates of the control points
+    # are the same as their local coordinates and can be read in one call.
+    if node.GetParentTransformNode() == None and hasattr(node, 'GetControlPointPositionsWorld'):
+      positions = vtk.vtkPoints()
+      positions.SetDataTypeToDouble()
+      node.GetControlPointPositionsWorld(positions)
+      return numpy.array(numpy_support.vtk_to_numpy(positions.GetData()), dtype=float).reshape(-1, 3)
+
+    nOfControlPoints = node.GetNumberOfControlPoints()
+    points = numpy.zeros((nOfControlPoints, 3))
+    pos = [0.0, 0.0, 0.0]
+    for i in range(nOfControlPoints):
+      node.GetNthControlPointPosition(i, pos)
+      points[i] = pos
+    return points
+
+
+#
+# DistanceMapProgress
+#
+
+class DistanceMapProgress:
+
+  # Progress dialog of CurveMakerLogic.computeDistanceMap(), as a context
+  # manager giving the 'progress' callback of CurveMakerLib.mapChunks() (None
+  # without a dialog, for 'minimumPoints' points or fewer). The events of
+  # the application are processed after each chunk, so that the user
+  # interface stays responsive and the computation can be cancelled.
+
+  def __init__(self, nPoints, minimumPoints):
+    self.nPoints = nPoints
+    self.minimumPoints = minimumPoints
+    self.dialog = None
+
+  def __enter__(self):
+    if self.nPoints <= self.minimumPoints:
+      return None
+    self.dialog = slicer.util.createProgressDialog(labelText='Computing the distances to the curve...', maximum=100)
+    return self.update
+
+  def __exit__(self, *args):
+    if self.dialog != None:
+      self.dialog.close()
+      self.dialog = None
+
+  def update(self, done, total):
+    self.dialog.setValue(int(100 * done / max(total, 1)))
+    slicer.app.processEvents()
+    return not self.dialog.wasCanceled
@@ -0,0 +1,247 @@
+import os
+import json
+import struct
+import numpy
+
+#
+# Binary archive of curves, for the analysis of the results outside of
+# CurveMaker. An archive holds any number of curves, appended one by one
+# (see CurveArchiveWriter), and is read back by memory-mapping the file, so
+# that the arrays of the curves are numpy views of the file (see
+# CurveArchive).
+#
+# Layout (little endian, every block starts at a multiple of 8 bytes):
+#
+#   file header     'CURVEARC', version (uint32), reserved (uint32)
+#   for each curve:
+#     curve header  'CREC', flags (uint32), number of samples N (uint64),
+#                   number of targets M (uint64), size of the metadata
+#                   (uint64), size of the record, header included (uint64)
+#     samples       N x 3 float64
+#     arc lengths   N float64
+#     curvature     N float64 (if flags & 1)
+#     targets       M x 3 float64
+#     distances     M float64
+#     segments      M int64 (closest segment of each target)
+#     metadata      JSON (parameters of the curve and other values)
+#
+# A record is complete only once it has been fully written; an incomplete
+# record at the end of the file (e.g. a batch still running, or
+# interrupted) is ignored by the reader.
+#
+
+_FILE_MAGIC = b'CURVEARC'
+_FILE_HEADER = struct.Struct('<8sII')
+_RECORD_MAGIC = b'CREC'
+_RECORD_HEADER = struct.Struct('<4sIQQQQ')
+_VERSION = 1
+_HAS_CURVATURE = 1
+
+
+def _padding(size):
+  return (-size) % 8
+
+
+class CurveArchiveWriter:
+
+  # Appends curves to an archive file. Each curve is written and flushed by
+  # write(), so that the memory does not depend on the number of curves and
+  # the curves already written can be read while the archive grows. If
+  # 'append' is True and the file exists, the curves are added after its
+  # complete records: an incomplete record at the end of the file (e.g. left
+  # by an interrupted batch) is overwritten.
+
+  def __init__(self, path, append=False):
+    self.path = path
+    self.count = 0
+    if append and os.path.exists(path) and os.path.getsize(path) > 0:
+      self.file = open(path, 'r+b')
+      try:
+        _readFileHeader(self.file.read(_FILE_HEADER.size), path)
+        size = os.path.getsize(path)
+        offset = _FILE_HEADER.size
+        while offset + _RECORD_HEADER.size <= size:
+          self.file.seek(offset)
+          end = _recordEnd(_RECORD_HEADER.unpack(self.file.read(_RECORD_HEADER.size)), offset, size, path)
+          if end == None:
+            break
+          offset = end
+        self.file.truncate(offset)
+        self.file.seek(offset)
+      except Exception:
+        self.file.close()
+        raise
+    else:
+      self.file = open(path, 'wb')
+      self.file.write(_FILE_HEADER.pack(_FILE_MAGIC, _VERSION, 0))
+      self.file.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+  def close(self):
+    if self.file:
+      self.file.close()
+      self.file = None
+
+  def write(self, samples, arcLengths=None, curvature=None, parameters=None,
+            targets=None, distances=None, segments=None, metadata=None):
+    # Appends a curve: 'samples' (Nx3), cumulative arc length and curvature
+    # at each sample (arc lengths are computed if None), the curve
+    # parameters (dictionary), and the distances of the targets (Mx3) with
+    # their closest segments. 'metadata' is a dictionary of other values
+    # (e.g. the name of the case) stored with the parameters.
+    samples = numpy.ascontiguousarray(samples, dtype='<f8').reshape(-1, 3)
+    n = samples.shape[0]
+    if arcLengths is None:
+      arcLengths = numpy.zeros(n)
+      if n > 1:
+        seg = samples[1:] - samples[:-1]
+        numpy.cumsum(numpy.sqrt((seg * seg).sum(axis=1)), out=arcLengths[1:])
+    blocks = [samples, _column(arcLengths, n, '<f8')]
+    flags = 0
+    if curvature is not None:
+      blocks.append(_column(curvature, n, '<f8'))
+      flags = flags | _HAS_CURVATURE
+
+    if targets is None:
+      targets = numpy.zeros((0, 3))
+    targets = numpy.ascontiguousarray(targets, dtype='<f8').reshape(-1, 3)
+    m = targets.shape[0]
+    if distances is None:
+      distances = numpy.empty(m)
+      distances.fill(numpy.nan)
+    if segments is None:
+      segments = numpy.empty(m, dtype=int)
+      segments.fill(-1)
+    blocks = blocks + [targets, _column(distances, m, '<f8'), _column(segments, m, '<i8')]
+
+    values = {}
+    if metadata:
+      values.update(metadata)
+    values['parameters'] = parameters
+    text = json.dumps(values, sort_keys=True).encode('utf-8')
+
+    size = _RECORD_HEADER.size + sum(b.nbytes for b in blocks) + len(text) + _padding(len(text))
+    self.file.write(_RECORD_HEADER.pack(_RECORD_MAGIC, flags, n, m, len(text), size))
+    for block in blocks:
+      self.file.write(block.data)
+    self.file.write(text + b'\0' * _padding(len(text)))
+    self.file.flush()
+    self.count = self.count + 1
+
+  def writeResult(self, result, targets=None, extrapolate=False, metadata=None):
+    # Appends a CurveResult (see CurveEngine), with the distances of
+    # 'targets' (Mx3) to the curve if specified
+    curvature = None
+    if result.CurvatureData:
+      curvature = result.CurvatureData.values
+    distances = None
+    segments = None
+    if targets is not None:
+      (distances, errVecs, segments) = result.distancesToPoints(targets, extrapolate)
+    self.write(result.getSamples(), result.getSampleArcLengths(), curvature, result.Parameters,
+               targets, distances, segments, metadata)
+
+
+def _column(values, n, dtype):
+  values = numpy.ascontiguousarray(values, dtype=dtype).reshape(-1)
+  if values.shape[0] != n:
+    raise ValueError("Expected %d values, got %d" % (n, values.shape[0]))
+  return values
+
+
+def _readFileHeader(data, path):
+  if len(data) < _FILE_HEADER.size:
+    raise IOError("Not a curve archive: %s" % path)
+  (magic, version, reserved) = _FILE_HEADER.unpack_from(data)
+  if magic != _FILE_MAGIC:
+    raise IOError("Not a curve archive: %s" % path)
+  if version > _VERSION:
+    raise IOError("Unsupported curve archive version %d: %s" % (version, path))
+  return version
+
+
+def _recordEnd(header, offset, size, path):
+  # End of the record at 'offset' given its (unpacked) header, or None if the
+  # record is incomplete in a file of 'size' bytes
+  if header[0] != _RECORD_MAGIC or header[5] < _RECORD_HEADER.size:
+    raise IOError("Corrupted curve archive at byte %d: %s" % (offset, path))
+  if offset + header[5] > size:
+    return None
+  return offset + header[5]
+
+
+#
+# Reading
+#
+
+class CurveArchiveRecord:
+
+  # One curve of a CurveArchive. The arrays are read-only views of the
+  # memory-mapped file (no copy); they remain valid while the archive is
+  # referenced.
+
+  def __init__(self, data, offset):
+    (magic, flags, n, m, metadataSize, size) = _RECORD_HEADER.unpack_from(data, offset)
+    offset = offset + _RECORD_HEADER.size
+    (self.samples, offset) = _view(data, offset, '<f8', (n, 3))
+    (self.arcLengths, offset) = _view(data, offset, '<f8', (n,))
+    self.curvature = None
+    if flags & _HAS_CURVATURE:
+      (self.curvature, offset) = _view(data, offset, '<f8', (n,))
+    (self.targets, offset) = _view(data, offset, '<f8', (m, 3))
+    (self.distances, offset) = _view(data, offset, '<f8', (m,))
+    (self.segments, offset) = _view(data, offset, '<i8', (m,))
+    self.metadata = json.loads(bytes(data[offset:offset + metadataSize]).decode('utf-8'))
+    self.parameters = self.metadata.get('parameters')
+
+
+def _view(data, offset, dtype, shape):
+  # Array of 'shape' at 'offset' in 'data' (bytes), and the offset after it
+  size = int(numpy.prod(shape)) * 8
+  return (data[offset:offset + size].view(dtype).reshape(shape), offset + size)
+
+
+class CurveArchive:
+
+  # Reads an archive written by CurveArchiveWriter. The file is mapped in
+  # memory and the records are located once; archive[i] returns the i-th
+  # curve as a CurveArchiveRecord. refresh() finds the curves appended since
+  # the archive was opened.
+
+  def __init__(self, path):
+    self.path = path
+    self.data = None
+    self.offsets = []
+    self.refresh()
+
+  def refresh(self):
+    with open(self.path, 'rb') as f:
+      _readFileHeader(f.read(_FILE_HEADER.size), self.path)
+    size = os.path.getsize(self.path)
+    self.data = numpy.memmap(self.path, dtype=numpy.uint8, mode='r', shape=(size,))
+
+    offset = _FILE_HEADER.size
+    if len(self.offsets) > 0:
+      offset = self.offsets[-1] + _RECORD_HEADER.unpack_from(self.data, self.offsets[-1])[5]
+    while offset + _RECORD_HEADER.size <= size:
+      end = _recordEnd(_RECORD_HEADER.unpack_from(self.data, offset), offset, size, self.path)
+      if end == None:
+        break
+      self.offsets.append(offset)
+      offset = end
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def __getitem__(self, i):
+    return CurveArchiveRecord(self.data, self.offsets[i])
+
+  def __iter__(self):
+    for offset in self.offsets:
+      yield CurveArchiveRecord(self.data, offset)
+
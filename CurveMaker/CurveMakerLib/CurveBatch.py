@@ -0,0 +1,264 @@
+import os
+import sys
+import argparse
+import traceback
+import multiprocessing
+import concurrent.futures
+import numpy
+import vtk
+
+from .CurveEngine import CurveEngine
+from .CurveIO import readControlPoints, writeCurveSamples, writePolyData, writeMetrics
+
+#
+# Batch generation of many curves across a pool of worker processes
+#
+
+def mapCases(function, tasks, workers=None, failed=None):
+  # Applies 'function' to each task in a pool of 'workers' processes (the
+  # number of CPUs by default) and returns the results in the order of the
+  # tasks. 'function' must be a module-level function, and must not raise
+  # (see generateCase()). If a worker process dies (e.g. crashes or runs out
+  # of memory), the tasks it was processing, and those still pending in the
+  # broken pool, get the result of failed(task, message) instead of
+  # aborting the batch (the exception is raised if 'failed' is None). With
+  # one worker the tasks run in this process.
+  tasks = list(tasks)
+  if workers == None:
+    workers = os.cpu_count() or 1
+  workers = min(workers, len(tasks))
+  if workers <= 1:
+    return [function(task) for task in tasks]
+
+  # Forked workers do not start a new interpreter, which is the fastest
+  # outside Slicer. Slicer runs Qt and VTK threads that must not be forked:
+  # there, the workers are started with the Python launcher of Slicer
+  # (sys.executable), and only import CurveMakerLib.
+  context = None
+  if 'slicer' in sys.modules:
+    context = multiprocessing.get_context('spawn')
+  elif 'fork' in multiprocessing.get_all_start_methods():
+    context = multiprocessing.get_context('fork')
+  # A few chunks per worker balance the load with little messaging
+  chunkSize = max(1, len(tasks) // (4 * workers))
+  chunks = [tasks[start:start+chunkSize] for start in range(0, len(tasks), chunkSize)]
+  results = []
+  with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as executor:
+    futures = [executor.submit(_mapChunk, function, chunk) for chunk in chunks]
+    for (future, chunk) in zip(futures, chunks):
+      try:
+        results.extend(future.result())
+      except concurrent.futures.process.BrokenProcessPool as e:
+        if failed == None:
+          raise
+        message = "The worker process terminated abruptly: %s\n" % e
+        results.extend([failed(task, message) for task in chunk])
+  return results
+
+
+def _mapChunk(function, chunk):
+  return [function(task) for task in chunk]
+
+
+class CaseResult:
+
+  # Result of one case of generateCurves(). If the case has failed, 'error'
+  # holds the traceback and the other attributes are None. The tube is
+  # transferred from the worker as a serialized polydata (see getTube()).
+
+  def __init__(self, index):
+    self.index = index
+    self.error = None
+    self.metrics = None
+    self.samples = None      ## Sampled centerline (Nx3)
+    self.arcLengths = None   ## Arc length at each sample
+    self.curvature = None    ## Curvature at each sample (if computed)
+    self.distances = None    ## Distances to the targets (if specified)
+    self.tubeData = None
+
+  def succeeded(self):
+    return self.error == None
+
+  def getTube(self):
+    if self.tubeData == None:
+      return None
+    reader = vtk.vtkPolyDataReader()
+    reader.ReadFromInputStringOn()
+    reader.SetBinaryInputString(self.tubeData, len(self.tubeData))
+    reader.Update()
+    return reader.GetOutput()
+
+
+def generateCase(task):
+  # Worker function of generateCurves(). 'task' is (index, control points
+  # or file name, engine parameters, tube, targets, extrapolate).
+  (index, source, parameters, tube, targets, extrapolate) = task
+  result = CaseResult(index)
+  try:
+    if isinstance(source, str):
+      source = readControlPoints(source)
+    engine = CurveEngine()
+    engine.setParameters(parameters)
+    curve = engine.generate(source, tube)
+
+    result.metrics = curve.getMetrics()
+    result.samples = numpy.array(curve.getSamples())
+    result.arcLengths = numpy.array(curve.getSampleArcLengths())
+    if curve.CurvatureData:
+      result.curvature = numpy.array(curve.CurvatureData.values)
+    if targets is not None:
+      (result.distances, errVecs, indices) = curve.distancesToPoints(targets, extrapolate)
+      result.metrics['targets'] = [{'distance' : float(d), 'segment' : int(i)} for (d, i) in zip(result.distances, indices)]
+    if tube:
+      writer = vtk.vtkPolyDataWriter()
+      writer.WriteToOutputStringOn()
+      writer.SetFileTypeToBinary()
+      writer.SetInputData(curve.getTube())
+      writer.Write()
+      result.tubeData = writer.GetOutputStdString()
+  except Exception:
+    result = failedCase(task, traceback.format_exc())
+  return result
+
+
+def failedCase(task, message):
+  result = CaseResult(task[0])
+  result.error = message
+  return result
+
+
+def generateCurves(sources, parameters=None, tube=False, workers=None, targets=None, extrapolate=False):
+  # Generates the curves of many cases in a pool of worker processes (see
+  # mapCases()). 'sources' are Nx3 arrays of control points or control point
+  # files, and 'parameters' are the parameters of CurveEngine (defaults if
+  # None). Returns a list of CaseResult in the order of 'sources'; a failing
+  # case does not affect the others.
+  if parameters == None:
+    parameters = CurveEngine().getParameters()
+  if targets is not None:
+    targets = numpy.asarray(targets, dtype=float).reshape(-1, 3)
+  tasks = []
+  for (index, source) in enumerate(sources):
+    if not isinstance(source, str):
+      source = numpy.asarray(source, dtype=float)
+    tasks.append((index, source, parameters, tube, targets, extrapolate))
+  return mapCases(generateCase, tasks, workers, failedCase)
+
+
+#
+# Command-line batch generation of curves:
+#
+#   python -m CurveMakerLib [options] FILE [FILE ...]
+#
+# For each control point file, writes <name>_samples.<ext> (sampled
+# centerline), <name>_tube.<ext> (tube surface, with --tube) and
+# <name>_metrics.json (length, curvature and target distances) to the
+# output directory.
+#
+
+def caseName(path):
+  name = os.path.basename(path)
+  for extension in ('.mrk.json', '.json', '.fcsv', '.csv', '.txt'):
+    if name.lower().endswith(extension):
+      return name[:-len(extension)]
+  return os.path.splitext(name)[0]
+
+
+def processFile(path, engine, options, targets=None):
+  # Generates the curve for one control point file and writes the outputs.
+  # Returns the metrics.
+  result = engine.generate(readControlPoints(path), options.tube)
+  name = caseName(path)
+
+  metrics = result.getMetrics()
+  metrics['input'] = path
+
+  if targets is not None:
+    (distances, errVecs, indices) = result.distancesToPoints(targets, options.extrapolate)
+    metrics['targets'] = [{'distance' : float(d), 'segment' : int(i)} for (d, i) in zip(distances, indices)]
+
+  if options.samples_format:
+    writeCurveSamples(os.path.join(options.output, '%s_samples.%s' % (name, options.samples_format)), result)
+  if options.tube:
+    writePolyData(os.path.join(options.output, '%s_tube.%s' % (name, options.tube_format)), result.getTube())
+  writeMetrics(os.path.join(options.output, '%s_metrics.json' % name), metrics)
+
+  return metrics
+
+
+def processFileCase(task):
+  # Worker function of main(). Returns None, or the error message.
+  (path, options, targets) = task
+  try:
+    processFile(path, createEngine(options), options, targets)
+    return None
+  except Exception:
+    return failedFileCase(task, traceback.format_exc())
+
+
+def failedFileCase(task, message):
+  return "Failed to process %s:\n%s" % (task[0], message)
+
+
+def createEngine(options):
+  engine = CurveEngine()
+  if options.method == 'spline':
+    engine.InterpolationMethod = 1
+  else:
+    engine.InterpolationMethod = 0
+  engine.RingMode = int(options.ring)
+  engine.interpResolution = options.resolution
+  engine.SamplingMode = ['resolution', 'arclength', 'adaptive'].index(options.sampling)
+  engine.SamplingSpacing = options.spacing
+  engine.SamplingTolerance = options.tolerance
+  engine.Curvature = int(options.curvature)
+  engine.TubeRadius = options.radius
+  engine.TubeNumberOfSides = options.sides
+  return engine
+
+
+def createArgumentParser():
+  parser = argparse.ArgumentParser(prog='python -m CurveMakerLib',
+                                   description='Generate curves from control point files (.fcsv, .mrk.json, or text files with x y z per line) without Slicer.')
+  parser.add_argument('inputs', nargs='+', metavar='FILE', help='control point files')
+  parser.add_argument('-o', '--output', default='.', help='output directory (default: current directory)')
+  parser.add_argument('--method', choices=['none', 'spline'], default='spline', help='interpolation method (default: spline)')
+  parser.add_argument('--ring', action='store_true', help='close the curve')
+  parser.add_argument('--resolution', type=int, default=25, help='interpolation points between two control points (default: 25)')
+  parser.add_argument('--sampling', choices=['resolution', 'arclength', 'adaptive'], default='resolution',
+                      help='sampling of the spline: --resolution points per interval, every --spacing mm, or adaptive to the curvature within --tolerance mm (default: resolution)')
+  parser.add_argument('--spacing', type=float, default=2.0, help='distance between the samples, or their maximum distance with adaptive sampling (default: 2.0)')
+  parser.add_argument('--tolerance', type=float, default=0.1, help='maximum deviation from the spline with adaptive sampling (default: 0.1)')
+  parser.add_argument('--curvature', action='store_true', help='compute the curvature')
+  parser.add_argument('--radius', type=float, default=5.0, help='tube radius (default: 5.0)')
+  parser.add_argument('--sides', type=int, default=20, help='number of sides of the tube (default: 20)')
+  parser.add_argument('--tube', action='store_true', help='write the tube surface')
+  parser.add_argument('--tube-format', choices=['vtp', 'vtk', 'stl', 'ply'], default='vtp', help='tube file format (default: vtp)')
+  parser.add_argument('--samples-format', choices=['csv', 'vtp', 'vtk', ''], default='csv', help="centerline file format, or '' not to write it (default: csv)")
+  parser.add_argument('--targets', help='control point file of targets to measure the distances to the curve')
+  parser.add_argument('--extrapolate', action='store_true', help='extend the ends of the curve when measuring the distances')
+  parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+  return parser
+
+
+def main(argv=None):
+  options = createArgumentParser().parse_args(argv)
+
+  targets = None
+  if options.targets:
+    targets = readControlPoints(options.targets)
+
+  if not os.path.isdir(options.output):
+    os.makedirs(options.output)
+
+  failures = 0
+  tasks = [(path, options, targets) for path in options.inputs]
+  for error in mapCases(processFileCase, tasks, options.workers, failedFileCase):
+    if error:
+      failures = failures + 1
+      sys.stderr.write(error)
+
+  if failures > 0:
+    sys.stderr.write("%d of %d files failed\n" % (failures, len(options.inputs)))
+    return 1
+  return 0
@@ -0,0 +1,81 @@
+import hashlib
+import collections
+import numpy
+
+#
+# CurveResultCache
+#
+
+class CurveResultCache:
+
+  # Least-recently-used cache of generated curves. Entries are keyed by a
+  # content hash of the control points and the curve parameters (see
+  # makeKey()), and hold copies of the sampled centerline and of the tube,
+  # so that they are not affected by later updates. The memory used by the
+  # entries is kept under MaxMemory (bytes) by evicting the least recently
+  # used ones. A MaxMemory of 0 disables the cache.
+
+  def __init__(self, maxMemory=128*1024*1024):
+    self.MaxMemory = maxMemory
+    self.entries = collections.OrderedDict()
+    self.Memory = 0
+    self.Hits = 0
+    self.Misses = 0
+    self.Evictions = 0
+
+  def isEnabled(self):
+    return self.MaxMemory > 0
+
+  def setMaxMemory(self, maxMemory):
+    self.MaxMemory = maxMemory
+    self._evict()
+
+  @staticmethod
+  def makeKey(controlPoints, parameters):
+    # 'parameters' is a tuple of the parameters affecting the result
+    points = numpy.ascontiguousarray(controlPoints, dtype=float)
+    digest = hashlib.sha1(points.tobytes()).hexdigest()
+    return (digest, points.shape) + tuple(parameters)
+
+  def get(self, key):
+    # Returns the entry (samples, tube) for 'key', or None
+    entry = self.entries.get(key)
+    if entry == None:
+      self.Misses = self.Misses + 1
+      return None
+    self.entries.move_to_end(key)
+    self.Hits = self.Hits + 1
+    return entry[:2]
+
+  def put(self, key, samples, tube):
+    # Stores the sampled centerline (Nx3 array) and the tube (vtkPolyData).
+    # Both must not be modified afterwards (pass copies).
+    if key in self.entries:
+      self.entries.move_to_end(key)
+      return
+    size = samples.nbytes + tube.GetActualMemorySize() * 1024
+    if size > self.MaxMemory:
+      return
+    self.entries[key] = (samples, tube, size)
+    self.Memory = self.Memory + size
+    self._evict()
+
+  def clear(self):
+    self.entries.clear()
+    self.Memory = 0
+
+  def _evict(self):
+    while self.Memory > self.MaxMemory and len(self.entries) > 0:
+      (key, entry) = self.entries.popitem(last=False)
+      self.Memory = self.Memory - entry[2]
+      self.Evictions = self.Evictions + 1
+
+  def getStatistics(self):
+    stats = {}
+    stats['hits'] = self.Hits
+    stats['misses'] = self.Misses
+    stats['evictions'] = self.Evictions
+    stats['entries'] = len(self.entries)
+    stats['memory'] = self.Memory
+    stats['maxMemory'] = self.MaxMemory
+    return stats
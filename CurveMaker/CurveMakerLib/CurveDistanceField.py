@@ -0,0 +1,158 @@
+import os
+import concurrent.futures
+import numpy
+
+from .CurveGeometry import _dot
+from .CurveEngine import queryDistances
+
+#
+# Distance fields: distances from a curve to large sets of points, e.g. the
+# vertices of an anatomy model or the voxels of a label map, for the analysis
+# of the margins around a needle path.
+#
+# The points are processed in chunks of 'chunkSize' points, so that the
+# temporary arrays of the queries do not grow with the number of points; only
+# the output (one value per point) is allocated in full. The chunks are
+# shared by a pool of 'workers' threads (the number of CPUs by default): the
+# segment index (CurveSegmentIndex) is not modified by the queries, and numpy
+# releases the GIL in the array operations of each chunk. The chunks of an
+# image are boxes of whole rows of voxels, so that the points of a chunk are
+# close to each other, which keeps the tree traversal of the index short.
+#
+# A query takes about 5-10 us per point and CPU (depending on the curve and
+# on the distance to it): a few seconds for a 256^3 image. Most voxels of an
+# image are usually far from the curve; with 'maxDistance', the distances
+# are only computed in a band around the curve, and clamped to maxDistance
+# outside it: the bricks of voxels whose center is farther than maxDistance
+# plus their radius are skipped after a single query, and the others are
+# refined into smaller bricks. 'progress' is called after each chunk (e.g.
+# to update a progress bar and process the events of the user interface).
+#
+
+def mapChunks(function, n, chunkSize=65536, workers=None, progress=None):
+  # Calls function(start, end) for the consecutive ranges of at most
+  # 'chunkSize' items of [0, n), in a pool of 'workers' threads (the number
+  # of CPUs by default). With one worker, or a single chunk, the ranges are
+  # processed in this thread. progress(done, n) is called in this thread
+  # after each range, in order, with the number of items done; if it returns
+  # False, the remaining ranges are cancelled. Returns False if cancelled,
+  # True otherwise.
+  starts = range(0, n, max(int(chunkSize), 1))
+  if workers == None:
+    workers = os.cpu_count() or 1
+  workers = min(workers, len(starts))
+  if workers <= 1:
+    for start in starts:
+      end = min(start + chunkSize, n)
+      function(start, end)
+      if progress != None and progress(end, n) == False:
+        return False
+    return True
+  with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+    futures = [executor.submit(function, start, min(start + chunkSize, n)) for start in starts]
+    for (start, future) in zip(starts, futures):
+      future.result()
+      if progress != None and progress(min(start + chunkSize, n), n) == False:
+        for pending in futures:
+          pending.cancel()
+        return False
+  return True
+
+
+def pointDistances(index, points, extrapolate=False, chunkSize=65536, workers=None, out=None, progress=None):
+  # Distances between the points (Nx3) and the curve of the segment index
+  # 'index' (see CurveSegmentIndex and queryDistances(); Inf if 'index' is
+  # None). The distances are written to 'out' (N values, e.g. the numpy view
+  # of a vtkDataArray) if specified, and returned (None if cancelled by
+  # 'progress', see mapChunks()). The points are converted to double
+  # precision chunk by chunk.
+  points = numpy.asarray(points).reshape(-1, 3)
+  n = points.shape[0]
+  if out is None:
+    out = numpy.empty(n)
+  elif out.shape[0] != n:
+    raise ValueError("Expected an output of %d values, got %d" % (n, out.shape[0]))
+
+  def computeChunk(start, end):
+    out[start:end] = queryDistances(index, points[start:end], extrapolate)[0]
+
+  if not mapChunks(computeChunk, n, chunkSize, workers, progress):
+    return None
+  return out
+
+
+def imageDistances(index, dimensions, ijkToRAS, extrapolate=False, chunkSize=65536,
+                   workers=None, dtype=numpy.float32, out=None, maxDistance=None, brickSize=8,
+                   progress=None):
+  # Distances between the centers of the voxels of an image and the curve of
+  # the segment index 'index' (see pointDistances()). 'dimensions' is the
+  # size of the image (I, J, K) and 'ijkToRAS' the 4x4 matrix from the voxel
+  # coordinates to the coordinates of the curve. Returns a (K, J, I) array of
+  # 'dtype' (the layout of the voxels of a vtkImageData), or fills 'out'.
+  # If 'maxDistance' is specified, the distances are clamped to it, and the
+  # bricks of voxels farther from the curve are not queried voxel by voxel
+  # (the results are the same): bricks of 'brickSize'^3 voxels (a power of
+  # 2), refined by halves.
+  (ni, nj, nk) = [int(d) for d in dimensions]
+  n = ni * nj * nk
+  matrix = numpy.asarray(ijkToRAS, dtype=float).reshape(4, 4)
+  if out is None:
+    out = numpy.empty((nk, nj, ni), dtype=dtype)
+  elif out.size != n:
+    raise ValueError("Expected an output of %d voxels, got %d" % (n, out.size))
+  if n == 0:
+    return out
+  values = out.reshape(nk, nj, ni)
+  origin = matrix[:3,3]
+  axes = matrix[:3,:3].T         ## Steps of i, j and k
+
+  # Chunks of whole rows, in slabs of bricks with a band
+  depth = 1 if maxDistance == None else min(brickSize, nk)
+  rows = min(max(chunkSize // (ni * depth), 1), nj)
+  if rows == nj:
+    depth = min(max(depth, chunkSize // (ni * nj)), nk)
+  boxes = [(k, min(k + depth, nk), j, min(j + rows, nj)) for k in range(0, nk, depth) for j in range(0, nj, rows)]
+
+  def voxelPoints(i, j, k):
+    # Points of the voxels (i, j, k) (aranges), shaped (K, J, I, 3)
+    return (origin + k[:,numpy.newaxis,numpy.newaxis,numpy.newaxis] * axes[2]
+            + j[:,numpy.newaxis,numpy.newaxis] * axes[1] + i[:,numpy.newaxis] * axes[0])
+
+  def computeBox(k0, k1, j0, j1):
+    view = values[k0:k1,j0:j1]
+    points = voxelPoints(numpy.arange(ni), numpy.arange(j0, j1), numpy.arange(k0, k1)).reshape(-1, 3)
+    if maxDistance == None:
+      view[...] = queryDistances(index, points, extrapolate)[0].reshape(view.shape)
+      return
+
+    # Bricks of voxels that may be within maxDistance, from the distance to
+    # their center: bricks of brickSize voxels, then the halves of the
+    # remaining ones, down to pairs of voxels
+    shape = numpy.array(view.shape)                      ## (K, J, I)
+    axisSteps = numpy.sqrt(_dot(axes, axes))[::-1]
+    near = numpy.ones((1, 1, 1), dtype=bool)
+    parentSize = shape
+    size = brickSize
+    while size > 1:
+      brick = numpy.minimum(size, shape)
+      starts = [numpy.arange(0, shape[axis], brick[axis]) for axis in range(3)]
+      near = near[numpy.ix_(*[start // parentSize[axis] for (axis, start) in enumerate(starts)])]
+      radius = 0.5 * _dot(brick - 1, axisSteps)
+      centers = voxelPoints(starts[2] + 0.5 * (brick[2] - 1), j0 + starts[1] + 0.5 * (brick[1] - 1),
+                            k0 + starts[0] + 0.5 * (brick[0] - 1))
+      near[near] = queryDistances(index, centers[near], extrapolate)[0] <= maxDistance + radius * (1.0 + 1.0e-9)
+      parentSize = brick
+      size = size // 2
+    near = near[numpy.ix_(*[numpy.arange(shape[axis]) // parentSize[axis] for axis in range(3)])]
+
+    view[...] = maxDistance
+    if near.any():
+      view[near] = numpy.minimum(queryDistances(index, points[near.ravel()], extrapolate)[0], maxDistance)
+
+  def computeChunk(start, end):
+    for box in boxes[start:end]:
+      computeBox(*box)
+
+  if not mapChunks(computeChunk, len(boxes), 1, workers, progress):
+    return None
+  return out
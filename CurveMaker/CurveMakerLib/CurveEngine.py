@@ -0,0 +1,299 @@
+import math
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from .CurveGeometry import CurveArcLength, CurveCurvature, CardinalSpline, CurveSegmentIndex, CurveDeviation, updatePolyLine, polyPoints
+from .CurveTube import CurveTubeFilter
+
+#
+# Sampling of the centerline. These functions are shared by CurveMakerLogic
+# and CurveEngine, so that both generate exactly the same curves.
+#
+
+def polylinePoints(controlPoints, closed=False):
+  # Points of the polyline connecting the control points. If 'closed' is
+  # True, the line starts and ends at the midpoint between the first and
+  # last points.
+  if closed:
+    posStartEnd = (controlPoints[0] + controlPoints[-1]) / 2.0
+    return numpy.vstack((posStartEnd, controlPoints, posStartEnd))
+  else:
+    return numpy.array(controlPoints, dtype=float)
+
+
+def splineParameters(nOfControlPoints, interpResolution, closed=False):
+  # Parameter values of the samples of a cardinal spline with the control
+  # points at t = 0, 1, 2, ... The values are accumulated step by step (as
+  # numpy.cumsum does) so that the number of samples is the same as the
+  # original sampling loop.
+  nInterpolatedPoints = (interpResolution+2)*(nOfControlPoints-1) # One section is devided into interpResolution segments
+  r = [0.0, float(nOfControlPoints-1)]
+  tStep = (nOfControlPoints-1.0)/(nInterpolatedPoints-1.0)
+  if closed:
+    tEnd = r[1]+1.0
+  else:
+    tEnd = r[1]
+  nSteps = int(math.ceil((tEnd-r[0])/tStep)) + 2
+  t = numpy.empty(nSteps)
+  t[0] = r[0]
+  t[1:] = tStep
+  t = numpy.cumsum(t)
+  t = t[:numpy.searchsorted(t, tEnd)]
+
+  if closed:
+    ## Make sure to close the loop
+    t = numpy.append(t, [r[0], r[0]+tStep])
+
+  return t
+
+
+def splineSamplingParameters(spline, interpResolution, samplingMode=0, spacing=2.0, tolerance=0.1):
+  # Parameter values of the samples of a cardinal spline (see CardinalSpline)
+  # for the sampling mode:
+  #  0: (interpResolution+2) samples per interval (see splineParameters())
+  #  1: evenly spaced by arc length, 'spacing' mm apart
+  #  2: adaptive to the curvature, so that the polyline deviates from the
+  #     spline by 'tolerance' mm at most, with samples at most 'spacing' mm
+  #     apart
+  if samplingMode == 0:
+    return splineParameters(spline.nPoints, interpResolution, spline.closed)
+
+  if samplingMode == 1:
+    t = spline.arcLengthParameters(spacing)
+  else:
+    t = spline.adaptiveParameters(tolerance, spacing)
+
+  if spline.closed:
+    ## Make sure to close the loop (as splineParameters())
+    t = numpy.append(t[:-1], [t[0], t[1]])
+
+  return t
+
+
+def sampleArcLengths(arcLength, samples):
+  # Cumulative arc length at each of the samples (Nx3) of a curve, from its
+  # CurveArcLength 'arcLength' (None if the curve is empty). CurveArcLength
+  # leaves out the sample added to close a ring; its arc length is
+  # extrapolated from the end.
+  if arcLength == None:
+    return numpy.zeros(samples.shape[0])
+  arcLengths = arcLength.arcLengths
+  if arcLengths.shape[0] == samples.shape[0]:
+    return arcLengths
+  d = samples[-1] - samples[-2]
+  return numpy.append(arcLengths, arcLength.length + math.sqrt(numpy.dot(d, d)))
+
+
+def decimateCurve(poly, step, outputPoly):
+  # Sets 'outputPoly' to the polyline through every 'step'-th point of the
+  # polyline 'poly' and its last point, with their point data. Used for the
+  # preview of the tube during interactions.
+  n = poly.GetNumberOfPoints()
+  if n < 2:
+    outputPoly.DeepCopy(poly)
+    return
+  indices = numpy.append(numpy.arange(0, n-1, max(int(step), 1)), n-1)
+  updatePolyLine(outputPoly, polyPoints(poly)[indices])
+
+  pointData = poly.GetPointData()
+  outputPointData = outputPoly.GetPointData()
+  outputPointData.Initialize()
+  for i in range(pointData.GetNumberOfArrays()):
+    array = pointData.GetArray(i)
+    values = numpy_support.vtk_to_numpy(array)[indices]
+    outputArray = numpy_support.numpy_to_vtk(values, deep=1, array_type=array.GetDataType())
+    outputArray.SetName(array.GetName())
+    outputPointData.AddArray(outputArray)
+
+
+def newTubeFilter(numberOfSides=20, capping=True, vtkFilter=False):
+  # Tube filter with parallel-transport frames (CurveTubeFilter), or
+  # vtkTubeFilter if 'vtkFilter' is True
+  if vtkFilter:
+    tubeFilter = vtk.vtkTubeFilter()
+  else:
+    tubeFilter = CurveTubeFilter()
+  tubeFilter.SetNumberOfSides(numberOfSides)
+  tubeFilter.SetCapping(capping)
+  return tubeFilter
+
+
+def queryDistances(index, points, extrapolate, useIndex=True):
+  # Distances between the query points (Nx3) and the curve of the segment
+  # index 'index' (see CurveSegmentIndex). Returns (distances, errVecs,
+  # indices). If 'index' is None (no curve), distances are Inf and indices
+  # are -1.
+  qpoints = numpy.asarray(points, dtype=float).reshape(-1, 3)
+
+  if index == None:
+    nq = qpoints.shape[0]
+    distances = numpy.empty(nq)
+    distances.fill(numpy.inf)
+    indices = numpy.empty(nq, dtype=int)
+    indices.fill(-1)
+    return (distances, numpy.zeros((nq, 3)), indices)
+
+  if useIndex:
+    return index.query(qpoints, extrapolate)
+  else:
+    return index.queryBruteForce(qpoints, extrapolate)
+
+
+#
+# CurveEngine
+#
+
+class CurveEngine:
+
+  # Headless counterpart of CurveMakerLogic. Generates a curve from an Nx3
+  # array of control points with the same parameters and the same results
+  # as the module, without Slicer (no MRML scene or nodes).
+
+  # Interpolation method:
+  #  0: None
+  #  1: Cardinal Spline (VTK default)
+
+  def __init__(self):
+    self.InterpolationMethod = 0
+    self.RingMode = 0
+    self.interpResolution = 25
+    self.SamplingMode = 0
+    self.SamplingSpacing = 2.0
+    self.SamplingTolerance = 0.1
+    self.Curvature = 0
+    self.TubeRadius = 5.0
+    self.TubeNumberOfSides = 20
+
+  def getParameters(self):
+    parameters = {}
+    parameters['InterpolationMethod'] = self.InterpolationMethod
+    parameters['RingMode'] = self.RingMode
+    parameters['interpResolution'] = self.interpResolution
+    parameters['SamplingMode'] = self.SamplingMode
+    parameters['SamplingSpacing'] = self.SamplingSpacing
+    parameters['SamplingTolerance'] = self.SamplingTolerance
+    parameters['Curvature'] = self.Curvature
+    parameters['TubeRadius'] = self.TubeRadius
+    parameters['TubeNumberOfSides'] = self.TubeNumberOfSides
+    return parameters
+
+  def setParameters(self, parameters):
+    for (name, value) in parameters.items():
+      if name not in self.__dict__:
+        raise ValueError("Unknown curve parameter: %s" % name)
+      setattr(self, name, value)
+
+  def generate(self, controlPoints, tube=False):
+    # Generates the curve for 'controlPoints' (Nx3). The tube surface is
+    # generated only if 'tube' is True (see CurveResult.getTube()).
+    result = CurveResult(self, numpy.array(controlPoints, dtype=float).reshape(-1, 3))
+    if tube:
+      result.getTube()
+    return result
+
+
+#
+# CurveResult
+#
+
+class CurveResult:
+
+  # Curve generated by CurveEngine.generate(). The attributes have the same
+  # meaning as those of CurveMakerLogic.
+
+  def __init__(self, engine, controlPoints):
+    self.Parameters = engine.getParameters()
+    self.ControlPoints = controlPoints
+    self.CurvePoly = vtk.vtkPolyData()
+    self.ArcLength = None
+    self.CurveLength = 0.0
+    self.CurvatureData = None
+    self.Spline = None
+    self.SplineParameters = None
+    self.SplineSamples = None
+    self.TubePoly = None
+    self.SegmentIndex = None
+
+    if controlPoints.shape[0] < 2:
+      return
+
+    closed = engine.RingMode > 0
+    if engine.InterpolationMethod == 1:
+      self.Spline = CardinalSpline(controlPoints, closed)
+      self.SplineParameters = splineSamplingParameters(self.Spline, engine.interpResolution, engine.SamplingMode,
+                                                       engine.SamplingSpacing, engine.SamplingTolerance)
+      self.SplineSamples = updatePolyLine(self.CurvePoly, None, self.SplineParameters.shape[0])
+      self.Spline.evaluate(self.SplineParameters, self.SplineSamples)
+    else:
+      updatePolyLine(self.CurvePoly, polylinePoints(controlPoints, closed))
+
+    self.ArcLength = CurveArcLength(polyPoints(self.CurvePoly))
+    self.CurveLength = self.ArcLength.length
+
+    if engine.Curvature:
+      self.CurvatureData = CurveCurvature(polyPoints(self.CurvePoly))
+      self.CurvePoly.GetPointData().AddArray(self.CurvatureData.vtkArray)
+
+  def getSamples(self):
+    # Sampled centerline (Nx3, shares the memory of CurvePoly)
+    if self.CurvePoly.GetPoints() == None:
+      return numpy.zeros((0, 3))
+    return polyPoints(self.CurvePoly)
+
+  def getSampleArcLengths(self):
+    # Cumulative arc length at each sample (see sampleArcLengths())
+    return sampleArcLengths(self.ArcLength, self.getSamples())
+
+  def getCurvatureSummary(self):
+    if self.CurvatureData:
+      summary = {}
+      summary['mean'] = float(self.CurvatureData.mean)
+      summary['min'] = float(self.CurvatureData.min)
+      summary['max'] = float(self.CurvatureData.max)
+      return summary
+    else:
+      return None
+
+  def getTube(self):
+    # Tube surface around the centerline (generated once)
+    if self.TubePoly == None:
+      self.TubePoly = vtk.vtkPolyData()
+      if self.CurvePoly.GetNumberOfPoints() >= 2:
+        tubeFilter = newTubeFilter(self.Parameters['TubeNumberOfSides'])
+        tubeFilter.SetInputData(self.CurvePoly)
+        tubeFilter.SetRadius(self.Parameters['TubeRadius'])
+        tubeFilter.Update()
+        # The output is copied so that it does not depend on the filter
+        self.TubePoly.ShallowCopy(tubeFilter.GetOutput())
+    return self.TubePoly
+
+  def getSegmentIndex(self):
+    if self.CurvePoly.GetNumberOfPoints() < 2:
+      return None
+    if self.SegmentIndex == None:
+      self.SegmentIndex = CurveSegmentIndex(polyPoints(self.CurvePoly))
+    return self.SegmentIndex
+
+  def distancesToPoints(self, points, extrapolate):
+    # See CurveMakerLogic.distancesToPoints()
+    return queryDistances(self.getSegmentIndex(), points, extrapolate)
+
+  def computeDeviation(self, reference):
+    # See CurveMakerLogic.computeDeviation(). 'reference' is a CurveResult or
+    # an Nx3 array of points.
+    if self.CurvePoly.GetNumberOfPoints() < 2:
+      return None
+    if isinstance(reference, CurveResult):
+      return CurveDeviation(self.getSamples(), reference.getSamples(), self.getSegmentIndex(), reference.getSegmentIndex())
+    return CurveDeviation(self.getSamples(), numpy.asarray(reference, dtype=float).reshape(-1, 3), self.getSegmentIndex())
+
+  def getMetrics(self):
+    # Summary of the curve as a dictionary of plain Python values
+    metrics = {}
+    metrics['parameters'] = dict(self.Parameters)
+    metrics['numberOfControlPoints'] = int(self.ControlPoints.shape[0])
+    metrics['numberOfSamples'] = int(self.CurvePoly.GetNumberOfPoints())
+    metrics['length'] = float(self.CurveLength)
+    metrics['curvature'] = self.getCurvatureSummary()
+    return metrics
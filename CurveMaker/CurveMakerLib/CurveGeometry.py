@@ -0,0 +1,944 @@
+import math
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+#
+# Curve geometry on numpy arrays of points. Nothing in this file depends on
+# Slicer, so it can be used by CurveMakerLogic as well as headless scripts.
+#
+
+#
+# CurveArcLength
+#
+
+class CurveArcLength:
+
+  # Cumulative arc length at the points of a curve, and lookup of the
+  # positions along the curve by arc length (binary search).
+
+  def __init__(self, points):
+    n = points.shape[0]
+
+    # Check if there is overlap between the first and last segments
+    # (for making sure to close the loop for spline curves)
+    if n > 2:
+      d = points[n-2] - points[0]
+      # Check distance between the first point and the second last point
+      if math.sqrt(_dot(d, d)) < 0.00001:
+        n = n - 1
+
+    self.points = points[:n]
+    seg = self.points[1:] - self.points[:-1]
+    self.segmentLengths = numpy.sqrt(_dot(seg, seg))
+    self.arcLengths = numpy.zeros(n)
+    numpy.cumsum(self.segmentLengths, out=self.arcLengths[1:])
+    self.length = self.arcLengths[-1]
+
+  def update(self, start, stop):
+    # Updates the table after the points start..stop-1 have been moved in
+    # place (self.points must be a view of the moved points)
+    first = max(start-1, 0)
+    last = min(stop, self.segmentLengths.shape[0])
+    if first >= last:
+      return
+    seg = self.points[first+1:last+1] - self.points[first:last]
+    lengths = numpy.sqrt(_dot(seg, seg))
+    delta = lengths.sum() - self.segmentLengths[first:last].sum()
+    self.segmentLengths[first:last] = lengths
+    self.arcLengths[first+1:last+1] = self.arcLengths[first] + numpy.cumsum(lengths)
+    self.arcLengths[last+1:] += delta
+    self.length = self.arcLengths[-1]
+
+  def positions(self, s):
+    # Returns (positions, unit tangent vectors) at arc length(s) 's'
+    s = numpy.clip(numpy.asarray(s, dtype=float), 0.0, self.length)
+    flat = s.reshape(-1)
+
+    # Segment containing each arc length (zero-length segments are skipped)
+    i = numpy.searchsorted(self.arcLengths, flat, side='right') - 1
+    i = numpy.clip(i, 0, self.points.shape[0]-2)
+    segLength = self.segmentLengths[i]
+    nonzero = segLength > 0.0
+    frac = numpy.zeros(flat.shape)
+    frac[nonzero] = (flat[nonzero] - self.arcLengths[i][nonzero]) / segLength[nonzero]
+
+    seg = self.points[i+1] - self.points[i]
+    positions = self.points[i] + frac[:,numpy.newaxis] * seg
+    tangents = numpy.zeros(seg.shape)
+    tangents[nonzero] = seg[nonzero] / segLength[nonzero][:,numpy.newaxis]
+
+    return (positions.reshape(s.shape + (3,)), tangents.reshape(s.shape + (3,)))
+
+
+#
+# CurveCurvature
+#
+
+class CurveCurvature:
+
+  # Point-by-point curvature of a curve, and its mean/min/max. The curvature
+  # for the first and last points is 0.0.
+  # NOTE: mean is weighted by the length of each segment. The length for
+  # each interior point is measured between the midpoints of the adjacent
+  # segments, except for the first and last ones, which start from the
+  # second point and end at the last point respectively.
+  # TODO: This routin does not consider a closed loop. If a closed loop is specified,
+  # It needs to calculate the curveture of two ends differently.
+
+  def __init__(self, points):
+    self.vtkArray = None
+    self.compute(points)
+
+  def compute(self, points):
+    # Computes the curvature of 'points'. The arrays (including vtkArray) are
+    # reused if the number of points is unchanged.
+    self.points = points
+    n = points.shape[0]
+    if self.vtkArray is None or self.values.shape[0] != n:
+      self.weights = numpy.zeros(n)
+      # "Curvature" point array; self.values is a view of its memory
+      self.vtkArray = newDoubleArray(n, 1)
+      self.vtkArray.SetName("Curvature")
+      self.values = numpy_support.vtk_to_numpy(self.vtkArray)
+      self.values.fill(0.0)
+    else:
+      self.vtkArray.Modified()
+    self._compute(0, n)
+    self._summarize()
+
+  def update(self, start, stop):
+    # Updates the curvature after the points start..stop-1 have been moved in
+    # place (self.points must be a view of the moved points)
+    self._compute(start-1, stop+1)
+    self._summarize()
+    self.vtkArray.Modified()
+
+  def _compute(self, start, stop):
+    points = self.points
+    n = points.shape[0]
+
+    # Curvature at the interior points
+    i = numpy.arange(max(start, 1), min(stop, n-1))
+    s1 = points[i] - points[i-1]
+    s2 = points[i+1] - points[i]
+    ds1 = numpy.sqrt(_dot(s1, s1))
+    ds2 = numpy.sqrt(_dot(s2, s2))
+    dT = s2 / ds2[:,numpy.newaxis] - s1 / ds1[:,numpy.newaxis]
+    self.values[i] = numpy.sqrt(_dot(dT, dT)) / ds2
+
+    # Length for each point (the length for the last point is the second
+    # half of the last segment)
+    j = numpy.arange(max(start, 1), min(stop, n))
+    dl = self._bound(j) - self._bound(j-1)
+    self.weights[j] = numpy.sqrt(_dot(dl, dl))
+
+  def _bound(self, j):
+    # Boundaries between the lengths of the points (midpoints of the segments)
+    points = self.points
+    n = points.shape[0]
+    b = (points[j] + points[numpy.minimum(j+1, n-1)]) / 2.0
+    b[j == 0] = points[min(1, n-1)]
+    return b
+
+  def _summarize(self):
+    length = self.weights.sum()
+    if length > 0.0:
+      self.mean = (self.values * self.weights).sum() / length
+    else:
+      self.mean = 0.0
+    self.min = self.values.min()
+    self.max = self.values.max()
+
+
+#
+# CardinalSpline
+#
+
+class CardinalSpline:
+
+  # Piecewise-cubic interpolation of 3D control points, placed at t = 0, 1,
+  # 2, ... The coefficients are computed once in the same way as
+  # vtkCardinalSpline (zero derivatives at both ends of an open curve, or a
+  # periodic spline if 'closed' is True), and evaluate() computes many
+  # parameter values at once. The coordinates are interpolated independently,
+  # so the points may have any number of coordinates (e.g. the coordinates of
+  # the control points of several curves side by side, see CurveSequence).
+
+  # Moving a control point changes the derivatives at the other control
+  # points by a factor decaying as (2-sqrt(3))^k ~ 0.27^k with the distance k
+  # (in control points). Beyond 'window' control points the change is below
+  # the double precision and moveControlPoints() ignores it.
+  window = 32
+
+  # Number of steps per interval of the tables used to sample the spline by
+  # arc length (see arcLengthTable())
+  tableResolution = 64
+
+  def __init__(self, points, closed=False):
+    self.closed = closed
+    self.nPoints = len(points)
+    y = numpy.array(points, dtype=float)
+    if closed:
+      # Add a fictitious point to close the loop
+      y = numpy.vstack((y, y[:1]))
+    self.size = y.shape[0]
+    if closed:
+      d = self._derivativesClosed(y)
+    else:
+      d = self._derivatives(y)
+
+    self.points = y
+    self.derivatives = d
+    self.coefficients = numpy.empty((self.size-1, 4, y.shape[1]))
+    self._computeCoefficients(0, self.size-1)
+
+  def _computeCoefficients(self, k0, k1):
+    # Coefficients of the cubic between each pair of control points
+    # (intervals are of unit length) for the intervals k0..k1-1
+    y = self.points
+    d = self.derivatives
+    c = self.coefficients
+    c[k0:k1,0] = y[k0:k1]
+    c[k0:k1,1] = d[k0:k1]
+    c[k0:k1,2] = 3.0 * (y[k0+1:k1+1] - y[k0:k1]) - (d[k0+1:k1+1] + 2.0 * d[k0:k1])
+    c[k0:k1,3] = 2.0 * (y[k0:k1] - y[k0+1:k1+1]) + (d[k0+1:k1+1] + d[k0:k1])
+
+  def moveControlPoints(self, points, first, last):
+    # Updates the spline after the control points first..last (inclusive)
+    # have been moved to 'points' (all control points). Only the derivatives
+    # within 'window' control points from the moved ones are solved again.
+    # Returns the range (k0, k1) of the intervals that have been changed
+    # (k0..k1-1), or None if the spline should be computed from scratch,
+    # i.e. the moved points are close to the start/end of a closed spline,
+    # or most of the spline would be affected anyway.
+    if self.closed:
+      a = first - self.window
+      b = last + self.window
+      if a < 2 or b > self.size - 3:
+        return None
+    else:
+      a = max(first - self.window, 1)
+      b = min(last + self.window, self.size - 2)
+    if 2 * (b - a + 1) > self.size:
+      return None
+
+    y = self.points
+    d = self.derivatives
+    y[first:last+1] = points[first:last+1]
+
+    # Solve the tridiagonal system for the derivatives at a..b, with the
+    # derivatives at a-1 and b+1 fixed
+    r = 3.0 * (y[a+1:b+2] - y[a-1:b])
+    r[0] = r[0] - d[a-1]
+    r[-1] = r[-1] - d[b+1]
+    w = _solveTridiagonal(_pivots(b - a + 1), r)
+    d[a:b+1] = w
+
+    self._computeCoefficients(a-1, b+1)
+
+    return (a-1, b+1)
+
+  def _derivatives(self, y):
+    # Solves the tridiagonal system for the first derivatives at the control
+    # points, with zero derivatives at both ends.
+    w = numpy.zeros(y.shape)
+    w[1:-1] = _solveTridiagonal(_pivots(self.size - 2), 3.0 * (y[2:] - y[:-2]))
+    return w
+
+  def _derivativesClosed(self, y):
+    # Solves the periodic (cyclic tridiagonal) system for the first
+    # derivatives at the control points of a closed curve: the solution is
+    # f * w[N] + g, where f and g solve the open system (with w[N] as the
+    # fixed derivative at both ends) for w[N] = 1 and for w[N] = 0.
+    N = self.size - 1
+    r = numpy.empty((N, y.shape[1]))
+    r[:-1] = 3.0 * (y[2:] - y[:-2])
+    dN = r[-1] = 3.0 * ((y[N] - y[N-1]) + (y[1] - y[0]))
+
+    # Forward elimination (rows 1..N), of the right-hand side and of the
+    # first column (e)
+    c = _pivots(N)
+    w = _linearRecurrence(-c, c[:,numpy.newaxis] * r, 0.0)
+    e = numpy.cumprod(-c)
+
+    # Back substitution (rows N-1..1)
+    f = _linearRecurrence(-c[-2::-1], e[-2::-1], 1.0)[::-1]
+    g = _linearRecurrence(-c[-2::-1], w[-2::-1], 0.0)[::-1]
+
+    w = numpy.empty(y.shape)
+    w[0] = w[N] = (dN - g[0] - g[-1]) / (4.0 + f[0] + f[-1])
+    w[1:N] = f[:,numpy.newaxis] * w[N] + g
+    return w
+
+  def evaluate(self, t, out=None):
+    # Returns a contiguous (len(t) x 3) array of the points at parameters 't'
+    # (or len(t) x D for D coordinates)
+    # (written to 'out' if specified). Parameters are clamped to the range
+    # of the spline.
+    m = self.size - 1
+    t = numpy.clip(numpy.asarray(t, dtype=float), 0.0, float(m))
+    # Each interval (k, k+1] is evaluated with the cubic of the k-th interval
+    index = numpy.clip(numpy.ceil(t).astype(int) - 1, 0, m-1)
+    dt = (t - index)[:,numpy.newaxis]
+    c = self.coefficients[index]
+    if out is None:
+      out = numpy.empty((t.shape[0], self.points.shape[1]))
+    return numpy.add(dt * (dt * (dt * c[:,3] + c[:,2]) + c[:,1]), c[:,0], out=out)
+
+  def evaluateDerivatives(self, t):
+    # Returns the first and second derivatives (len(t) x 3) at parameters 't'
+    m = self.size - 1
+    t = numpy.clip(numpy.asarray(t, dtype=float), 0.0, float(m))
+    index = numpy.clip(numpy.ceil(t).astype(int) - 1, 0, m-1)
+    dt = (t - index)[:,numpy.newaxis]
+    c = self.coefficients[index]
+    d1 = dt * (3.0 * dt * c[:,3] + 2.0 * c[:,2]) + c[:,1]
+    d2 = 6.0 * dt * c[:,3] + 2.0 * c[:,2]
+    return (d1, d2)
+
+  def arcLengthTable(self):
+    # Parameters 't' at 'tableResolution' steps per interval and the arc
+    # lengths 's' at these parameters (lengths of the chords between them)
+    m = self.size - 1
+    t = numpy.linspace(0.0, float(m), m*self.tableResolution+1)
+    p = self.evaluate(t)
+    seg = p[1:] - p[:-1]
+    s = numpy.zeros(t.shape[0])
+    numpy.cumsum(numpy.sqrt(_dot(seg, seg)), out=s[1:])
+    return (t, s)
+
+  def arcLengthParameters(self, spacing):
+    # Parameters of the samples evenly spaced by arc length, about 'spacing'
+    # apart, from the start to the end of the spline
+    (t, s) = self.arcLengthTable()
+    n = max(int(math.ceil(s[-1] / spacing)), 1)
+    return numpy.interp(numpy.linspace(0.0, s[-1], n+1), s, t)
+
+  def adaptiveParameters(self, tolerance, maxSpacing=None):
+    # Parameters of the samples such that the chords between consecutive
+    # samples deviate from the spline by 'tolerance' at most. A chord of
+    # length h on a curve of curvature k deviates by about k*h^2/8, so the
+    # samples are first placed with the density 1/h = sqrt(k/(8*tolerance))
+    # per unit length (at least 1/maxSpacing, and at most one sample per step
+    # of the table, since the curvature diverges where the spline stops, e.g.
+    # at the ends of an open spline). The estimate does not hold where the
+    # curvature varies quickly: the chords deviating by more than 'tolerance'
+    # are then split until none does (see _refineChords()).
+    (t, s) = self.arcLengthTable()
+    (d1, d2) = self.evaluateDerivatives(t)
+    cross = numpy.cross(d1, d2)
+    speed = numpy.sqrt(_dot(d1, d1))
+    kappa = numpy.zeros(t.shape[0])
+    moving = speed > 1.0e-9 * speed.max()
+    kappa[moving] = numpy.sqrt(_dot(cross[moving], cross[moving])) / speed[moving]**3
+    density = numpy.sqrt(kappa / (8.0 * tolerance))
+    if maxSpacing:
+      density = numpy.maximum(density, 1.0 / maxSpacing)
+
+    # Number of samples up to each table entry
+    step = numpy.minimum((density[1:] + density[:-1]) * 0.5 * (s[1:] - s[:-1]), 1.0)
+    count = numpy.zeros(t.shape[0])
+    numpy.cumsum(step, out=count[1:])
+    n = max(int(math.ceil(count[-1])), 1)
+    u = numpy.interp(numpy.linspace(0.0, count[-1], n+1), count, t)
+    return self._refineChords(u, tolerance)
+
+  def _refineChords(self, u, tolerance, probes=8):
+    # Adds parameters to the sorted parameters 'u' until the chords between
+    # their points deviate from the spline by 'tolerance' at most. The
+    # deviation of a chord is measured at 'probes'-1 points evenly spaced in
+    # parameter along it, and at the vertex of the parabola through the
+    # farthest of them and its neighbours (close to the farthest point of the
+    # spline). The chords deviating too much are split there, and only the
+    # new chords are measured again.
+    fractions = numpy.arange(1, probes) / float(probes)
+    check = numpy.ones(u.shape[0] - 1, dtype=bool)
+    while check.any():
+      chord = numpy.nonzero(check)[0]
+      tp = u[chord,numpy.newaxis] + (u[chord+1] - u[chord])[:,numpy.newaxis] * fractions
+      p = self.evaluate(tp.ravel()).reshape(tp.shape + (-1,))
+      c = self.evaluate(u)
+      d = numpy.zeros((chord.shape[0], probes + 1))    ## 0 at both ends of the chord
+      d[:,1:-1] = numpy.sqrt(_segmentDistance2(p, c[chord,numpy.newaxis], c[chord+1,numpy.newaxis]))
+      farthest = numpy.maximum(numpy.argmax(d, axis=1), 1)
+      rows = numpy.arange(chord.shape[0])
+      y0 = d[rows, farthest]
+      y1 = d[rows, farthest - 1]
+      y2 = d[rows, farthest + 1]
+      curvature = numpy.maximum(2.0 * y0 - y1 - y2, 1.0e-300)
+      offset = numpy.clip(0.5 * (y2 - y1) / curvature, -0.5, 0.5)
+      tv = u[chord] + (u[chord+1] - u[chord]) * (farthest + offset) / probes
+      dv = numpy.sqrt(_segmentDistance2(self.evaluate(tv), c[chord], c[chord+1]))
+      over = numpy.maximum(y0, dv) > tolerance
+      split = chord[over]
+      u = numpy.insert(u, split + 1, tv[over])
+      # The two halves of each split chord are measured at the next pass
+      check = numpy.zeros(u.shape[0] - 1, dtype=bool)
+      halves = split + numpy.arange(split.shape[0])
+      check[halves] = True
+      check[halves + 1] = True
+    return u
+
+
+#
+# CurveSegments
+#
+
+class CurveSegments:
+
+  # Straight-line segments between consecutive points of a curve, with the
+  # per-segment quantities used by the point-to-curve distance computation.
+
+  def __init__(self, points):
+    self.p1 = points[:-1]
+    self.p2 = points[1:]
+    self.n = self.p1.shape[0]
+    nvec = self.p2 - self.p1
+    self.norm = numpy.sqrt(_dot(nvec, nvec))
+    self.nnvec = numpy.zeros(nvec.shape)
+    nonzero = self.norm > 0.0
+    self.nnvec[nonzero] = nvec[nonzero] / self.norm[nonzero][:,numpy.newaxis]
+
+  def errorVectors(self, q, idx, extrapolate):
+    # Computes the error vectors between query points 'q' and segments 'idx'
+    # ('q' and 'idx' must be broadcastable to each other). Returns
+    # (magnitude^2, error vector). If 'extrapolate' is True, the first and last
+    # segments are extended to infinite rays beyond the ends of the curve.
+    # (computed coordinate by coordinate on contiguous arrays, in the same
+    # order of operations as _dot())
+    p1 = self.p1[idx]
+    p2 = self.p2[idx]
+    nnvec = self.nnvec[idx]
+    norm = self.norm[idx]
+
+    op = [q[...,k] - p1[...,k] for k in range(3)]
+    aproj = op[0] * nnvec[...,0] + op[1] * nnvec[...,1] + op[2] * nnvec[...,2]
+
+    before = aproj < 0.0
+    after = aproj > norm
+    if extrapolate:
+      segIndex = numpy.arange(self.n)[idx]
+      before = before & (segIndex != 0)
+      after = after & (segIndex != self.n-1)
+
+    errVec = numpy.empty(aproj.shape + (3,))
+    for k in range(3):
+      perp = op[k] - aproj * nnvec[...,k]
+      errVec[...,k] = numpy.where(after, q[...,k] - p2[...,k], numpy.where(before, op[k], perp))
+
+    return (_dot(errVec, errVec), errVec)
+
+
+def updatePolyLine(poly, points, n=None):
+  # Sets the points of 'poly' to 'points' (Nx3 array), connected by a single
+  # polyline. If 'points' is None, only the buffers for 'n' points are set up.
+  # The point buffer and the line of 'poly' are updated in place, and
+  # reallocated only if the number of points has changed.
+  # Returns the numpy array sharing the memory of the points of 'poly'.
+  if points is not None:
+    n = points.shape[0]
+
+  vpoints = poly.GetPoints()
+  if vpoints is None:
+    vpoints = vtk.vtkPoints()
+    poly.SetPoints(vpoints)
+
+  data = vpoints.GetData()
+  if data.GetDataType() == vtk.VTK_DOUBLE and data.GetNumberOfComponents() == 3 and data.GetNumberOfTuples() == n:
+    buffer = numpy_support.vtk_to_numpy(data)
+    if points is not None:
+      buffer[:] = points
+    data.Modified()
+    vpoints.Modified()
+  else:
+    data = newDoubleArray(n, 3)
+    buffer = numpy_support.vtk_to_numpy(data)
+    if points is not None:
+      buffer[:] = points
+    vpoints.SetData(data)
+
+  # A new cell array is set rather than modifying the current one, since
+  # GetLines() of a polydata without lines returns an array shared by all
+  # polydata.
+  lines = poly.GetLines()
+  if lines.GetNumberOfCells() != 1 or lines.GetMaxCellSize() != n:
+    cells = numpy.arange(-1, n, dtype=numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE))
+    cells[0] = n
+    lines = vtk.vtkCellArray()
+    lines.ImportLegacyFormat(numpy_support.numpy_to_vtkIdTypeArray(cells, deep=1))
+    poly.SetLines(lines)
+
+  return buffer
+
+
+def newDoubleArray(n, components):
+  # The memory is owned by the VTK array, and shared with numpy through
+  # vtk_to_numpy(), so that it remains valid as long as the VTK array is
+  # used. (The reference to a numpy array kept by numpy_to_vtk(deep=0) is
+  # lost with the Python wrapper of the VTK array.)
+  array = vtk.vtkDoubleArray()
+  array.SetNumberOfComponents(components)
+  array.SetNumberOfTuples(n)
+  return array
+
+
+def polyPoints(poly):
+  # Points of a vtkPolyData as an Nx3 float64 array (no copy if the points
+  # are already stored in double precision)
+  return numpy.asarray(numpy_support.vtk_to_numpy(poly.GetPoints().GetData()), dtype=float)
+
+
+def _dot(a, b):
+  # Row-wise inner product of two (broadcastable) arrays of 3D vectors
+  return a[...,0]*b[...,0] + a[...,1]*b[...,1] + a[...,2]*b[...,2]
+
+
+def _segmentDistance2(q, a, b):
+  # Squared distances between the points 'q' and the segments from 'a' to
+  # 'b' (row-wise)
+  ab = b - a
+  aq = q - a
+  length2 = _dot(ab, ab)
+  t = numpy.clip(_dot(aq, ab) / numpy.where(length2 > 0.0, length2, 1.0), 0.0, 1.0)
+  d = aq - t[...,numpy.newaxis] * ab
+  return _dot(d, d)
+
+
+def _advance(points, span=16):
+  # Average distance along a curve between consecutive points, from the
+  # chords of runs of 'span' segments: the noise of a jagged curve does not
+  # count, unlike in the length of the segments
+  span = max(min(span, points.shape[0] - 1), 1)
+  d = points[span:] - points[:-span]
+  return numpy.sqrt(_dot(d, d)).mean() / span
+
+
+def _pivots(n):
+  # Reciprocal pivots c[k] = 1 / (4 - c[k-1]) of the elimination of the
+  # tridiagonal system (1, 4, 1) of n rows (c[-1] = 0). They converge to
+  # 2 - sqrt(3) within a few rows, and are constant from there.
+  c = numpy.empty(n)
+  previous = 0.0
+  for k in range(n):
+    value = 1.0 / (4.0 - previous)
+    if value == previous:
+      c[k:] = value
+      break
+    c[k] = previous = value
+  return c
+
+
+def _linearRecurrence(a, b, x0, block=32):
+  # Solves x[k] = a[k] * x[k-1] + b[k] for k = 0, 1, ... (x[-1] = x0), where
+  # 'b' has one row (of any number of columns) per 'a', and |a| < 1. Within a
+  # block of rows, x[k] = P[k] * (x0 + sum(b[j] / P[j], j <= k)), with P the
+  # cumulative product of 'a'; the blocks are short enough for P not to
+  # underflow, so that only one step per block is done in Python.
+  x = numpy.empty(b.shape)
+  shape = (-1,) + (1,) * (b.ndim - 1)
+  n = a.shape[0]
+  for start in range(0, n, block):
+    end = min(start + block, n)
+    p = numpy.cumprod(a[start:end]).reshape(shape)
+    x[start:end] = p * (x0 + numpy.cumsum(b[start:end] / p, axis=0))
+    x0 = x[end-1]
+  return x
+
+
+def _solveTridiagonal(c, r):
+  # Solves the tridiagonal system (1, 4, 1) with the right-hand sides 'r'
+  # (one row per equation), given its pivots 'c' (see _pivots())
+  w = _linearRecurrence(-c, c[:,numpy.newaxis] * r, 0.0)
+  return _linearRecurrence(-c[::-1], w[::-1], 0.0)[::-1]
+
+
+#
+# CurveSegmentIndex
+#
+
+class CurveSegmentIndex:
+
+  # Bounding volume hierarchy over the segments of a curve for nearest-segment
+  # queries. Since consecutive segments of a curve are close to each other,
+  # leaves are made of runs of 'leafSize' consecutive segments, and each upper
+  # level merges pairs of neighbouring nodes. Each node is bounded by a box
+  # and by a capsule around the chord of its run of segments; the capsule is
+  # much tighter than the box on smooth curves, where many short segments are
+  # nearly as close to a distant point. The first and last segments are
+  # kept out of the tree and always tested, because they become infinite rays
+  # when the curve is extrapolated. Queries give exactly the same results as
+  # the brute-force search (queryBruteForce()), including the choice of the
+  # lowest segment index among equally distant segments.
+  # Both take an optional 'exclude' argument, a pair of arrays (lo, hi): the
+  # segments lo[k] to hi[k] are then ignored for the k-th query point (e.g.
+  # to find the closest part of the curve outside a window of segments).
+  # Points for which all the segments are ignored get the distance Inf and
+  # the index -1.
+
+  def __init__(self, points, leafSize=4):
+    self.segments = CurveSegments(points)
+    self.leafSize = leafSize
+    self.chunkSize = 4096        # Number of query points processed at once
+    self.bruteForceChunkSize = 1000000 # Number of (point, segment) pairs processed at once
+
+    # Interior segments (excluding the first and last ones)
+    n = self.segments.n
+    self.nInterior = max(n-2, 0)
+    self.levelLo = []
+    self.levelHi = []
+    self.levelA = []       ## Chords of the capsules (from A to B)
+    self.levelB = []
+    self.levelRadius = []  ## Radii of the capsules
+    if self.nInterior < 2*leafSize:
+      return
+
+    p = self.segments.p1
+    lo = numpy.minimum(p[1:n-1], self.segments.p2[1:n-1])
+    hi = numpy.maximum(p[1:n-1], self.segments.p2[1:n-1])
+    starts = numpy.arange(0, self.nInterior, leafSize)
+    lo = numpy.minimum.reduceat(lo, starts, axis=0)
+    hi = numpy.maximum.reduceat(hi, starts, axis=0)
+    extent = hi.max(axis=0) - lo.min(axis=0)
+    slack = 1.0e-9 * math.sqrt(_dot(extent, extent))
+
+    # The capsule of a leaf goes from its first point to its last point, and
+    # contains all its points
+    a = p[1 + starts]
+    b = p[numpy.minimum(1 + starts + leafSize, n-1)]
+    leaf = (numpy.arange(1, n-1) - 1) // leafSize
+    radius = numpy.sqrt(numpy.maximum.reduceat(_segmentDistance2(p[1:n-1], a[leaf], b[leaf]), starts)) + slack
+    while True:
+      self.levelLo.append(lo)
+      self.levelHi.append(hi)
+      self.levelA.append(a)
+      self.levelB.append(b)
+      self.levelRadius.append(radius)
+      if lo.shape[0] == 1:
+        break
+      starts = numpy.arange(0, lo.shape[0], 2)
+      lo = numpy.minimum.reduceat(lo, starts, axis=0)
+      hi = numpy.maximum.reduceat(hi, starts, axis=0)
+      # The capsule of a node contains the capsules of its children, whose
+      # chords are within the distance of their ends from the new chord
+      parent = numpy.arange(a.shape[0]) // 2
+      parentA = a[starts]
+      parentB = b[numpy.minimum(starts + 1, a.shape[0] - 1)]
+      ends = numpy.maximum(_segmentDistance2(a, parentA[parent], parentB[parent]),
+                           _segmentDistance2(b, parentA[parent], parentB[parent]))
+      radius = numpy.maximum.reduceat(radius + numpy.sqrt(ends), starts) + slack
+      a = parentA
+      b = parentB
+    # Root first
+    self.levelLo.reverse()
+    self.levelHi.reverse()
+    self.levelA.reverse()
+    self.levelB.reverse()
+    self.levelRadius.reverse()
+
+    # Slack for the pruning test to absorb rounding errors
+    self.tolerance = 1.0e-12 * _dot(extent, extent)
+
+  def queryBruteForce(self, qpoints, extrapolate, exclude=None):
+    # Tests all query points against all segments
+    nq = qpoints.shape[0]
+    distances = numpy.empty(nq)
+    errVecs = numpy.zeros((nq, 3))
+    indices = numpy.empty(nq, dtype=int)
+
+    chunk = max(1, int(self.bruteForceChunkSize / self.segments.n))
+    for s in range(0, nq, chunk):
+      q = qpoints[s:s+chunk]
+      (mag2, errVec) = self.segments.errorVectors(q[:,numpy.newaxis,:], slice(None), extrapolate)
+      if exclude is not None:
+        mag2[_excluded(numpy.arange(self.segments.n)[numpy.newaxis,:], exclude, slice(s, s+chunk))] = numpy.inf
+      minIndex = numpy.argmin(mag2, axis=1)
+      rows = numpy.arange(q.shape[0])
+      distances[s:s+chunk] = numpy.sqrt(mag2[rows, minIndex])
+      errVecs[s:s+chunk] = errVec[rows, minIndex]
+      indices[s:s+chunk] = minIndex
+
+    if exclude is not None:
+      indices[numpy.isinf(distances)] = -1
+    return (distances, errVecs, indices)
+
+  def query(self, qpoints, extrapolate, exclude=None):
+    if len(self.levelLo) == 0:
+      return self.queryBruteForce(qpoints, extrapolate, exclude)
+
+    nq = qpoints.shape[0]
+    distances = numpy.empty(nq)
+    errVecs = numpy.zeros((nq, 3))
+    indices = numpy.empty(nq, dtype=int)
+
+    for s in range(0, nq, self.chunkSize):
+      chunkExclude = None
+      if exclude is not None:
+        chunkExclude = (exclude[0][s:s+self.chunkSize], exclude[1][s:s+self.chunkSize])
+      (mag2, errVec, index) = self._queryChunk(qpoints[s:s+self.chunkSize], extrapolate, chunkExclude)
+      distances[s:s+self.chunkSize] = numpy.sqrt(mag2)
+      errVecs[s:s+self.chunkSize] = errVec
+      indices[s:s+self.chunkSize] = index
+
+    if exclude is not None:
+      indices[numpy.isinf(distances)] = -1
+    return (distances, errVecs, indices)
+
+  def queryCurve(self, qpoints, extrapolate, step=8, maxWidth=128):
+    # Same as query(), for the points of a curve (in order along the curve,
+    # e.g. to compare two curves). Every 'step'-th point is an anchor, queried
+    # with the tree. The points of the block of each anchor (up to the next
+    # anchor) are tested against a range of consecutive segments around the
+    # closest segments of the anchors, and with the tree only if a segment
+    # outside the range might be closer: these segments are at least the
+    # clearance of the anchor (its distance to them) minus the distance to
+    # the anchor away. The ranges are made wide enough for the clearance to
+    # exceed the distance to the curve by twice the radius of the block
+    # (from the average advance of the segments along the curve, see
+    # _advance()), and the blocks of wider ranges than 'maxWidth' segments
+    # (e.g. where the closest part of the curve jumps) are queried with the
+    # tree, as are jagged curves.
+    n = self.segments.n
+    nq = qpoints.shape[0]
+    if len(self.levelLo) == 0 or nq < 2 * step:
+      return self.query(qpoints, extrapolate)
+    d = numpy.diff(qpoints, axis=0)
+    if _advance(qpoints) < 0.5 * numpy.sqrt(_dot(d, d)).mean():
+      # Jagged curve (e.g. noisy measurements): the blocks are too wide for
+      # their clearance
+      return self.query(qpoints, extrapolate)
+
+    nBlocks = (nq + step - 1) // step
+    padded = numpy.empty((nBlocks * step, 3))
+    padded[:nq] = qpoints
+    padded[nq:] = qpoints[-1]
+    padded = padded.reshape(nBlocks, step, 3)
+    anchors = padded[:,0]
+    d = padded - anchors[:,numpy.newaxis,:]
+    anchorDistances = numpy.sqrt(_dot(d, d))
+    radius = anchorDistances.max(axis=1)
+
+    (distances, errVecs, anchorSegments) = self.query(anchors, extrapolate)
+    arc = numpy.sqrt(numpy.maximum((distances + 2.0 * radius) ** 2 - distances ** 2, 0.0))
+    margin = numpy.ceil(arc / max(_advance(self.segments.p1), 1.0e-12)).astype(int) + 2
+    nextSegments = numpy.append(anchorSegments[1:], anchorSegments[-1])
+    lo = numpy.maximum(numpy.minimum(anchorSegments, nextSegments) - margin, 0)
+    hi = numpy.minimum(numpy.maximum(anchorSegments, nextSegments) + margin, n-1)
+    narrow = hi - lo < maxWidth
+    clearance = numpy.zeros(nBlocks)
+    clearance[narrow] = self.query(anchors[narrow], extrapolate, (lo[narrow], hi[narrow]))[0]
+
+    # Closest segment of each point in the range of its block, a few blocks
+    # at a time
+    distances = numpy.empty((nBlocks, step))
+    errVecs = numpy.empty((nBlocks, step, 3))
+    indices = numpy.empty((nBlocks, step), dtype=int)
+    chunk = max(self.chunkSize // step, 1)
+    for b in range(0, nBlocks, chunk):
+      width = min(int((hi[b:b+chunk] - lo[b:b+chunk]).max()) + 1, maxWidth)
+      seg = numpy.minimum(lo[b:b+chunk,numpy.newaxis] + numpy.arange(width), hi[b:b+chunk,numpy.newaxis])
+      (mag2, errVec) = self.segments.errorVectors(padded[b:b+chunk,:,numpy.newaxis,:], seg[:,numpy.newaxis,:], extrapolate)
+      best = numpy.argmin(mag2, axis=2)
+      (blocks, points) = numpy.indices(best.shape)
+      distances[b:b+chunk] = numpy.sqrt(mag2[blocks, points, best])
+      errVecs[b:b+chunk] = errVec[blocks, points, best]
+      indices[b:b+chunk] = seg[blocks, best]
+
+    exact = (narrow[:,numpy.newaxis]
+             & (distances * (1.0 + 1.0e-9) + self.tolerance < clearance[:,numpy.newaxis] - anchorDistances))
+    exact = exact.ravel()[:nq]
+    distances = distances.ravel()[:nq]
+    errVecs = errVecs.reshape(-1, 3)[:nq]
+    indices = indices.ravel()[:nq]
+    if not exact.all():
+      (distances[~exact], errVecs[~exact], indices[~exact]) = self.query(qpoints[~exact], extrapolate)
+    return (distances, errVecs, indices)
+
+  def _queryChunk(self, q, extrapolate, exclude=None):
+    nq = q.shape[0]
+    rows = numpy.arange(nq)
+
+    # The first and last segments are always candidates
+    ends = numpy.array([0, self.segments.n-1])
+    (mag2, errVec) = self.segments.errorVectors(q[:,numpy.newaxis,:], ends, extrapolate)
+    if exclude is not None:
+      mag2[_excluded(ends[numpy.newaxis,:], exclude, slice(None))] = numpy.inf
+    first = numpy.argmin(mag2, axis=1)
+    bestMag2 = mag2[rows, first]
+    bestErrVec = errVec[rows, first]
+    bestIndex = ends[first]
+
+    # Traverse the tree, skipping the nodes farther than an upper bound of
+    # the distance. The bound is lowered at each level by the distance to a
+    # point of the curve in each remaining node (the middle point of its
+    # segments), so that it approaches the distance as the nodes get smaller.
+    bound = bestMag2.copy()
+    qi = rows
+    node = numpy.zeros(nq, dtype=int)
+    for level in range(len(self.levelLo)):
+      if level > 0:
+        count = self.levelLo[level].shape[0]
+        qi = numpy.repeat(qi, 2)
+        node = 2*numpy.repeat(node, 2)
+        node[1::2] += 1
+        valid = node < count
+        qi = qi[valid]
+        node = node[valid]
+      span = self.leafSize << (len(self.levelLo) - 1 - level)
+      nodeDistance2 = self._nodeDistance2(q[qi], level, node)
+      keep = nodeDistance2 <= bound[qi] * (1.0 + 1.0e-9) + self.tolerance
+      if exclude is not None:
+        # Nodes whose segments are all excluded
+        keep = keep & ~(_excluded(1 + node*span, exclude, qi)
+                        & _excluded(numpy.minimum((node+1)*span, self.nInterior), exclude, qi))
+      qi = qi[keep]
+      node = node[keep]
+      nodeDistance2 = nodeDistance2[keep]
+
+      middle = numpy.minimum(1 + node*span + span//2, self.nInterior)
+      d = q[qi] - self.segments.p1[middle]
+      d2 = _dot(d, d)
+      if exclude is not None:
+        # (the middle point is on the segment 'middle')
+        d2[_excluded(middle, exclude, qi)] = numpy.inf
+      # (qi is sorted)
+      first = numpy.flatnonzero(numpy.diff(qi, prepend=-1))
+      group = qi[first]
+      bound[group] = numpy.minimum(bound[group], numpy.minimum.reduceat(d2, first))
+      keep = nodeDistance2 <= bound[qi] * (1.0 + 1.0e-9) + self.tolerance
+      qi = qi[keep]
+      node = node[keep]
+    self._testLeaves(q, qi, node, extrapolate, bestMag2, bestErrVec, bestIndex, exclude)
+
+    return (bestMag2, bestErrVec, bestIndex)
+
+  def _nodeDistance2(self, q, level, node):
+    # Lower bounds of the squared distances between the points and the
+    # segments of the nodes: the distances to their boxes and capsules
+    lo = self.levelLo[level][node]
+    hi = self.levelHi[level][node]
+    d = numpy.maximum(numpy.maximum(lo - q, q - hi), 0.0)
+    capsule = numpy.sqrt(_segmentDistance2(q, self.levelA[level][node], self.levelB[level][node]))
+    capsule = numpy.maximum(capsule - self.levelRadius[level][node], 0.0)
+    return numpy.maximum(_dot(d, d), capsule * capsule)
+
+  def _testLeaves(self, q, qi, leaf, extrapolate, bestMag2, bestErrVec, bestIndex, exclude=None):
+    # Tests the query points 'qi' against the segments in the leaves 'leaf',
+    # and updates the best candidates in place.
+    if qi.shape[0] == 0:
+      return
+    offsets = numpy.arange(self.leafSize)
+    seg = 1 + leaf[:,numpy.newaxis]*self.leafSize + offsets
+    valid = seg <= self.nInterior
+    qi = numpy.repeat(qi, self.leafSize)[valid.ravel()]
+    seg = seg[valid]
+
+    (mag2, errVec) = self.segments.errorVectors(q[qi], seg, extrapolate)
+    if exclude is not None:
+      mag2[_excluded(seg, exclude, qi)] = numpy.inf
+
+    # Pick the closest (and lowest index) segment for each query point
+    order = numpy.lexsort((seg, mag2, qi))
+    qi = qi[order]
+    head = numpy.ones(qi.shape[0], dtype=bool)
+    head[1:] = qi[1:] != qi[:-1]
+    pick = order[head]
+    qi = qi[head]
+    mag2 = mag2[pick]
+    seg = seg[pick]
+
+    better = (mag2 < bestMag2[qi]) | ((mag2 == bestMag2[qi]) & (seg < bestIndex[qi]))
+    qi = qi[better]
+    pick = pick[better]
+    bestMag2[qi] = mag2[better]
+    bestErrVec[qi] = errVec[pick]
+    bestIndex[qi] = seg[better]
+
+
+def _excluded(seg, exclude, qi):
+  # Whether the segments 'seg' are excluded for the query points 'qi' (see
+  # CurveSegmentIndex). 'seg' is either one segment for each point, or a
+  # row of segments (1 x M) for all the points.
+  (lo, hi) = exclude
+  lo = lo[qi]
+  hi = hi[qi]
+  if seg.ndim == 2:
+    lo = lo[:,numpy.newaxis]
+    hi = hi[:,numpy.newaxis]
+  return (seg >= lo) & (seg <= hi)
+
+
+#
+# CurveDeviation
+#
+
+class CurveDeviation:
+
+  # Deviation of a curve from a reference curve, e.g. a reconstructed path
+  # from the planned trajectory. 'values' is the distance from each point
+  # of the curve to the reference (polyline), and 'reverseValues' the
+  # distance from each point of the reference to the curve. The closest
+  # segments are found with the segment indexes of the curves (see
+  # CurveSegmentIndex), which are built if not given.
+  # hausdorff is the symmetric Hausdorff distance between the points of the
+  # two curves and the other curve: the larger of max and reverseMax.
+  # NOTE: mean and rms are weighted by the length around each point (half of
+  # each adjacent segment), so that they do not depend on the sampling.
+
+  def __init__(self, points, referencePoints, index=None, referenceIndex=None):
+    self.vtkArray = None
+    self.compute(points, referencePoints, index, referenceIndex)
+
+  def compute(self, points, referencePoints, index=None, referenceIndex=None):
+    # Computes the deviation of 'points' from 'referencePoints'. The arrays
+    # (including vtkArray) are reused if the number of points is unchanged.
+    n = points.shape[0]
+    if self.vtkArray is None or self.values.shape[0] != n:
+      # "Deviation" point array; self.values is a view of its memory
+      self.vtkArray = newDoubleArray(n, 1)
+      self.vtkArray.SetName("Deviation")
+      self.values = numpy_support.vtk_to_numpy(self.vtkArray)
+    else:
+      self.vtkArray.Modified()
+
+    if n < 2 or referencePoints.shape[0] < 2:
+      self.values.fill(numpy.inf)
+      self.reverseValues = numpy.empty(referencePoints.shape[0])
+      self.reverseValues.fill(numpy.inf)
+      self.segments = numpy.empty(n, dtype=int)
+      self.segments.fill(-1)
+      self.max = self.reverseMax = self.hausdorff = self.mean = self.rms = numpy.inf
+      return
+
+    if referenceIndex is None:
+      referenceIndex = CurveSegmentIndex(referencePoints)
+    if index is None:
+      index = CurveSegmentIndex(points)
+    (self.values[:], errVecs, self.segments) = referenceIndex.queryCurve(points, False)
+    (self.reverseValues, errVecs, indices) = index.queryCurve(referencePoints, False)
+
+    self.max = self.values.max()
+    self.reverseMax = self.reverseValues.max()
+    self.hausdorff = max(self.max, self.reverseMax)
+
+    seg = points[1:] - points[:-1]
+    half = numpy.sqrt(_dot(seg, seg)) / 2.0
+    weights = numpy.zeros(n)
+    weights[:-1] += half
+    weights[1:] += half
+    length = weights.sum()
+    if length > 0.0:
+      self.mean = (self.values * weights).sum() / length
+      self.rms = math.sqrt((self.values * self.values * weights).sum() / length)
+    else:
+      self.mean = self.values.mean()
+      self.rms = math.sqrt((self.values * self.values).mean())
+
+  def getSummary(self):
+    summary = {}
+    summary['hausdorff'] = float(self.hausdorff)
+    summary['max'] = float(self.max)
+    summary['reverseMax'] = float(self.reverseMax)
+    summary['mean'] = float(self.mean)
+    summary['rms'] = float(self.rms)
+    return summary
@@ -0,0 +1,142 @@
+import os
+import csv
+import json
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+#
+# Reading control points and writing curves without Slicer. Positions are
+# handled in the RAS coordinate system, as in the Slicer scene; files stored
+# in LPS are converted when they are read.
+#
+
+def readControlPoints(path):
+  # Reads the control points in a markups file (.fcsv, .mrk.json/.json) or a
+  # text file with one 'x y z' (or 'x,y,z') point per line. Returns an Nx3
+  # array.
+  name = path.lower()
+  if name.endswith('.fcsv'):
+    return _readFcsv(path)
+  elif name.endswith('.json'):
+    return _readMarkupsJson(path)
+  else:
+    return _readText(path)
+
+
+def _readFcsv(path):
+  lps = False
+  columns = None
+  points = []
+  with open(path) as f:
+    for row in csv.reader(f):
+      if len(row) == 0:
+        continue
+      if row[0].startswith('#'):
+        header = ','.join(row)[1:].strip()
+        if header.startswith('CoordinateSystem'):
+          value = header.split('=')[-1].strip()
+          lps = value in ('LPS', '1')
+        elif header.startswith('columns'):
+          columns = [c.strip() for c in header.split('=', 1)[1].split(',')]
+        continue
+      if columns:
+        points.append([float(row[columns.index(c)]) for c in ('x', 'y', 'z')])
+      else:
+        points.append([float(v) for v in row[1:4]])
+  return _toRAS(numpy.array(points, dtype=float).reshape(-1, 3), lps)
+
+
+def _readMarkupsJson(path):
+  with open(path) as f:
+    data = json.load(f)
+  markups = data['markups'][0]
+  points = [p['position'] for p in markups.get('controlPoints', [])]
+  lps = markups.get('coordinateSystem', 'LPS') == 'LPS'
+  return _toRAS(numpy.array(points, dtype=float).reshape(-1, 3), lps)
+
+
+def _readText(path):
+  with open(path) as f:
+    text = f.read()
+  delimiter = None
+  if ',' in text:
+    delimiter = ','
+  points = numpy.loadtxt(path, delimiter=delimiter, comments='#', ndmin=2)
+  return numpy.array(points[:, :3], dtype=float)
+
+
+def _toRAS(points, lps):
+  if lps:
+    points[:, 0:2] = -points[:, 0:2]
+  return points
+
+
+def writeCurveSamples(path, result):
+  # Writes the sampled centerline of a CurveResult with the arc length (and
+  # curvature, if computed) at each sample. The format is given by the
+  # extension: .csv, or a VTK polydata file (.vtp, .vtk).
+  samples = result.getSamples()
+  arcLengths = result.getSampleArcLengths()
+
+  if path.lower().endswith('.csv'):
+    columns = [samples, arcLengths[:, numpy.newaxis]]
+    header = 'x,y,z,arcLength'
+    if result.CurvatureData:
+      columns.append(result.CurvatureData.values[:, numpy.newaxis])
+      header = header + ',curvature'
+    numpy.savetxt(path, numpy.hstack(columns), delimiter=',', header=header, comments='', fmt='%.10g')
+    return
+
+  poly = vtk.vtkPolyData()
+  poly.ShallowCopy(result.CurvePoly)
+  arcLengthArray = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(arcLengths), deep=1, array_type=vtk.VTK_DOUBLE)
+  arcLengthArray.SetName('ArcLength')
+  poly.GetPointData().AddArray(arcLengthArray)
+  writePolyData(path, poly)
+
+
+def writePolyData(path, poly):
+  # Writes a polydata (e.g. the tube) to .vtp, .vtk, .stl or .ply
+  extension = os.path.splitext(path)[1].lower()
+  if extension == '.vtp':
+    writer = vtk.vtkXMLPolyDataWriter()
+  elif extension == '.vtk':
+    writer = vtk.vtkPolyDataWriter()
+  elif extension == '.stl':
+    writer = vtk.vtkSTLWriter()
+  elif extension == '.ply':
+    writer = vtk.vtkPLYWriter()
+  else:
+    raise ValueError("Unsupported polydata format: %s" % path)
+  writer.SetFileName(path)
+  writer.SetInputData(poly)
+  if writer.Write() != 1:
+    raise IOError("Failed to write %s" % path)
+
+
+def writeMetrics(path, metrics):
+  with open(path, 'w') as f:
+    json.dump(metrics, f, indent=2, sort_keys=True)
+
+
+def writeSequenceMetrics(path, results, nTargets=0):
+  # Writes the FrameResults of a sequence (see CurveSequence) to a CSV file,
+  # one line per frame, as they are produced by 'results' (e.g. a
+  # generator). Returns the number of frames.
+  header = ['frame', 'controlPoints', 'samples', 'length', 'curvatureMean', 'curvatureMin', 'curvatureMax']
+  header = header + ['distance%d' % i for i in range(nTargets)] + ['segment%d' % i for i in range(nTargets)]
+  count = 0
+  with open(path, 'w') as f:
+    f.write(','.join(header) + '\n')
+    for result in results:
+      row = [str(result.frame), str(result.numberOfControlPoints), str(result.numberOfSamples), '%.10g' % result.length]
+      if result.curvature:
+        row = row + ['%.10g' % c for c in result.curvature]
+      else:
+        row = row + ['', '', '']
+      if nTargets > 0:
+        row = row + ['%.10g' % d for d in result.distances] + [str(i) for i in result.segments]
+      f.write(','.join(row) + '\n')
+      count = count + 1
+  return count
@@ -0,0 +1,128 @@
+import time
+import json
+import collections
+
+#
+# CurveProfiler
+#
+
+class CurveProfiler:
+
+  # Wall time, number of calls and number of samples of the stages of the
+  # curve generation, in total and for each update. The instrumented code
+  # brackets each stage with start() and stop(), and each update with
+  # beginUpdate() and endUpdate(). When the profiler is disabled (default),
+  # start() returns None and the other calls return immediately.
+  #
+  # Each update is kept in a history of the last 'historyLength' updates,
+  # and optionally appended to a log file as one JSON object per line.
+
+  def __init__(self, historyLength=1000):
+    self.Enabled = False
+    self.historyLength = historyLength
+    self.logFile = None
+    self.reset()
+
+  def enable(self, enabled=True, logFileName=None):
+    # Starts (or stops) profiling. If 'logFileName' is specified, each update
+    # is appended to the file.
+    if self.logFile:
+      self.logFile.close()
+      self.logFile = None
+    if enabled and logFileName:
+      self.logFile = open(logFileName, 'a')
+    self.Enabled = enabled
+    self.depth = 0
+    self.current = None
+
+  def reset(self):
+    self.Stages = {}   ## Stage name -> [calls, total time, max time, last time, samples]
+    self.History = collections.deque(maxlen=self.historyLength)
+    self.UpdateCount = 0
+    self.depth = 0
+    self.current = None
+    self.updateStart = 0.0
+
+  def start(self):
+    if not self.Enabled:
+      return None
+    return time.perf_counter()
+
+  def stop(self, stage, start, samples=0):
+    # Records 'stage' started at 'start' (value returned by start())
+    if start is None:
+      return
+    elapsed = time.perf_counter() - start
+    samples = int(samples)
+    stats = self.Stages.get(stage)
+    if stats == None:
+      stats = [0, 0.0, 0.0, 0.0, 0]
+      self.Stages[stage] = stats
+    stats[0] = stats[0] + 1
+    stats[1] = stats[1] + elapsed
+    stats[2] = max(stats[2], elapsed)
+    stats[3] = elapsed
+    stats[4] = stats[4] + samples
+
+    if self.current is not None:
+      record = self.current.get(stage)
+      if record == None:
+        record = [0, 0.0, 0]
+        self.current[stage] = record
+      record[0] = record[0] + 1
+      record[1] = record[1] + elapsed
+      record[2] = record[2] + samples
+
+  def beginUpdate(self):
+    # Updates may be nested (e.g. a local update falling back to a full
+    # update); only the outermost one is recorded.
+    if not self.Enabled:
+      return
+    self.depth = self.depth + 1
+    if self.depth == 1:
+      self.current = {}
+      self.updateStart = time.perf_counter()
+
+  def endUpdate(self, kind='full'):
+    if not self.Enabled or self.depth == 0:
+      return
+    self.depth = self.depth - 1
+    if self.depth > 0:
+      return
+
+    stages = self.current
+    self.current = None
+    self.stop('update', self.updateStart)
+    self.UpdateCount = self.UpdateCount + 1
+
+    record = {}
+    record['update'] = self.UpdateCount
+    record['time'] = time.time()
+    record['kind'] = kind
+    record['total_ms'] = self.Stages['update'][3] * 1000.0
+    record['stages'] = dict((name, {'calls' : r[0], 'ms' : r[1] * 1000.0, 'samples' : r[2]})
+                            for (name, r) in stages.items())
+    self.History.append(record)
+
+    if self.logFile:
+      self.logFile.write(json.dumps(record, sort_keys=True) + '\n')
+      self.logFile.flush()
+
+  def getStatistics(self):
+    # Returns {stage: {'calls', 'total_ms', 'mean_ms', 'max_ms', 'last_ms',
+    # 'samples'}}. The stage 'update' is the whole update.
+    statistics = {}
+    for (name, stats) in self.Stages.items():
+      entry = {}
+      entry['calls'] = stats[0]
+      entry['total_ms'] = stats[1] * 1000.0
+      entry['mean_ms'] = stats[1] * 1000.0 / stats[0]
+      entry['max_ms'] = stats[2] * 1000.0
+      entry['last_ms'] = stats[3] * 1000.0
+      entry['samples'] = stats[4]
+      statistics[name] = entry
+    return statistics
+
+  def getHistory(self):
+    # Returns the records of the last updates (oldest first)
+    return list(self.History)
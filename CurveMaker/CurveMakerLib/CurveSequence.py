@@ -0,0 +1,277 @@
+import os
+import numpy
+import vtk
+
+from .CurveGeometry import CardinalSpline, CurveCurvature, CurveSegmentIndex, updatePolyLine, _dot
+from .CurveEngine import CurveEngine, splineParameters, newTubeFilter, queryDistances
+from .CurveIO import writePolyData, writeSequenceMetrics
+
+#
+# Processing of sequences of control points, e.g. the positions of tracked
+# fiducials recorded during a procedure: length, curvature and target
+# distances of the curve in each frame.
+#
+# The frames are read from an iterable one chunk at a time, and the results
+# are produced one frame at a time (see iterateSequence()), so that the
+# memory does not grow with the length of the sequence. Consecutive frames
+# with the same number of control points are processed together when the
+# samples do not depend on the shape of the curve (polyline, or cardinal
+# spline sampled with interpResolution): the coordinates of all the frames
+# of a chunk are interpolated by a single CardinalSpline, and the lengths and
+# curvatures are computed on the stacked samples.
+#
+
+class FrameResult:
+
+  # Metrics of the curve in one frame of a sequence
+
+  def __init__(self, frame):
+    self.frame = frame
+    self.numberOfControlPoints = 0
+    self.numberOfSamples = 0
+    self.length = 0.0
+    self.curvature = None    ## (mean, min, max), as CurveCurvature
+    self.distances = None    ## Distances to the targets (if specified)
+    self.segments = None     ## Index of the closest segment to each target
+
+
+def frameLengths(samples):
+  # Length of the curves of the frames (F x N x 3 samples), as CurveArcLength
+  n = samples.shape[1]
+  seg = samples[:,1:] - samples[:,:-1]
+  lengths = numpy.cumsum(numpy.sqrt(_dot(seg, seg)), axis=1)
+  if n > 2:
+    # The last sample of a ring is left out (see CurveArcLength)
+    d = samples[:,n-2] - samples[:,0]
+    ring = numpy.sqrt(_dot(d, d)) < 0.00001
+    return numpy.where(ring, lengths[:,-2], lengths[:,-1])
+  return lengths[:,-1]
+
+
+def frameCurvatures(samples):
+  # Mean, min and max curvature of the curves of the frames (F x N x 3
+  # samples), with the same definitions as CurveCurvature
+  p = samples
+  n = p.shape[1]
+  values = numpy.zeros(p.shape[:2])
+  s1 = p[:,1:n-1] - p[:,:n-2]
+  s2 = p[:,2:] - p[:,1:n-1]
+  ds1 = numpy.sqrt(_dot(s1, s1))
+  ds2 = numpy.sqrt(_dot(s2, s2))
+  dT = s2 / ds2[...,numpy.newaxis] - s1 / ds1[...,numpy.newaxis]
+  values[:,1:n-1] = numpy.sqrt(_dot(dT, dT)) / ds2
+
+  bounds = (p + p[:,numpy.minimum(numpy.arange(n)+1, n-1)]) / 2.0
+  bounds[:,0] = p[:,min(1, n-1)]
+  dl = bounds[:,1:] - bounds[:,:-1]
+  weights = numpy.zeros(values.shape)
+  weights[:,1:] = numpy.sqrt(_dot(dl, dl))
+
+  length = weights.sum(axis=1)
+  mean = numpy.zeros(length.shape)
+  nonzero = length > 0.0
+  mean[nonzero] = (values * weights).sum(axis=1)[nonzero] / length[nonzero]
+  return (mean, values.min(axis=1), values.max(axis=1))
+
+
+def frameDistances(samples, targets, extrapolate):
+  # Distances between the targets (F x M x 3, or 1 x M x 3 for the same
+  # targets in all the frames) and the curves of the frames (F x N x 3
+  # samples), by testing all the segments. Returns (distances, indices of
+  # the closest segments), both F x M, with the same results as
+  # CurveSegments/CurveSegmentIndex.
+  p1 = samples[:,numpy.newaxis,:-1]
+  nvec = samples[:,numpy.newaxis,1:] - p1
+  norm = numpy.sqrt(_dot(nvec, nvec))
+  nnvec = numpy.zeros(nvec.shape)
+  nonzero = norm > 0.0
+  nnvec[nonzero] = nvec[nonzero] / norm[nonzero][:,numpy.newaxis]
+
+  q = targets[:,:,numpy.newaxis,:]
+  op = q - p1
+  aproj = _dot(op, nnvec)
+  perp = op - aproj[...,numpy.newaxis] * nnvec
+
+  before = aproj < 0.0
+  after = aproj > norm
+  if extrapolate:
+    nSegments = samples.shape[1] - 1
+    before[...,0] = False
+    after[...,nSegments-1] = False
+
+  errVec = numpy.where(before[...,numpy.newaxis], op, perp)
+  errVec = numpy.where(after[...,numpy.newaxis], q - samples[:,numpy.newaxis,1:], errVec)
+  mag2 = _dot(errVec, errVec)
+  indices = numpy.argmin(mag2, axis=2)
+  return (numpy.sqrt(numpy.take_along_axis(mag2, indices[...,numpy.newaxis], axis=2)[...,0]), indices)
+
+
+def sampleFrames(points, parameters):
+  # Samples of the curves of the frames (F x N x 3 control points), or None
+  # if the sampling depends on the shape of each curve (arc-length or
+  # adaptive sampling). Same results as CurveEngine.
+  (nFrames, n) = points.shape[:2]
+  closed = parameters['RingMode'] > 0
+  if parameters['InterpolationMethod'] == 1:
+    if parameters['SamplingMode'] != 0:
+      return None
+    # The frames are the columns of one spline (x0, y0, z0, x1, y1, ...)
+    spline = CardinalSpline(points.transpose(1, 0, 2).reshape(n, nFrames*3), closed)
+    t = splineParameters(n, parameters['interpResolution'], closed)
+    return spline.evaluate(t).reshape(t.shape[0], nFrames, 3).transpose(1, 0, 2)
+  if closed:
+    ends = (points[:,:1] + points[:,-1:]) / 2.0
+    return numpy.concatenate((ends, points, ends), axis=1)
+  return points
+
+
+def _chunks(frames, parameters, maxSamples):
+  # Groups consecutive frames with the same number of control points into
+  # chunks of about 'maxSamples' samples. Yields (first frame, F x N x 3).
+  chunk = []
+  first = 0
+  limit = 1
+  for (frame, points) in enumerate(frames):
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    if len(chunk) > 0 and (points.shape[0] != chunk[0].shape[0] or len(chunk) >= limit):
+      yield (first, numpy.array(chunk))
+      chunk = []
+    if len(chunk) == 0:
+      first = frame
+      n = points.shape[0]
+      nSamples = n
+      if parameters['InterpolationMethod'] == 1 and n >= 2:
+        nSamples = splineParameters(n, parameters['interpResolution'], parameters['RingMode'] > 0).shape[0]
+      limit = max(1, maxSamples // max(nSamples, 1))
+    chunk.append(points)
+  if len(chunk) > 0:
+    yield (first, numpy.array(chunk))
+
+
+def _chunkDistances(samples, first, targets, extrapolate, maxPairs=250000):
+  # Distances to the targets for a chunk of frames starting at 'first' (see
+  # frameDistances()), computed for at most 'maxPairs' (segment, target)
+  # pairs at once. Returns None if a single frame has more pairs, in which
+  # case the segment index of each frame is faster.
+  (nFrames, n) = samples.shape[:2]
+  pairs = (n - 1) * targets.shape[1]
+  if pairs > maxPairs:
+    return None
+  distances = numpy.empty((nFrames, targets.shape[1]))
+  indices = numpy.empty((nFrames, targets.shape[1]), dtype=int)
+  step = max(1, maxPairs // pairs)
+  for s in range(0, nFrames, step):
+    e = min(s + step, nFrames)
+    if targets.shape[0] == 1:
+      frameTargets = targets
+    else:
+      frameTargets = targets[first+s:first+e]
+    (distances[s:e], indices[s:e]) = frameDistances(samples[s:e], frameTargets, extrapolate)
+  return (distances, indices)
+
+
+def _frameTargets(targets):
+  # Targets as an FxMx3 array (F = 1 if the targets are the same for all the
+  # frames)
+  if targets is None:
+    return None
+  targets = numpy.asarray(targets, dtype=float)
+  if targets.ndim < 3:
+    targets = targets.reshape(1, -1, 3)
+  return targets
+
+
+def iterateSequence(frames, parameters=None, targets=None, extrapolate=False,
+                    tubeDirectory=None, tubeFormat='vtp', maxSamples=1<<17):
+  # Generates the curve of each frame of 'frames' (an iterable of Nx3 arrays
+  # of control points) with the parameters of CurveEngine (defaults if None),
+  # and yields a FrameResult for each frame, in order. 'targets' is an Mx3
+  # array of target points, or an FxMx3 array (targets of each frame). If
+  # 'tubeDirectory' is specified, the tube of each frame is written to
+  # frame_<index>.<tubeFormat> in the directory. At most 'maxSamples' samples
+  # (in total) are kept in memory at once.
+  engine = CurveEngine()
+  if parameters:
+    engine.setParameters(parameters)
+  parameters = engine.getParameters()
+
+  targets = _frameTargets(targets)
+
+  tubeFilter = None
+  curvePoly = None
+  if tubeDirectory:
+    if not os.path.isdir(tubeDirectory):
+      os.makedirs(tubeDirectory)
+    tubeFilter = newTubeFilter(parameters['TubeNumberOfSides'])
+    tubeFilter.SetRadius(parameters['TubeRadius'])
+    curvePoly = vtk.vtkPolyData()
+    tubeFilter.SetInputData(curvePoly)
+
+  for (first, points) in _chunks(frames, parameters, maxSamples):
+    n = points.shape[1]
+    if n < 2:
+      samples = None
+    else:
+      samples = sampleFrames(points, parameters)
+
+    if samples is None:
+      # One frame at a time
+      frameSamples = []
+      for controlPoints in points:
+        frameSamples.append(numpy.array(engine.generate(controlPoints).getSamples()))
+    else:
+      frameSamples = samples
+
+    if samples is not None:
+      lengths = frameLengths(samples)
+      curvatures = frameCurvatures(samples)
+      if targets is not None:
+        distances = _chunkDistances(samples, first, targets, extrapolate)
+
+    for (k, s) in enumerate(frameSamples):
+      result = FrameResult(first + k)
+      result.numberOfControlPoints = n
+      result.numberOfSamples = s.shape[0]
+      if s.shape[0] >= 2:
+        if samples is None:
+          result.length = float(frameLengths(s[numpy.newaxis])[0])
+          curvature = frameCurvatures(s[numpy.newaxis])
+          result.curvature = tuple(float(c[0]) for c in curvature)
+        else:
+          result.length = float(lengths[k])
+          result.curvature = (float(curvatures[0][k]), float(curvatures[1][k]), float(curvatures[2][k]))
+
+      if targets is not None:
+        if targets.shape[0] == 1:
+          frameTargets = targets[0]
+        else:
+          frameTargets = targets[first + k]
+        if samples is not None and distances is not None:
+          result.distances = distances[0][k]
+          result.segments = distances[1][k]
+        else:
+          index = None
+          if s.shape[0] >= 2:
+            index = CurveSegmentIndex(s)
+          (result.distances, errVecs, result.segments) = queryDistances(index, frameTargets, extrapolate)
+
+      if tubeFilter and s.shape[0] >= 2:
+        updatePolyLine(curvePoly, s)
+        if parameters['Curvature']:
+          curvePoly.GetPointData().AddArray(CurveCurvature(s).vtkArray)
+        tubeFilter.Update()
+        writePolyData(os.path.join(tubeDirectory, 'frame_%06d.%s' % (result.frame, tubeFormat)), tubeFilter.GetOutput())
+
+      yield result
+
+
+def processSequence(frames, path, parameters=None, targets=None, extrapolate=False,
+                    tubeDirectory=None, tubeFormat='vtp', maxSamples=1<<17):
+  # Writes the metrics of the curve of each frame (see iterateSequence()) to
+  # the CSV file 'path' as they are computed. Returns the number of frames.
+  targets = _frameTargets(targets)
+  nTargets = 0
+  if targets is not None:
+    nTargets = targets.shape[1]
+  results = iterateSequence(frames, parameters, targets, extrapolate, tubeDirectory, tubeFormat, maxSamples)
+  return writeSequenceMetrics(path, results, nTargets)
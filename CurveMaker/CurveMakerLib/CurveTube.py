@@ -0,0 +1,277 @@
+import math
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from .CurveGeometry import newDoubleArray, polyPoints, _dot
+
+#
+# Tube surface around a curve
+#
+
+def parallelTransportFrames(points):
+  # Unit tangents and normals (Nx3) at the points of a polyline. The normals
+  # are transported along the curve by the minimal rotation between the
+  # consecutive tangents (parallel transport), so they do not twist about the
+  # curve. The rotations are accumulated as angles (see below), so that all
+  # the points are processed at once. If the polyline is a ring (the second
+  # last point is the first one, see CurveArcLength), the mismatch between
+  # the normals at the two ends is spread along the curve.
+  n = points.shape[0]
+  seg = points[1:] - points[:-1]
+  length = numpy.sqrt(_dot(seg, seg))
+
+  # Zero-length segments take the direction of the previous segment (or of
+  # the first non-zero one at the start)
+  valid = length > 0.0
+  if not valid.any():
+    tangents = numpy.zeros((n, 3))
+    tangents[:,0] = 1.0
+    return (tangents, _perpendicular(tangents))
+  index = numpy.where(valid, numpy.arange(n-1), -1)
+  numpy.maximum.accumulate(index, out=index)
+  index[index < 0] = numpy.argmax(valid)
+  directions = seg[index] / length[index][:,numpy.newaxis]
+
+  ring = n > 2 and math.sqrt(_dot(points[n-2] - points[0], points[n-2] - points[0])) < 0.00001
+
+  # Tangent at each point: bisector of the adjacent segments
+  tangents = numpy.empty((n, 3))
+  tangents[0] = directions[0]
+  tangents[-1] = directions[-1]
+  tangents[1:-1] = directions[:-1] + directions[1:]
+  if ring:
+    tangents[0] = directions[n-3] + directions[0]
+  norm = numpy.sqrt(_dot(tangents, tangents))
+  hairpin = norm < 1.0e-9
+  tangents[hairpin] = directions[numpy.maximum(numpy.nonzero(hairpin)[0] - 1, 0)]
+  norm[hairpin] = 1.0
+  tangents = tangents / norm[:,numpy.newaxis]
+
+  # Each point has an arbitrary normal U. The normal U of the previous point,
+  # moved by the minimal rotation between the tangents, is at the angle
+  # 'delta' from U about the tangent. The parallel-transported normal is U
+  # rotated by the sum of these angles from the first point.
+  u = _perpendicular(tangents)
+  t0 = tangents[:-1]
+  t1 = tangents[1:]
+  axis = _cross(t0, t1)
+  cosine = _dot(t0, t1)
+  c = 1.0 + cosine
+  opposite = c < 1.0e-12
+  c[opposite] = 1.0
+  v = u[:-1] * cosine[:,numpy.newaxis] + _cross(axis, u[:-1]) + axis * (_dot(axis, u[:-1]) / c)[:,numpy.newaxis]
+  # A half turn between opposite tangents is made about the normal
+  v[opposite] = u[:-1][opposite]
+  delta = numpy.arctan2(_dot(_cross(u[1:], v), t1), _dot(u[1:], v))
+  theta = numpy.zeros(n)
+  numpy.cumsum(delta, out=theta[1:])
+  normals = numpy.cos(theta)[:,numpy.newaxis] * u + numpy.sin(theta)[:,numpy.newaxis] * _cross(tangents, u)
+
+  if ring:
+    end = normals[n-2]
+    angle = math.atan2(_dot(_cross(normals[0], end), tangents[0]), _dot(normals[0], end))
+    arcLengths = numpy.zeros(n)
+    numpy.cumsum(length, out=arcLengths[1:])
+    if arcLengths[n-2] > 0.0:
+      alpha = -angle * arcLengths / arcLengths[n-2]
+      normals = (numpy.cos(alpha)[:,numpy.newaxis] * normals
+                 + numpy.sin(alpha)[:,numpy.newaxis] * _cross(tangents, normals))
+
+  return (tangents, normals)
+
+
+def _perpendicular(v):
+  # Unit vectors perpendicular to the unit vectors 'v' (Nx3)
+  axes = numpy.eye(3)[numpy.argmin(numpy.abs(v), axis=1)]
+  p = _cross(v, axes)
+  return p / numpy.sqrt(_dot(p, p))[:,numpy.newaxis]
+
+
+def _cross(a, b):
+  # Row-wise cross product of two (broadcastable) arrays of 3D vectors
+  # (numpy.cross has a large overhead on short arrays)
+  product = numpy.empty(numpy.broadcast(a, b).shape)
+  product[...,0] = a[...,1]*b[...,2] - a[...,2]*b[...,1]
+  product[...,1] = a[...,2]*b[...,0] - a[...,0]*b[...,2]
+  product[...,2] = a[...,0]*b[...,1] - a[...,1]*b[...,0]
+  return product
+
+
+#
+# CurveTubeFilter
+#
+
+class CurveTubeFilter:
+
+  # Tube around a polyline (e.g. CurvePoly) with parallel-transport frames
+  # (see parallelTransportFrames()). The interface is the part of
+  # vtkTubeFilter used by CurveMaker (SetInputData(), SetRadius(),
+  # SetNumberOfSides(), SetCapping(), Update(), GetOutput()), and the output
+  # has the same layout: a ring of NumberOfSides points around each point of
+  # the polyline, one triangle strip along each side, two more rings of
+  # points for the caps (triangle strips), the point data of the input and
+  # the "TubeNormals" normals.
+  #
+  # The output polydata is the same across updates. Its points, normals and
+  # point data are computed in place, and its strips are rebuilt only if the
+  # number of points, the number of sides or the capping has changed.
+
+  def __init__(self):
+    self.input = None
+    self.Radius = 0.5
+    self.NumberOfSides = 3
+    self.Capping = 0
+    self.output = vtk.vtkPolyData()
+    self.layout = None       ## (number of points, number of sides, capping) of the output
+    self.pointsArray = None
+    self.normalsArray = None
+    self.sourceIndex = None  ## Input point of each output point
+
+  def SetInputData(self, poly):
+    self.input = poly
+
+  def GetInput(self):
+    return self.input
+
+  def SetRadius(self, radius):
+    self.Radius = radius
+
+  def GetRadius(self):
+    return self.Radius
+
+  def SetNumberOfSides(self, sides):
+    self.NumberOfSides = max(int(sides), 3)
+
+  def GetNumberOfSides(self):
+    return self.NumberOfSides
+
+  def SetCapping(self, capping):
+    self.Capping = int(bool(capping))
+
+  def GetCapping(self):
+    return self.Capping
+
+  def CappingOn(self):
+    self.SetCapping(True)
+
+  def CappingOff(self):
+    self.SetCapping(False)
+
+  def GetOutput(self):
+    return self.output
+
+  def Update(self):
+    if self.input == None or self.input.GetNumberOfPoints() < 2:
+      self.output.Initialize()
+      self.layout = None
+      return
+
+    points = polyPoints(self.input)
+    n = points.shape[0]
+    sides = self.NumberOfSides
+    layout = (n, sides, self.Capping)
+    # The arrays are also set up again if the content of the output has been
+    # replaced (e.g. by DeepCopy())
+    if (layout != self.layout or self.output.GetPoints() == None
+        or self.output.GetPoints().GetData() is not self.pointsArray
+        or self.output.GetPointData().GetNormals() is not self.normalsArray):
+      self._allocate(layout)
+
+    (tangents, normals) = parallelTransportFrames(points)
+    frames = numpy.empty((n, 2, 3))
+    frames[:,0] = normals
+    frames[:,1] = _cross(normals, tangents)
+    angles = 2.0 * math.pi * numpy.arange(sides) / sides
+    rotations = numpy.column_stack((numpy.cos(angles), numpy.sin(angles)))
+    outputPoints = numpy.asarray(numpy_support.vtk_to_numpy(self.pointsArray))
+    outputNormals = numpy.asarray(numpy_support.vtk_to_numpy(self.normalsArray))
+
+    # Outward normal of each side at each point (n x sides x 3)
+    radial = outputNormals[:n*sides].reshape(n, sides, 3)
+    numpy.matmul(rotations, frames, out=radial)
+    tube = outputPoints[:n*sides].reshape(n, sides, 3)
+    numpy.multiply(radial, self.Radius, out=tube)
+    tube += points[:,numpy.newaxis,:]
+
+    if self.Capping:
+      outputPoints[n*sides:(n+1)*sides] = outputPoints[:sides]
+      outputPoints[(n+1)*sides:] = outputPoints[(n-1)*sides:n*sides]
+      outputNormals[n*sides:(n+1)*sides] = -tangents[0]
+      outputNormals[(n+1)*sides:] = tangents[-1]
+
+    self.pointsArray.Modified()
+    self.normalsArray.Modified()
+    self.output.GetPoints().Modified()
+    self._copyPointData()
+    self.output.Modified()
+
+  def _allocate(self, layout):
+    # Sets up the points, normals and strips of the output for 'layout'
+    (n, sides, capping) = layout
+    self.layout = layout
+    nPoints = n * sides
+    if capping:
+      nPoints = nPoints + 2 * sides
+
+    self.output.Initialize()
+    self.pointsArray = newDoubleArray(nPoints, 3)
+    outputPoints = vtk.vtkPoints()
+    outputPoints.SetData(self.pointsArray)
+    self.output.SetPoints(outputPoints)
+    self.normalsArray = newDoubleArray(nPoints, 3)
+    self.normalsArray.SetName('TubeNormals')
+    self.output.GetPointData().SetNormals(self.normalsArray)
+
+    # One strip along each side: (i, k+1), (i, k) for each point i
+    idType = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+    ring = numpy.arange(n, dtype=idType) * sides
+    k = numpy.arange(sides, dtype=idType)
+    strips = numpy.empty((sides, 1 + 2*n), dtype=idType)
+    strips[:,0] = 2 * n
+    strips[:,1::2] = ring[numpy.newaxis,:] + ((k + 1) % sides)[:,numpy.newaxis]
+    strips[:,2::2] = ring[numpy.newaxis,:] + k[:,numpy.newaxis]
+    cells = [strips.ravel()]
+
+    self.sourceIndex = numpy.repeat(numpy.arange(n), sides)
+    if capping:
+      # Zigzag across each cap: 0, 1, s-1, 2, s-2, ... (reversed at the end)
+      j = numpy.arange(sides, dtype=idType)
+      zigzag = numpy.where(j % 2 == 1, (j + 1) // 2, (sides - j // 2) % sides)
+      cells.append(numpy.concatenate(([sides], n*sides + zigzag)).astype(idType))
+      cells.append(numpy.concatenate(([sides], (n+1)*sides + (sides - zigzag) % sides)).astype(idType))
+      self.sourceIndex = numpy.concatenate((self.sourceIndex, numpy.zeros(sides, dtype=int), numpy.repeat(n-1, sides)))
+
+    outputStrips = vtk.vtkCellArray()
+    outputStrips.ImportLegacyFormat(numpy_support.numpy_to_vtkIdTypeArray(numpy.concatenate(cells), deep=1))
+    self.output.SetStrips(outputStrips)
+
+  def _copyPointData(self):
+    # Copies the point data of the input to the points of the tube (the
+    # arrays of the output are reused if they have the same size and type)
+    inputPointData = self.input.GetPointData()
+    outputPointData = self.output.GetPointData()
+    nPoints = self.sourceIndex.shape[0]
+    names = []
+    for i in range(inputPointData.GetNumberOfArrays()):
+      array = inputPointData.GetArray(i)
+      if array is None or array.GetName() == None or array.GetName() == 'TubeNormals':
+        continue
+      name = array.GetName()
+      names.append(name)
+      outputArray = outputPointData.GetArray(name)
+      if (outputArray is None or outputArray.GetDataType() != array.GetDataType()
+          or outputArray.GetNumberOfComponents() != array.GetNumberOfComponents()
+          or outputArray.GetNumberOfTuples() != nPoints):
+        outputArray = array.NewInstance()
+        outputArray.SetName(name)
+        outputArray.SetNumberOfComponents(array.GetNumberOfComponents())
+        outputArray.SetNumberOfTuples(nPoints)
+        outputPointData.AddArray(outputArray)
+      numpy.take(numpy_support.vtk_to_numpy(array), self.sourceIndex, axis=0, out=numpy_support.vtk_to_numpy(outputArray))
+      outputArray.Modified()
+
+    for i in reversed(range(outputPointData.GetNumberOfArrays())):
+      name = outputPointData.GetArrayName(i)
+      if name != 'TubeNormals' and name not in names:
+        outputPointData.RemoveArray(i)
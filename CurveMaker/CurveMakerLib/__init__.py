@@ -0,0 +1,10 @@
+from .CurveGeometry import CurveArcLength, CurveCurvature, CardinalSpline, CurveSegments, CurveSegmentIndex, CurveDeviation, updatePolyLine, polyPoints
+from .CurveEngine import CurveEngine, CurveResult, polylinePoints, splineParameters, splineSamplingParameters, sampleArcLengths, decimateCurve, newTubeFilter, queryDistances
+from .CurveIO import readControlPoints, writeCurveSamples, writePolyData, writeMetrics, writeSequenceMetrics
+from .CurveBatch import generateCurves, mapCases, CaseResult
+from .CurveProfiler import CurveProfiler
+from .CurveCache import CurveResultCache
+from .CurveSequence import iterateSequence, processSequence, FrameResult
+from .CurveTube import CurveTubeFilter, parallelTransportFrames
+from .CurveArchive import CurveArchiveWriter, CurveArchive, CurveArchiveRecord
+from .CurveDistanceField import pointDistances, imageDistances, mapChunks
@@ -0,0 +1,5 @@
+import sys
+
+from .CurveBatch import main
+
+sys.exit(main())
@@ -0,0 +1,234 @@
+#
+# Benchmark of the stages of the curve generation on synthetic curves.
+#
+# Runs without Slicer, on the CurveMakerLib code used by CurveMakerLogic:
+#
+#   nodeToPoly                polyline through the control points
+#   nodeToPolyCardinalSpline  spline sampling
+#   calculateLineLength       arc length table
+#   computeCurvatures         point-by-point curvature
+#   tube                      tube filter of updateCurve() (CurveTubeFilter)
+#   vtkTube                   vtkTubeFilter, for comparison
+#   segmentIndex              spatial index built on the first distance query
+#   distanceToPoint           distances of the targets to the curve
+#   curveDeviation            deviation from a displaced copy of the curve
+#   distanceField             distances to the voxels of an image around the curve
+#   distanceFieldBand         same within --field-max-distance of the curve only
+#
+# Usage:
+#
+#   python CurveMakerBenchmark.py [--output results.json] [--compare baseline.json]
+#
+# The results (latency percentiles, throughput, peak memory for each stage,
+# curve and size) are written as JSON. With --compare, the median latencies
+# are compared with a previous run, and the exit status is 1 if a stage is
+# slower than --threshold times the baseline.
+#
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+import numpy
+import vtk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from CurveMakerLib import CardinalSpline, CurveArcLength, CurveCurvature, CurveSegmentIndex, CurveDeviation
+from CurveMakerLib import polylinePoints, splineParameters, newTubeFilter, queryDistances, updatePolyLine, polyPoints
+from CurveMakerLib import imageDistances
+from CurveMakerTestData import syntheticCurve
+
+
+def measure(function, minRepeat, minTime, maxRepeat):
+  # Runs 'function' at least 'minRepeat' times and for at least 'minTime'
+  # seconds (at most 'maxRepeat' times). Returns the latencies (s) and the
+  # peak memory (bytes) allocated through Python during one run.
+  gc.collect()
+  tracemalloc.start()
+  function()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+
+  latencies = []
+  start = time.perf_counter()
+  while len(latencies) < maxRepeat and (len(latencies) < minRepeat or time.perf_counter() - start < minTime):
+    t0 = time.perf_counter()
+    function()
+    latencies.append(time.perf_counter() - t0)
+  return (numpy.array(latencies), peak)
+
+
+def summarize(stage, case, latencies, peak, items):
+  # 'items' is the number of elements processed by one run (control points,
+  # samples or targets), for the throughput
+  result = dict(case)
+  result['stage'] = stage
+  result['repeat'] = int(latencies.shape[0])
+  result['items'] = int(items)
+  for (name, q) in (('p50', 50), ('p90', 90), ('p99', 99)):
+    result['latency_%s_ms' % name] = float(numpy.percentile(latencies, q) * 1000.0)
+  result['latency_min_ms'] = float(latencies.min() * 1000.0)
+  result['latency_mean_ms'] = float(latencies.mean() * 1000.0)
+  result['throughput_per_s'] = float(items / numpy.median(latencies)) if numpy.median(latencies) > 0.0 else None
+  result['peak_memory_bytes'] = int(peak)
+  return result
+
+
+def benchmarkCurve(n, closed, resolution, targetCounts, options):
+  results = []
+  points = syntheticCurve(n, closed)
+  case = {'controlPoints' : n, 'closed' : closed, 'resolution' : resolution}
+  timing = (options.min_repeat, options.min_time, options.max_repeat)
+
+  def run(stage, function, items, extra=None):
+    stageCase = dict(case)
+    if extra:
+      stageCase.update(extra)
+    (latencies, peak) = measure(function, *timing)
+    result = summarize(stage, stageCase, latencies, peak, items)
+    results.append(result)
+    if not options.quiet:
+      details = ' '.join('%s=%s' % item for item in sorted((extra or {}).items()))
+      sys.stderr.write("%-25s n=%-7d closed=%d res=%-3d %-14s p50=%.3f ms\n"
+                       % (stage, n, closed, resolution, details, result['latency_p50_ms']))
+
+  poly = vtk.vtkPolyData()
+  run('nodeToPoly', lambda: updatePolyLine(poly, polylinePoints(points, closed)), n)
+
+  def sample():
+    spline = CardinalSpline(points, closed)
+    t = splineParameters(n, resolution, closed)
+    spline.evaluate(t, updatePolyLine(poly, None, t.shape[0]))
+  run('nodeToPolyCardinalSpline', sample, n)
+
+  samples = polyPoints(poly)
+  nSamples = samples.shape[0]
+  case['samples'] = nSamples
+  run('calculateLineLength', lambda: CurveArcLength(samples), nSamples)
+  run('computeCurvatures', lambda: CurveCurvature(samples), nSamples)
+
+  if nSamples <= options.max_tube_samples:
+    tubeFilter = newTubeFilter(20)
+    tubeFilter.SetInputData(poly)
+    tubeFilter.SetRadius(1.0)
+    def tube():
+      poly.Modified()
+      tubeFilter.Update()
+    run('tube', tube, nSamples)
+    vtkTubeFilter = newTubeFilter(20, vtkFilter=True)
+    vtkTubeFilter.SetInputData(poly)
+    vtkTubeFilter.SetRadius(1.0)
+    def vtkTube():
+      poly.Modified()
+      vtkTubeFilter.Update()
+    run('vtkTube', vtkTube, nSamples)
+
+  run('segmentIndex', lambda: CurveSegmentIndex(samples), nSamples)
+  index = CurveSegmentIndex(samples)
+  lo = samples.min(axis=0) - 10.0
+  hi = samples.max(axis=0) + 10.0
+  rng = numpy.random.RandomState(1)
+  for nTargets in targetCounts:
+    targets = lo + rng.random_sample((nTargets, 3)) * (hi - lo)
+    run('distanceToPoint', lambda: queryDistances(index, targets, False), nTargets, {'targets' : nTargets})
+
+  if nSamples <= options.max_deviation_samples:
+    reference = samples + rng.normal(0.0, 0.5, samples.shape)
+    referenceIndex = CurveSegmentIndex(reference)
+    run('curveDeviation', lambda: CurveDeviation(samples, reference, index, referenceIndex), nSamples)
+
+  if options.field_size > 0:
+    size = options.field_size
+    ijkToRAS = numpy.eye(4)
+    ijkToRAS[:3,:3] = numpy.diag((hi - lo) / max(size - 1, 1))
+    ijkToRAS[:3,3] = lo
+    run('distanceField', lambda: imageDistances(index, (size, size, size), ijkToRAS), size**3, {'voxels' : size**3})
+    if options.field_max_distance > 0.0:
+      run('distanceFieldBand', lambda: imageDistances(index, (size, size, size), ijkToRAS, maxDistance=options.field_max_distance),
+          size**3, {'voxels' : size**3, 'maxDistance' : options.field_max_distance})
+
+  return results
+
+
+def environment():
+  info = {}
+  info['python'] = platform.python_version()
+  info['numpy'] = numpy.__version__
+  info['vtk'] = vtk.vtkVersion.GetVTKVersion()
+  info['platform'] = platform.platform()
+  info['processor'] = platform.processor()
+  info['cpus'] = os.cpu_count()
+  info['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+  return info
+
+
+def caseKey(result):
+  return (result['stage'], result['controlPoints'], result['closed'], result['resolution'], result.get('targets'))
+
+
+def compare(results, baselinePath, threshold):
+  # Prints the ratio of the median latencies to the baseline. Returns the
+  # number of regressions (ratio > threshold).
+  with open(baselinePath) as f:
+    baseline = dict((caseKey(r), r) for r in json.load(f)['results'])
+  regressions = 0
+  for result in results:
+    reference = baseline.get(caseKey(result))
+    if reference == None or reference['latency_p50_ms'] <= 0.0:
+      continue
+    ratio = result['latency_p50_ms'] / reference['latency_p50_ms']
+    flag = ''
+    if ratio > threshold:
+      flag = '  REGRESSION'
+      regressions = regressions + 1
+    sys.stdout.write("%-25s %s %8.3f ms -> %8.3f ms (x%.2f)%s\n"
+                     % (result['stage'], caseKey(result)[1:], reference['latency_p50_ms'], result['latency_p50_ms'], ratio, flag))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the stages of the curve generation on synthetic curves.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=[3, 10, 100, 1000, 10000, 100000], help='numbers of control points')
+  parser.add_argument('--resolutions', type=int, nargs='+', default=[5, 25], help='interpolation resolutions')
+  parser.add_argument('--targets', type=int, nargs='+', default=[1, 100, 10000], help='numbers of targets for the distances')
+  parser.add_argument('--curves', choices=['open', 'closed', 'both'], default='both')
+  parser.add_argument('--min-repeat', type=int, default=5, help='minimum number of runs per stage')
+  parser.add_argument('--max-repeat', type=int, default=1000, help='maximum number of runs per stage')
+  parser.add_argument('--min-time', type=float, default=0.5, help='minimum time (s) per stage')
+  parser.add_argument('--max-tube-samples', type=int, default=1000000, help='skip the tube above this number of samples')
+  parser.add_argument('--max-deviation-samples', type=int, default=100000, help='skip the curve deviation above this number of samples')
+  parser.add_argument('--field-size', type=int, default=32, help='size of the image of the distance field (0 to skip)')
+  parser.add_argument('--field-max-distance', type=float, default=2.0, help='band (mm) of the distanceFieldBand stage (0 to skip)')
+  parser.add_argument('--output', help='JSON file for the results (default: standard output)')
+  parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+  parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+  parser.add_argument('--quiet', action='store_true')
+  options = parser.parse_args(argv)
+
+  closedModes = {'open' : [False], 'closed' : [True], 'both' : [False, True]}[options.curves]
+  results = []
+  for closed in closedModes:
+    for n in options.sizes:
+      for resolution in options.resolutions:
+        results.extend(benchmarkCurve(n, closed, resolution, options.targets, options))
+
+  report = {'environment' : environment(), 'results' : results}
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump(report, f, indent=1)
+  else:
+    json.dump(report, sys.stdout, indent=1)
+    sys.stdout.write('\n')
+
+  if options.compare and compare(results, options.compare, options.threshold) > 0:
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,304 @@
+#
+# Unit tests of CurveMakerLib: the numpy implementations are checked against
+# their VTK counterparts, and the incremental updates against a computation
+# from scratch.
+#
+# Runs without Slicer:
+#
+#   python CurveMakerLibTest.py
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from CurveMakerLib import CardinalSpline, CurveArcLength, CurveCurvature, CurveSegmentIndex, CurveEngine
+from CurveMakerLib import CurveArchiveWriter, CurveArchive, newTubeFilter, updatePolyLine, splineParameters
+from CurveMakerLib import imageDistances, CurveResultCache
+from CurveMakerTestData import randomCurve
+
+
+def vtkSplinePoints(points, t, closed):
+  # Points at parameters 't' of the vtkCardinalSpline through 'points'
+  splines = []
+  for axis in range(3):
+    spline = vtk.vtkCardinalSpline()
+    spline.SetClosed(closed)
+    for (k, value) in enumerate(points[:,axis]):
+      spline.AddPoint(k, value)
+    splines.append(spline)
+  return numpy.array([[spline.Evaluate(s) for spline in splines] for s in t])
+
+
+class CardinalSplineTest(unittest.TestCase):
+
+  def checkSpline(self, n, closed):
+    points = randomCurve(n, n)
+    spline = CardinalSpline(points, closed)
+    t = numpy.linspace(0.0, spline.size - 1.0, 10 * n + 1)
+    numpy.testing.assert_allclose(spline.evaluate(t), vtkSplinePoints(points, t, closed), rtol=0.0, atol=1.0e-9)
+
+  def test_open(self):
+    for n in (2, 3, 5, 40, 200):
+      self.checkSpline(n, False)
+
+  def test_closed(self):
+    for n in (3, 5, 40, 200):
+      self.checkSpline(n, True)
+
+  def test_adaptiveParameters(self):
+    # Deviation of the chords from the spline, measured at 512 points per
+    # interval
+    for closed in (False, True):
+      spline = CardinalSpline(randomCurve(40, 8), closed)
+      t = numpy.linspace(0.0, spline.size - 1.0, 512 * (spline.size - 1) + 1)
+      points = spline.evaluate(t)
+      for tolerance in (1.0, 0.1, 0.01):
+        for maxSpacing in (None, 5.0):
+          u = spline.adaptiveParameters(tolerance, maxSpacing)
+          samples = spline.evaluate(u)
+          chord = numpy.clip(numpy.searchsorted(u, t, side='right') - 1, 0, u.shape[0] - 2)
+          (a, b) = (samples[chord], samples[chord+1])
+          s = numpy.clip(((points - a) * (b - a)).sum(axis=1) / ((b - a) * (b - a)).sum(axis=1), 0.0, 1.0)
+          deviation = numpy.sqrt((((a + s[:,numpy.newaxis] * (b - a)) - points) ** 2).sum(axis=1))
+          self.assertLessEqual(deviation.max(), tolerance)
+          if maxSpacing:
+            self.assertLessEqual(numpy.sqrt(((samples[1:] - samples[:-1]) ** 2).sum(axis=1)).max(), maxSpacing * 1.05)
+
+  def test_moveControlPoints(self):
+    # Local update of the spline, the samples, the arc lengths and the
+    # curvature (as in CurveMakerLogic.updateCurveLocally())
+    for closed in (False, True):
+      points = randomCurve(200, 1)
+      spline = CardinalSpline(points, closed)
+      t = splineParameters(spline.nPoints, 10, closed)
+      if closed:
+        t = t[:-2]
+      samples = spline.evaluate(t)
+      arcLength = CurveArcLength(samples)
+      curvature = CurveCurvature(samples)
+
+      points[100:103] += [3.0, -2.0, 1.0]
+      (k0, k1) = spline.moveControlPoints(points, 100, 102)
+      start = numpy.searchsorted(t, k0, side='right')
+      stop = numpy.searchsorted(t, k1, side='right')
+      spline.evaluate(t[start:stop], samples[start:stop])
+      arcLength.update(start, stop)
+      curvature.update(start, stop)
+
+      expected = CardinalSpline(points, closed)
+      expectedSamples = expected.evaluate(t)
+      numpy.testing.assert_allclose(spline.derivatives, expected.derivatives, rtol=0.0, atol=1.0e-12)
+      numpy.testing.assert_allclose(samples, expectedSamples, rtol=0.0, atol=1.0e-12)
+      numpy.testing.assert_allclose(arcLength.arcLengths, CurveArcLength(expectedSamples).arcLengths, rtol=1.0e-12, atol=1.0e-9)
+      expectedCurvature = CurveCurvature(expectedSamples)
+      numpy.testing.assert_allclose(curvature.values, expectedCurvature.values, rtol=0.0, atol=1.0e-9)
+      self.assertAlmostEqual(curvature.mean, expectedCurvature.mean, places=9)
+
+
+class CurveSegmentIndexTest(unittest.TestCase):
+
+  def test_query(self):
+    samples = CurveEngine().generate(randomCurve(50, 2)).getSamples()
+    index = CurveSegmentIndex(samples)
+    rng = numpy.random.RandomState(3)
+    # Points near the curve, and far from it
+    queries = numpy.vstack((samples[::7] + rng.normal(scale=2.0, size=samples[::7].shape),
+                            rng.uniform(-200.0, 200.0, size=(200, 3))))
+    for extrapolate in (False, True):
+      (distances, errVecs, indices) = index.query(queries, extrapolate)
+      (expected, expectedErrVecs, expectedIndices) = index.queryBruteForce(queries, extrapolate)
+      numpy.testing.assert_allclose(distances, expected, rtol=1.0e-12, atol=1.0e-12)
+      numpy.testing.assert_allclose(numpy.sqrt((errVecs * errVecs).sum(axis=1)), distances, rtol=1.0e-12, atol=1.0e-12)
+
+  def test_queryCurve(self):
+    # Smooth and jagged curves near the indexed one, and a curve crossing it
+    engine = CurveEngine()
+    samples = engine.generate(randomCurve(50, 2)).getSamples()
+    index = CurveSegmentIndex(samples)
+    rng = numpy.random.RandomState(4)
+    curves = (engine.generate(randomCurve(50, 2) + rng.normal(scale=1.0, size=(50, 3))).getSamples(),
+              samples + rng.normal(scale=0.5, size=samples.shape),
+              engine.generate(randomCurve(20, 5)).getSamples())
+    for curve in curves:
+      for extrapolate in (False, True):
+        for (result, expected) in zip(index.queryCurve(curve, extrapolate), index.query(curve, extrapolate)):
+          numpy.testing.assert_array_equal(result, expected)
+
+
+class CurveDistanceFieldTest(unittest.TestCase):
+
+  def test_imageDistances(self):
+    # Oblique image around the curve, in chunks of a few rows, with and
+    # without a band
+    samples = CurveEngine().generate(randomCurve(20, 6)).getSamples()
+    index = CurveSegmentIndex(samples)
+    dimensions = (23, 17, 12)
+    ijkToRAS = numpy.eye(4)
+    rotation = numpy.linalg.qr(numpy.random.RandomState(7).normal(size=(3, 3)))[0]
+    ijkToRAS[:3,:3] = rotation * 4.0
+    ijkToRAS[:3,3] = samples.mean(axis=0) - numpy.dot(ijkToRAS[:3,:3], numpy.array(dimensions) / 2.0)
+    ijk = numpy.indices(dimensions[::-1]).reshape(3, -1)[::-1].T
+    expected = index.query(numpy.dot(ijk, ijkToRAS[:3,:3].T) + ijkToRAS[:3,3], False)[0].reshape(dimensions[::-1])
+    for chunkSize in (100, 65536):
+      distances = imageDistances(index, dimensions, ijkToRAS, chunkSize=chunkSize, dtype=float)
+      numpy.testing.assert_allclose(distances, expected, rtol=0.0, atol=1.0e-9)
+      for maxDistance in (2.0, 10.0):
+        distances = imageDistances(index, dimensions, ijkToRAS, chunkSize=chunkSize, dtype=float, maxDistance=maxDistance)
+        numpy.testing.assert_allclose(distances, numpy.minimum(expected, maxDistance), rtol=0.0, atol=1.0e-9)
+
+
+class CurveTubeFilterTest(unittest.TestCase):
+
+  def test_layout(self):
+    poly = vtk.vtkPolyData()
+    updatePolyLine(poly, CurveEngine().generate(randomCurve(10, 4)).getSamples())
+    for capping in (False, True):
+      tubes = []
+      for vtkFilter in (False, True):
+        tubeFilter = newTubeFilter(12, capping, vtkFilter)
+        tubeFilter.SetInputData(poly)
+        tubeFilter.SetRadius(2.0)
+        tubeFilter.Update()
+        tubes.append(tubeFilter.GetOutput())
+      (tube, expected) = tubes
+      self.assertEqual(tube.GetNumberOfPoints(), expected.GetNumberOfPoints())
+      self.assertEqual(tube.GetNumberOfStrips(), expected.GetNumberOfStrips())
+      self.assertEqual(tube.GetStrips().GetNumberOfConnectivityIds(), expected.GetStrips().GetNumberOfConnectivityIds())
+      self.assertIsNotNone(tube.GetPointData().GetNormals())
+
+  def test_geometry(self):
+    # The vertices of each ring are at the radius from their centerline
+    # point, along the normals. The first vertex of a ring is that of the
+    # previous ring moved by the minimal rotation between the rings (no
+    # twist), up to the spread of the mismatch at the ends of a closed curve.
+    engine = CurveEngine()
+    engine.InterpolationMethod = 1
+    poly = vtk.vtkPolyData()
+    for ring in (0, 1):
+      engine.RingMode = ring
+      samples = engine.generate(randomCurve(40, 8)).getSamples()
+      n = samples.shape[0]
+      updatePolyLine(poly, samples)
+      tubeFilter = newTubeFilter(12, True)
+      tubeFilter.SetInputData(poly)
+      tubeFilter.SetRadius(2.0)
+      tubeFilter.Update()
+      tube = tubeFilter.GetOutput()
+      points = numpy_support.vtk_to_numpy(tube.GetPoints().GetData())[:n*12].reshape(n, 12, 3)
+      normals = numpy_support.vtk_to_numpy(tube.GetPointData().GetNormals())[:n*12].reshape(n, 12, 3)
+      radial = points - samples[:,numpy.newaxis,:]
+      numpy.testing.assert_allclose(numpy.sqrt((radial * radial).sum(axis=2)), 2.0, rtol=0.0, atol=1.0e-9)
+      numpy.testing.assert_allclose(normals, radial / 2.0, rtol=0.0, atol=1.0e-9)
+
+      axes = numpy.cross(normals[:,0], normals[:,3])
+      (a, b) = (axes[:-1], axes[1:])
+      (u0, u1) = (normals[:-1,0], normals[1:,0])
+      axis = numpy.cross(a, b)
+      cosine = (a * b).sum(axis=1)
+      moved = (u0 * cosine[:,numpy.newaxis] + numpy.cross(axis, u0)
+               + axis * ((axis * u0).sum(axis=1) / (1.0 + cosine))[:,numpy.newaxis])
+      twist = numpy.abs(numpy.arctan2((numpy.cross(moved, u1) * b).sum(axis=1), (moved * u1).sum(axis=1)))
+      if ring:
+        length = numpy.sqrt(((samples[1:] - samples[:-1]) ** 2).sum(axis=1))
+        self.assertTrue((twist <= numpy.pi * length / length.sum() + 1.0e-9).all())
+      else:
+        self.assertLessEqual(twist.max(), 1.0e-9)
+
+
+class CurveResultCacheTest(unittest.TestCase):
+
+  def test_leastRecentlyUsed(self):
+    # The same control points and parameters give the same key; the cache
+    # holds two of the three results and evicts the least recently used one
+    engine = CurveEngine()
+    points = [randomCurve(20, seed) for seed in range(3)]
+    results = [engine.generate(p) for p in points]
+    tubes = []
+    for result in results:
+      poly = vtk.vtkPolyData()
+      updatePolyLine(poly, result.getSamples())
+      tubes.append(poly)
+    keys = [CurveResultCache.makeKey(p, (25, 0)) for p in points]
+    self.assertEqual(CurveResultCache.makeKey(points[0].copy(), (25, 0)), keys[0])
+    self.assertNotEqual(CurveResultCache.makeKey(points[0], (10, 0)), keys[0])
+
+    size = results[0].getSamples().nbytes + tubes[0].GetActualMemorySize() * 1024
+    cache = CurveResultCache(2 * size + size // 2)
+    for (key, result, tube) in zip(keys[:2], results, tubes):
+      cache.put(key, result.getSamples(), tube)
+    self.assertIs(cache.get(keys[0])[1], tubes[0])
+    cache.put(keys[2], results[2].getSamples(), tubes[2])
+    self.assertIsNone(cache.get(keys[1]))
+    self.assertIsNotNone(cache.get(keys[0]))
+    self.assertIsNotNone(cache.get(keys[2]))
+    statistics = cache.getStatistics()
+    self.assertEqual((statistics['hits'], statistics['misses'], statistics['evictions'], statistics['entries']), (3, 1, 1, 2))
+
+    cache.setMaxMemory(0)
+    self.assertFalse(cache.isEnabled())
+    self.assertEqual(cache.getStatistics()['entries'], 0)
+
+
+class CurveArchiveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'curves.crv')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_roundTrip(self):
+    engine = CurveEngine()
+    engine.InterpolationMethod = 1
+    engine.Curvature = 1
+    results = [engine.generate(randomCurve(8, seed)) for seed in range(3)]
+    targets = randomCurve(4, 5)
+    with CurveArchiveWriter(self.path) as writer:
+      for result in results[:2]:
+        writer.writeResult(result, targets)
+    with CurveArchiveWriter(self.path, append=True) as writer:
+      writer.writeResult(results[2], metadata={'case' : 'appended'})
+
+    archive = CurveArchive(self.path)
+    self.assertEqual(len(archive), 3)
+    for (record, result) in zip(archive, results):
+      numpy.testing.assert_array_equal(record.samples, result.getSamples())
+      numpy.testing.assert_array_equal(record.arcLengths, result.getSampleArcLengths())
+      numpy.testing.assert_array_equal(record.curvature, result.CurvatureData.values)
+      self.assertEqual(record.parameters, result.Parameters)
+    numpy.testing.assert_array_equal(archive[0].targets, targets)
+    numpy.testing.assert_array_equal(archive[0].distances, results[0].distancesToPoints(targets, False)[0])
+    self.assertEqual(archive[2].targets.shape, (0, 3))
+    self.assertEqual(archive[2].metadata['case'], 'appended')
+
+  def test_appendAfterIncompleteRecord(self):
+    # The second record is cut (e.g. by an interrupted batch) in its data or
+    # in its header: it is replaced by the appended one
+    samples = [randomCurve(20, seed) for seed in range(3)]
+    with CurveArchiveWriter(self.path) as writer:
+      for points in samples[:2]:
+        writer.write(points)
+    end = CurveArchive(self.path).offsets[1]
+    for size in (os.path.getsize(self.path) - 8, end + 20):
+      with open(self.path, 'r+b') as f:
+        f.truncate(size)
+      self.assertEqual(len(CurveArchive(self.path)), 1)
+      with CurveArchiveWriter(self.path, append=True) as writer:
+        writer.write(samples[2])
+      archive = CurveArchive(self.path)
+      self.assertEqual(len(archive), 2)
+      numpy.testing.assert_array_equal(archive[0].samples, samples[0])
+      numpy.testing.assert_array_equal(archive[1].samples, samples[2])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,327 @@
+#
+# Tests of CurveMakerLogic in Slicer: the curves generated from a markups
+# node are the same as those of CurveMakerLib.CurveEngine.
+#
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+import slicer
+
+import CurveMaker
+from CurveMakerLib import CurveEngine, CurveArchive
+from CurveMakerTestData import randomCurve
+
+
+class CancelledProgress:
+
+  # Replaces CurveMaker.DistanceMapProgress: cancels the distance map after
+  # its first chunk
+
+  def __init__(self, nPoints, minimumPoints):
+    pass
+
+  def __enter__(self):
+    return lambda done, total: False
+
+  def __exit__(self, *args):
+    pass
+
+
+class CurveMakerLogicTest(unittest.TestCase):
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+    self.points = randomCurve(200)
+    self.sourceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    slicer.util.updateMarkupsControlPointsFromArray(self.sourceNode, self.points)
+    self.destinationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+    self.destinationNode.CreateDefaultDisplayNodes()
+
+  def tearDown(self):
+    slicer.mrmlScene.Clear(0)
+
+  def newLogic(self, parameters):
+    logic = CurveMaker.CurveMakerLogic()
+    logic.SourceNode = self.sourceNode
+    logic.DestinationNode = self.destinationNode
+    logic.setEngineParameters(parameters)
+    logic.AutomaticUpdate = True
+    logic.updateCurve()
+    return logic
+
+  def checkSamples(self, logic, points):
+    engine = CurveEngine()
+    engine.setParameters(logic.getEngineParameters())
+    result = engine.generate(points)
+    samples = CurveMaker.polyPoints(logic.CurvePoly)
+    numpy.testing.assert_allclose(samples, result.getSamples(), rtol=0.0, atol=1.0e-9)
+    self.assertAlmostEqual(logic.CurveLength, result.CurveLength, places=9)
+    if result.CurvatureData:
+      numpy.testing.assert_allclose(logic.CurvatureData.values, result.CurvatureData.values, rtol=0.0, atol=1.0e-9)
+
+  def processEvents(self, duration=0.0):
+    # Runs the event loop for 'duration' seconds (at least once)
+    end = time.perf_counter() + duration
+    slicer.app.processEvents()
+    while time.perf_counter() < end:
+      time.sleep(0.005)
+      slicer.app.processEvents()
+
+  def trackedPoints(self, tracker):
+    # Control points with the point moved by 'tracker'
+    points = self.points.copy()
+    position = [0.0, 0.0, 0.0]
+    self.sourceNode.GetNthControlPointPosition(tracker.pointIndex, position)
+    points[tracker.pointIndex] = position
+    return points
+
+  def test_engineSamples(self):
+    for method in (0, 1):
+      for ring in (0, 1):
+        for sampling in (0, 1, 2):
+          parameters = {'InterpolationMethod' : method, 'RingMode' : ring, 'SamplingMode' : sampling, 'Curvature' : 1}
+          self.checkSamples(self.newLogic(parameters), self.points)
+
+  def test_localUpdate(self):
+    logic = self.newLogic({'InterpolationMethod' : 1, 'Curvature' : 1})
+    logic.enableProfiling()
+    self.points[100] += [4.0, -3.0, 2.0]
+    self.sourceNode.SetNthControlPointPosition(100, *self.points[100])
+    logic.controlPointsUpdated(self.sourceNode, vtk.vtkCommand.ModifiedEvent)
+    self.assertEqual(logic.getProfile()['updates'][-1]['kind'], 'local')
+    self.checkSamples(logic, self.points)
+
+  def test_repeatedConfigurationHit(self):
+    # Switching the ring mode and the curvature back and forth, as in the
+    # widget, with the default cache
+    logic = self.newLogic({'InterpolationMethod' : 1})
+    for (ring, curvature) in ((1, 0), (1, 1), (0, 0), (1, 0), (1, 1)):
+      logic.setRing(ring)
+      logic.setCurvature(curvature)
+    statistics = logic.getResultCacheStatistics()
+    self.assertGreaterEqual(statistics['hits'], 3)
+    self.checkSamples(logic, self.points)
+
+  def test_cacheHitThenLocalUpdate(self):
+    logic = self.newLogic({'InterpolationMethod' : 1, 'Curvature' : 1})
+    logic.enableProfiling()
+    # (the curve of newLogic() has the default resolution, 25)
+    hits = logic.getResultCacheStatistics()['hits']
+    for resolution in (10, 25, 10):
+      logic.setEngineParameters({'interpResolution' : resolution})
+    self.assertEqual(logic.getResultCacheStatistics()['hits'], hits + 2)
+    self.checkSamples(logic, self.points)
+
+    # The spline is kept on a hit: the next move is a local update
+    self.points[100] += [4.0, -3.0, 2.0]
+    self.sourceNode.SetNthControlPointPosition(100, *self.points[100])
+    logic.controlPointsUpdated(self.sourceNode, vtk.vtkCommand.ModifiedEvent)
+    self.assertEqual(logic.getProfile()['updates'][-1]['kind'], 'local')
+    self.checkSamples(logic, self.points)
+
+  def test_updateScheduler(self):
+    # In a burst of moves, the first one is processed at once and the
+    # others are merged into one update at the end of the interval
+    logic = self.newLogic({'InterpolationMethod' : 1})
+    logic.setUpdateInterval(50)
+    updates = logic.UpdateCount
+    for k in range(5):
+      self.points[100] += [1.0, 0.0, 0.0]
+      self.sourceNode.SetNthControlPointPosition(100, *self.points[100])
+      logic.controlPointsUpdated(self.sourceNode, vtk.vtkCommand.ModifiedEvent)
+    self.assertEqual(logic.UpdateCount, updates + 1)
+    self.processEvents(0.2)
+    self.assertEqual(logic.UpdateCount, updates + 2)
+    self.assertEqual(logic.MergedUpdateRequestCount, 3)
+    self.checkSamples(logic, self.points)
+
+  def test_interactionPreview(self):
+    # During an interaction, the tube is generated with PreviewNumberOfSides
+    # sides around every PreviewDecimation-th point; the full tube is
+    # generated at the end of the interaction
+    logic = self.newLogic({'InterpolationMethod' : 1})
+    nOfPoints = logic.TubeFilter.GetOutput().GetNumberOfPoints()
+    logic.setPreviewLevel(4, 5)
+    logic.startInteraction()
+    self.points[100] += [4.0, -3.0, 2.0]
+    self.sourceNode.SetNthControlPointPosition(100, *self.points[100])
+    logic.controlPointsUpdated(self.sourceNode, vtk.vtkCommand.ModifiedEvent)
+    self.assertTrue(logic.tubeIsPreview)
+    self.assertEqual(logic.TubeFilter.GetNumberOfSides(), 4)
+    nOfSamples = logic.CurvePoly.GetNumberOfPoints()
+    self.assertEqual(logic.PreviewPoly.GetNumberOfPoints(), (nOfSamples - 2) // 5 + 2)
+    self.assertLess(self.destinationNode.GetPolyData().GetNumberOfPoints(), nOfPoints)
+
+    logic.endInteraction()
+    self.assertFalse(logic.tubeIsPreview)
+    self.assertEqual(logic.TubeFilter.GetNumberOfSides(), logic.TubeNumberOfSides)
+    self.assertEqual(self.destinationNode.GetPolyData().GetNumberOfPoints(), nOfPoints)
+    self.checkSamples(logic, self.points)
+
+  def test_curves(self):
+    # Curves added to a logic are updated only when their control points
+    # move, and merged into one model, which replaces their own models
+    manager = CurveMaker.CurveMakerLogic()
+    mergedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+    manager.setMergedModel(mergedNode)
+    points = randomCurve(50, 3)
+    sourceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    slicer.util.updateMarkupsControlPointsFromArray(sourceNode, points)
+    destinationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+    destinationNode.CreateDefaultDisplayNodes()
+    curves = [manager.addCurve(self.sourceNode, self.destinationNode, {'InterpolationMethod' : 1}),
+              manager.addCurve(sourceNode, destinationNode, {'InterpolationMethod' : 1, 'RingMode' : 1})]
+    self.assertEqual(manager.getCurves(), curves)
+    self.checkSamples(curves[0], self.points)
+    self.checkSamples(curves[1], points)
+    for curve in curves:
+      self.assertIsNone(curve.updateTimer)
+      self.assertIsNot(curve.ModelColor, manager.ModelColor)
+      self.assertFalse(curve.DestinationNode.GetDisplayNode().GetVisibility())
+
+    def checkMerged(curves):
+      tubes = [CurveMaker.polyPoints(curve.TubeFilter.GetOutput()) for curve in curves]
+      numpy.testing.assert_array_equal(CurveMaker.polyPoints(mergedNode.GetPolyData()), numpy.vstack(tubes))
+    checkMerged(curves)
+
+    updates = [curve.UpdateCount for curve in curves]
+    points[10] += [4.0, -3.0, 2.0]
+    sourceNode.SetNthControlPointPosition(10, *points[10])
+    self.assertEqual([curve.UpdateCount for curve in curves], [updates[0], updates[1] + 1])
+    self.checkSamples(curves[1], points)
+    checkMerged(curves)
+
+    manager.removeCurve(sourceNode)
+    self.assertEqual(manager.getCurves(), curves[:1])
+    self.assertTrue(destinationNode.GetDisplayNode().GetVisibility())
+    checkMerged(curves[:1])
+    sourceNode.SetNthControlPointPosition(10, *(points[10] + 1.0))
+    self.assertEqual(curves[1].UpdateCount, updates[1] + 1)
+
+    manager.setMergedModel(None)
+    self.assertTrue(self.destinationNode.GetDisplayNode().GetVisibility())
+
+  def test_controlPointCacheNodeRemoved(self):
+    # The cache of a node removed from the scene is dropped with its
+    # observers, the others are kept
+    logic = self.newLogic({'InterpolationMethod' : 1})
+    targetNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    slicer.util.updateMarkupsControlPointsFromArray(targetNode, randomCurve(5, 1))
+    logic.getControlPoints(targetNode)
+    targetID = targetNode.GetID()
+    cache = logic.controlPointCaches[targetID]
+    slicer.mrmlScene.RemoveNode(targetNode)
+    self.assertNotIn(targetID, logic.controlPointCaches)
+    self.assertEqual(cache.tags, [])
+    self.assertIn(self.sourceNode.GetID(), logic.controlPointCaches)
+
+    logic.clearControlPointCache()
+    self.assertIsNone(logic.cacheScene)
+
+  def test_streaming(self):
+    logic = self.newLogic({'InterpolationMethod' : 1, 'Curvature' : 1})
+    self.sourceNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, logic.controlPointsUpdated, 2)
+    logic.setStreamingMode(True, 1000.0)
+    logic.StreamIdleInterval = 50
+    tracker = CurveMaker.CurveMakerSimulatedTracker(self.sourceNode, radius=5.0)
+
+    # The samples arriving before the event loop runs are merged into one
+    # update with the latest one
+    for k in range(3):
+      tracker.moveTo(k / 60.0)
+    self.assertEqual(logic.getStreamingStatistics()['updates'], 0)
+    self.processEvents()
+    statistics = logic.getStreamingStatistics()
+    self.assertEqual((statistics['samples'], statistics['updates'], statistics['dropped']), (3, 1, 2))
+    self.assertEqual(statistics['overBudget'], 0)
+    self.assertFalse(statistics['preview'])
+    self.assertFalse(logic.tubeIsPreview)
+    self.checkSamples(logic, self.trackedPoints(tracker))
+
+    # Over the budget: the tube is a preview until no sample has arrived for
+    # StreamIdleInterval, then the full tube is generated
+    logic.setStreamingMode(True, 0.0)
+    tracker.moveTo(0.1)
+    self.processEvents()
+    self.assertTrue(logic.getStreamingStatistics()['preview'])
+    tracker.moveTo(0.2)
+    self.processEvents()
+    self.assertTrue(logic.tubeIsPreview)
+    self.assertEqual(logic.getStreamingStatistics()['overBudget'], 2)
+    self.processEvents(0.2)
+    self.assertFalse(logic.getStreamingStatistics()['preview'])
+    self.assertFalse(logic.tubeIsPreview)
+    self.checkSamples(logic, self.trackedPoints(tracker))
+
+  def test_streamingManagedCurve(self):
+    # A streamed curve added to a manager is updated by the scheduler of the
+    # manager, with the merged model
+    manager = CurveMaker.CurveMakerLogic()
+    mergedNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+    manager.setMergedModel(mergedNode)
+    curve = manager.addCurve(self.sourceNode, self.destinationNode, {'InterpolationMethod' : 1})
+    curve.setStreamingMode(True, 1000.0)
+    tracker = CurveMaker.CurveMakerSimulatedTracker(self.sourceNode, radius=5.0)
+    nOfPoints = mergedNode.GetPolyData().GetNumberOfPoints()
+    self.assertEqual(nOfPoints, curve.TubeFilter.GetOutput().GetNumberOfPoints())
+
+    tracker.moveTo(0.25)
+    tracker.moveTo(0.5)
+    self.assertEqual(curve.getStreamingStatistics()['updates'], 0)
+    self.processEvents()
+    statistics = curve.getStreamingStatistics()
+    self.assertEqual((statistics['samples'], statistics['updates'], statistics['dropped']), (2, 1, 1))
+    self.checkSamples(curve, self.trackedPoints(tracker))
+    merged = CurveMaker.polyPoints(mergedNode.GetPolyData())
+    numpy.testing.assert_array_equal(merged, CurveMaker.polyPoints(curve.TubeFilter.GetOutput()))
+
+  def test_distanceMapCancelled(self):
+    # Vertices of a model in two chunks (see CurveMakerLib.mapChunks())
+    logic = self.newLogic({'InterpolationMethod' : 1})
+    rng = numpy.random.RandomState(5)
+    points = self.points.mean(axis=0) + rng.uniform(-50.0, 50.0, size=(70000, 3))
+    poly = vtk.vtkPolyData()
+    poly.SetPoints(vtk.vtkPoints())
+    poly.GetPoints().SetData(numpy_support.numpy_to_vtk(points, deep=1))
+    modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+    modelNode.SetAndObservePolyData(poly)
+    expected = logic.computeDistanceMap(modelNode, workers=1)
+    values = numpy_support.vtk_to_numpy(poly.GetPointData().GetArray('CurveDistance'))
+    numpy.testing.assert_array_equal(values, expected)
+
+    values[:] = -1.0
+    with mock.patch.object(CurveMaker, 'DistanceMapProgress', CancelledProgress):
+      self.assertIsNone(logic.computeDistanceMap(modelNode, workers=1))
+      self.assertTrue((values == -1.0).all())
+      self.assertIsNone(logic.computeDistanceMap(modelNode, workers=1, fillCancelled=True))
+    done = ~numpy.isnan(values)
+    self.assertEqual(done.sum(), 65536)
+    numpy.testing.assert_array_equal(values[done], expected[done])
+
+  def test_exportCurveData(self):
+    logic = self.newLogic({'InterpolationMethod' : 1, 'RingMode' : 1, 'Curvature' : 1})
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'curves.crv')
+      logic.exportCurveData(path)
+      record = CurveArchive(path)[0]
+      engine = CurveEngine()
+      engine.setParameters(logic.getEngineParameters())
+      result = engine.generate(self.points)
+      numpy.testing.assert_allclose(record.arcLengths, result.getSampleArcLengths(), rtol=0.0, atol=1.0e-9)
+      numpy.testing.assert_allclose(record.curvature, result.CurvatureData.values, rtol=0.0, atol=1.0e-9)
+      del record
+    finally:
+      shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,30 @@
+#
+# Synthetic control points shared by the tests and the benchmark.
+#
+
+import numpy
+
+
+def randomCurve(n, seed=0):
+  # Random walk of n control points, about 10 mm apart
+  rng = numpy.random.RandomState(seed)
+  return numpy.cumsum(rng.normal(scale=6.0, size=(n, 3)), axis=0)
+
+
+def syntheticCurve(n, closed, seed=0):
+  # Control points along a noisy helix (open) or a noisy torus knot (closed),
+  # about 2 mm apart
+  rng = numpy.random.RandomState(seed)
+  u = numpy.linspace(0.0, 1.0, n, endpoint=not closed)
+  if closed:
+    angle = 2.0 * numpy.pi * u
+    r = 50.0 + 10.0 * numpy.cos(3.0 * angle)
+    points = numpy.column_stack((r * numpy.cos(2.0 * angle), r * numpy.sin(2.0 * angle), 10.0 * numpy.sin(3.0 * angle)))
+    scale = 2.0 * n / (2.0 * numpy.pi * 50.0 * 2.0)
+  else:
+    turns = max(n / 50.0, 1.0)
+    angle = 2.0 * numpy.pi * turns * u
+    points = numpy.column_stack((30.0 * numpy.cos(angle), 30.0 * numpy.sin(angle), 20.0 * turns * u))
+    scale = 2.0 * n / (2.0 * numpy.pi * 30.0 * turns)
+  points = points * scale
+  return points + rng.normal(scale=0.2, size=points.shape)